@@ -1,22 +1,29 @@
-from fastapi import FastAPI, Body,Depends,HTTPException,status
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, Body,Depends,HTTPException,Request,status
+from fastapi.responses import JSONResponse,StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.security import OAuth2PasswordBearer,OAuth2PasswordRequestForm
 from contextlib import asynccontextmanager  # 用於建立 lifespan 
 import logging
-from sqlmodel import SQLModel,Field,create_engine,Session,select
+from sqlmodel import SQLModel,Field,Session,select,delete,func,or_,and_
+from sqlalchemy import Index, literal
 from pydantic import BaseModel
 from jose import JWTError, jwt  # JWT處理
 from passlib.context import CryptContext  # 加密用
-from package.travel_rag import TravelRAGService
+from package.worker_pool import BoundedWorkerPool, BoundedAsyncPool, WorkerPoolSaturated
+from package.query_expansion import QUERY_EXPANSION_MODES
+from package.ttl_cache import TTLCache
+from app.database import create_db_engine, describe_engine, is_sqlite
+from app.revocation import create_revocation_store
 from datetime import datetime,timedelta
-from typing import Annotated,Optional,Dict,List,Set
+from typing import Annotated,Any,Optional,Dict,List,Set
+import asyncio
 import json
 import os
 from dotenv import load_dotenv
 import jose
 from uuid import uuid4
+import base64
 
 
 
@@ -27,25 +34,12 @@ load_dotenv(dotenv_path)
 # 取得API key
 gemini_api_key = os.getenv("gemini_api_key")
 cohere_api_key= os.getenv("cohere_api_key")
+# 多把 Gemini 金鑰以逗號分隔，輪流使用
+gemini_api_keys = [key.strip() for key in os.getenv("gemini_api_keys", "").split(",") if key.strip()]
 # 設定日誌
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# 初始化 台灣旅遊 RAG 服務
-try:
-    rag_service = TravelRAGService(
-        gemini_api_key=gemini_api_key,
-        cohere_api_key=cohere_api_key
-    )
-    logger.info("台灣旅遊 RAG 服務初始化成功")
-except Exception as e:
-    logger.error(f"初始化 RAG 服務出錯: {str(e)}")
-
-#設定JWT參數
-SECRET_KEY=os.getenv("secret_key")
-ALGORITHM = "HS256"  
-ACCESS_TOKEN_EXPIRE_MINUTES = 30
-
 #設定資料庫
 # 檢查是否在 Docker 環境
 if os.path.exists('/code'):
@@ -55,10 +49,231 @@ else:  # 本地開發環境
     backend_dir = os.path.dirname(os.path.dirname(__file__))
     databas_name = os.path.join(backend_dir, "database.db")
 
-database_path=f"sqlite:///{databas_name}"
-connect_args={"check_same_thread":False}
-engine=create_engine(database_path,connect_args=connect_args)
-print(f"Database path: {databas_name}")
+# 語意快取設定，預設以 SQLite 存放在資料庫旁
+SEMANTIC_CACHE_ENABLED = os.getenv("semantic_cache_enabled", "true").lower() == "true"
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("semantic_cache_threshold", "0.95"))
+SEMANTIC_CACHE_TTL = int(os.getenv("semantic_cache_ttl", "86400"))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("semantic_cache_max_entries", "1000"))
+SEMANTIC_CACHE_PATH = os.getenv(
+    "semantic_cache_path",
+    os.path.join(os.path.dirname(databas_name), "semantic_cache.db")
+) or None  # 設為空字串時只使用記憶體
+
+# 完全比對快取設定 (以正規化後的查詢字串為鍵)
+RESPONSE_CACHE_ENABLED = os.getenv("response_cache_enabled", "true").lower() == "true"
+RESPONSE_CACHE_TTL = int(os.getenv("response_cache_ttl", "3600"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("response_cache_max_entries", "2000"))
+
+# 速率限制設定 (每秒請求數與可累積的突發請求數)，未設定的項目使用 TravelRAGService 的預設值
+RATE_LIMITS = {}
+for purpose in ("query_generation", "answer_generation", "rerank"):
+    limit = {}
+    if os.getenv(f"rate_limit_{purpose}_rps"):
+        limit["requests_per_second"] = float(os.getenv(f"rate_limit_{purpose}_rps"))
+    if os.getenv(f"rate_limit_{purpose}_burst"):
+        limit["burst"] = int(os.getenv(f"rate_limit_{purpose}_burst"))
+    if limit:
+        RATE_LIMITS[purpose] = limit
+
+# 查詢擴展方式 llm/local/none，請求中可用 query_expansion 欄位覆寫
+QUERY_EXPANSION_MODE = os.getenv("query_expansion_mode", "llm")
+
+# 嵌入模型執行方式 torch/onnx/onnx_int8，容器沒有 GPU 時可改用 ONNX Runtime
+EMBEDDING_BACKEND = os.getenv("embedding_backend", "torch")
+EMBEDDING_THREADS = int(os.getenv("embedding_threads", "0")) or None
+
+# 查詢向量快取，設定 query_embedding_cache_shared_path 時多個 worker 共用同一個 mmap 檔案
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("query_embedding_cache_size", "4096"))
+QUERY_EMBEDDING_CACHE_TTL = int(os.getenv("query_embedding_cache_ttl", "86400")) or None
+QUERY_EMBEDDING_CACHE_SHARED_PATH = os.getenv("query_embedding_cache_shared_path") or None
+
+# 向量檢索方式 chroma/numpy，numpy 以 mmap 載入的向量矩陣做精確搜尋 (float16 時記憶體減半)
+VECTOR_BACKEND = os.getenv("vector_backend", "chroma")
+VECTOR_DTYPE = os.getenv("vector_dtype", "float32")
+
+# 向量與 BM25 結果的合併方式 rrf/blend、權重與兩種檢索的深度
+FUSION_MODE = os.getenv("fusion_mode", "rrf")
+FUSION_WEIGHTS = tuple(float(w) for w in os.getenv("fusion_weights", "0.8,0.2").split(","))
+FUSION_RRF_K = int(os.getenv("fusion_rrf_k", "60"))
+FUSION_TOP_N = int(os.getenv("fusion_top_n", "0")) or None
+RETRIEVAL_DENSE_DEPTH = int(os.getenv("retrieval_dense_depth", "10"))
+RETRIEVAL_SPARSE_DEPTH = int(os.getenv("retrieval_sparse_depth", "10"))
+# 重新排序後放入提示的區塊數量
+RETRIEVAL_TOP_N = int(os.getenv("retrieval_top_n", "10"))
+
+# 提示內容組合：同一景點的區塊合併去重，移除低分尾端並依 token 預算截取
+CONTEXT_PACKING_ENABLED = os.getenv("context_packing_enabled", "true").lower() == "true"
+CONTEXT_TOKEN_BUDGET = int(os.getenv("context_token_budget", "1500"))
+CONTEXT_MIN_SCORE_RATIO = float(os.getenv("context_min_score_ratio", "0.1"))
+
+# 查詢提到縣市、鄉鎮市區或類別時先過濾再檢索
+METADATA_FILTER_ENABLED = os.getenv("metadata_filter_enabled", "true").lower() == "true"
+
+# 重新排序設定 cohere/cross_encoder/none，逾時時該次請求改用檢索合併後的順序
+RERANKER_BACKEND = os.getenv("reranker_backend", "cohere")
+RERANKER_MODEL = os.getenv("reranker_model") or None
+RERANKER_ONNX_FILE = os.getenv("reranker_onnx_file") or None
+RERANKER_TIMEOUT_SECONDS = float(os.getenv("reranker_timeout_seconds", "10"))
+RERANKER_MAX_CANDIDATES = int(os.getenv("reranker_max_candidates", "50"))
+
+# 台灣旅遊 RAG 服務在 lifespan 中於背景初始化，完成前搜尋 API 回傳 503
+rag_service = None
+rag_state = {"status": "starting", "error": None}
+RAG_WARMUP_RETRY_AFTER_SECONDS = int(os.getenv("rag_warmup_retry_after_seconds", "30"))
+
+# 多 worker 模式：設定模型伺服器的 Unix socket 後，嵌入與 cross-encoder 由模型伺服器計算，各 worker 不載入模型
+MODEL_SERVER_SOCKET = os.getenv("model_server_socket") or None
+MODEL_SERVER_TIMEOUT = float(os.getenv("model_server_timeout", "30"))
+
+def init_rag_service():
+    """初始化 台灣旅遊 RAG 服務 (載入模型與向量資料庫較耗時，在背景執行緒中執行)"""
+    global rag_service
+    try:
+        # 延後載入，避免 torch 與 langchain 拖慢服務啟動
+        from package.travel_rag import TravelRAGService
+        from package.model_server import default_authkey
+        
+        service = TravelRAGService(
+            gemini_api_key=gemini_api_key,
+            cohere_api_key=cohere_api_key,
+            gemini_api_keys=gemini_api_keys,
+            rate_limits=RATE_LIMITS,
+            semantic_cache_enabled=SEMANTIC_CACHE_ENABLED,
+            semantic_cache_threshold=SEMANTIC_CACHE_THRESHOLD,
+            semantic_cache_ttl=SEMANTIC_CACHE_TTL,
+            semantic_cache_max_entries=SEMANTIC_CACHE_MAX_ENTRIES,
+            semantic_cache_path=SEMANTIC_CACHE_PATH,
+            response_cache_enabled=RESPONSE_CACHE_ENABLED,
+            response_cache_ttl=RESPONSE_CACHE_TTL,
+            response_cache_max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+            query_expansion_mode=QUERY_EXPANSION_MODE,
+            reranker_backend=RERANKER_BACKEND,
+            reranker_model=RERANKER_MODEL,
+            reranker_onnx_file=RERANKER_ONNX_FILE,
+            reranker_timeout=RERANKER_TIMEOUT_SECONDS,
+            reranker_max_candidates=RERANKER_MAX_CANDIDATES,
+            metadata_filter_enabled=METADATA_FILTER_ENABLED,
+            embedding_backend=EMBEDDING_BACKEND,
+            embedding_threads=EMBEDDING_THREADS,
+            query_embedding_cache_size=QUERY_EMBEDDING_CACHE_SIZE,
+            query_embedding_cache_ttl=QUERY_EMBEDDING_CACHE_TTL,
+            query_embedding_cache_shared_path=QUERY_EMBEDDING_CACHE_SHARED_PATH,
+            vector_backend=VECTOR_BACKEND,
+            vector_dtype=VECTOR_DTYPE,
+            fusion_mode=FUSION_MODE,
+            fusion_weights=FUSION_WEIGHTS,
+            fusion_rrf_k=FUSION_RRF_K,
+            fusion_top_n=FUSION_TOP_N,
+            retrieval_dense_depth=RETRIEVAL_DENSE_DEPTH,
+            retrieval_sparse_depth=RETRIEVAL_SPARSE_DEPTH,
+            retrieval_top_n=RETRIEVAL_TOP_N,
+            context_packing_enabled=CONTEXT_PACKING_ENABLED,
+            context_token_budget=CONTEXT_TOKEN_BUDGET,
+            context_min_score_ratio=CONTEXT_MIN_SCORE_RATIO,
+            model_server_address=MODEL_SERVER_SOCKET,
+            model_server_authkey=default_authkey(),
+            model_server_timeout=MODEL_SERVER_TIMEOUT
+        )
+        if not service.is_ready():
+            raise RuntimeError("問答鏈未設置")
+        
+        rag_service = service
+        rag_state["status"] = "ready"
+        logger.info("台灣旅遊 RAG 服務初始化成功")
+    except Exception as e:
+        rag_state["status"] = "failed"
+        rag_state["error"] = str(e)
+        logger.error(f"初始化 RAG 服務出錯: {str(e)}")
+
+# 取得已就緒的 RAG 服務
+def get_rag_service():
+    """RAG 服務尚未就緒時回傳 503"""
+    if rag_service is None:
+        if rag_state["status"] == "failed":
+            detail = f"RAG 服務初始化失敗: {rag_state['error']}"
+        else:
+            detail = "RAG 服務初始化中，請稍後再試"
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=detail,
+            headers={"Retry-After": str(RAG_WARMUP_RETRY_AFTER_SECONDS)}
+        )
+    return rag_service
+
+v_rag_service=Annotated[Any,Depends(get_rag_service)]
+
+# RAG 工作池設定，避免同步的 RAG 查詢阻塞 event loop
+RAG_MAX_WORKERS = int(os.getenv("rag_max_workers", "4"))
+RAG_QUEUE_SIZE = int(os.getenv("rag_queue_size", "16"))
+RAG_TIMEOUT_SECONDS = float(os.getenv("rag_timeout_seconds", "120"))
+RAG_RETRY_AFTER_SECONDS = int(os.getenv("rag_retry_after_seconds", "10"))
+
+# 非同步模式下檢索與生成以協程執行，可同時處理更多查詢而不需要對應數量的執行緒
+RAG_ASYNC = os.getenv("rag_async", "true").lower() == "true"
+RAG_MAX_CONCURRENCY = int(os.getenv("rag_max_concurrency", "32"))
+
+if RAG_ASYNC:
+    rag_pool = BoundedAsyncPool(
+        name="rag-async",
+        max_concurrency=RAG_MAX_CONCURRENCY,
+        max_queue=RAG_QUEUE_SIZE,
+        timeout=RAG_TIMEOUT_SECONDS,
+        retry_after=RAG_RETRY_AFTER_SECONDS
+    )
+else:
+    rag_pool = BoundedWorkerPool(
+        name="rag-worker",
+        max_workers=RAG_MAX_WORKERS,
+        max_queue=RAG_QUEUE_SIZE,
+        timeout=RAG_TIMEOUT_SECONDS,
+        retry_after=RAG_RETRY_AFTER_SECONDS
+    )
+
+# 串流查詢一律以協程執行
+if RAG_ASYNC:
+    rag_stream_pool = rag_pool
+else:
+    rag_stream_pool = BoundedAsyncPool(
+        name="rag-stream",
+        max_concurrency=RAG_MAX_CONCURRENCY,
+        max_queue=RAG_QUEUE_SIZE,
+        timeout=RAG_TIMEOUT_SECONDS,
+        retry_after=RAG_RETRY_AFTER_SECONDS
+    )
+
+#設定JWT參數
+SECRET_KEY=os.getenv("secret_key")
+ALGORITHM = "HS256"  
+ACCESS_TOKEN_EXPIRE_MINUTES = 30
+
+# 已驗證用戶的快取，避免每個請求都查詢資料庫；多個 worker 時停用帳號最多延遲 TTL 秒才在其他 worker 生效
+USER_CACHE_TTL_SECONDS = int(os.getenv("user_cache_ttl_seconds", "60"))
+USER_CACHE_MAX_ENTRIES = int(os.getenv("user_cache_max_entries", "10000"))
+user_cache = TTLCache(max_entries=USER_CACHE_MAX_ENTRIES, ttl_seconds=USER_CACHE_TTL_SECONDS) \
+    if USER_CACHE_TTL_SECONDS > 0 and USER_CACHE_MAX_ENTRIES > 0 else None
+
+#設定資料庫，設定 database_url 時可改用 Postgres
+DATABASE_URL = os.getenv("database_url") or f"sqlite:///{databas_name}"
+DB_POOL_SIZE = int(os.getenv("db_pool_size", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("db_max_overflow", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("db_pool_timeout", "30"))
+# SQLite 寫入鎖被佔用時的等待時間與同步模式
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("sqlite_busy_timeout_ms", "5000"))
+SQLITE_SYNCHRONOUS = os.getenv("sqlite_synchronous", "NORMAL")
+# 歷史記錄摘要模式下回覆保留的字元數
+HISTORY_SUMMARY_CHARS = int(os.getenv("history_summary_chars", "200"))
+engine = create_db_engine(
+    DATABASE_URL,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    busy_timeout_ms=SQLITE_BUSY_TIMEOUT_MS,
+    sqlite_pragmas={"synchronous": SQLITE_SYNCHRONOUS}
+)
+if is_sqlite(DATABASE_URL):
+    print(f"Database path: {engine.url.database}")
+else:
+    print(f"Database: {engine.url.render_as_string(hide_password=True)}")
 
 #用戶資料
 class User(SQLModel, table=True):
@@ -72,6 +287,9 @@ class User(SQLModel, table=True):
 
 #問答紀錄
 class QueryRecord(SQLModel, table=True):
+    # 歷史記錄依 (用戶, 建立時間, ID) 由新到舊分頁，計數與游標查詢都只需掃描這個索引
+    __table_args__ = (Index("ix_queryrecord_user_created_id", "user_id", "created_at", "id"),)
+
     id: int = Field(default=None, primary_key=True)
     user_id: int = Field(foreign_key="user.id", index=True)
     query: str
@@ -99,11 +317,15 @@ class QueryRecordResponse(BaseModel):
     query: str
     response: str
     created_at: datetime
+    # 摘要模式下回覆被截斷時為 True，完整內容需以 /api/history/{record_id} 取得
+    truncated: bool = False
 
 # 多筆問答記錄回應模型
 class QueryHistoryResponse(BaseModel):
     records: list[QueryRecordResponse]
     total: int
+    # 下一頁的游標，沒有下一頁時為 None
+    next_cursor: Optional[str] = None
 
 #給前端用
 class token(BaseModel):
@@ -115,24 +337,138 @@ class TokenData(BaseModel):
     username: Optional[str] = None
 def creat_db():
     SQLModel.metadata.create_all(engine)
+    # create_all 不會替已存在的資料表補上新增的索引
+    for index in QueryRecord.__table__.indexes:
+        index.create(engine, checkfirst=True)
 
-#安全建立資料庫連接
-async def creat_session():
+# 寫入問答記錄，在執行緒中呼叫 (等待 SQLite 寫入鎖時不阻塞 event loop)
+def save_query_record(user_id: int, query: str, response: str) -> int:
+    """寫入一筆問答記錄並回傳記錄ID"""
     with Session(engine) as session:
-        yield session
+        query_record = QueryRecord(
+            user_id=user_id,
+            query=query,
+            response=response
+        )
+        session.add(query_record)
+        session.commit()
+        session.refresh(query_record)
+        return query_record.id
+
+def encode_history_cursor(record) -> str:
+    """以最後一筆記錄的 (建立時間, ID) 產生下一頁的游標"""
+    raw = f"{record.created_at.isoformat()}|{record.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_history_cursor(cursor: str):
+    """解析游標，格式錯誤時拋出 ValueError"""
+    raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+    created_at, record_id = raw.rsplit("|", 1)
+    return datetime.fromisoformat(created_at), int(record_id)
+
+# 讀取問答歷史記錄，在執行緒中呼叫
+def load_user_history(user_id: int, skip: int, limit: int, cursor: Optional[str], summary: bool):
+    """
+    讀取一頁問答歷史記錄
+
+    有游標時從游標之後開始讀取 (不使用 OFFSET)；摘要模式只讀取回覆的前 HISTORY_SUMMARY_CHARS 個字元。
+    """
+    if summary:
+        response = func.substr(QueryRecord.response, 1, HISTORY_SUMMARY_CHARS)
+        truncated = func.length(QueryRecord.response) > HISTORY_SUMMARY_CHARS
+    else:
+        response = QueryRecord.response
+        truncated = literal(False)
+    statement = select(
+        QueryRecord.id, QueryRecord.user_id, QueryRecord.query,
+        response.label("response"), QueryRecord.created_at, truncated.label("truncated")
+    ).where(QueryRecord.user_id == user_id)
+
+    if cursor:
+        created_at, record_id = decode_history_cursor(cursor)
+        statement = statement.where(or_(
+            QueryRecord.created_at < created_at,
+            and_(QueryRecord.created_at == created_at, QueryRecord.id < record_id)
+        ))
+    else:
+        statement = statement.offset(skip)
+    statement = statement.order_by(QueryRecord.created_at.desc(), QueryRecord.id.desc()).limit(limit)
+
+    with Session(engine) as session:
+        rows = session.exec(statement).all()
+        total = session.exec(
+            select(func.count()).select_from(QueryRecord).where(QueryRecord.user_id == user_id)
+        ).one()
+
+    records = [{**row._mapping, "truncated": bool(row.truncated)} for row in rows]
+    next_cursor = encode_history_cursor(rows[-1]) if len(rows) == limit else None
+    return {"records": records, "total": total, "next_cursor": next_cursor}
+
+# 讀取最新一筆問答記錄，在執行緒中呼叫
+def load_latest_record(user_id: int):
+    statement = select(QueryRecord).where(QueryRecord.user_id == user_id)\
+        .order_by(QueryRecord.created_at.desc(), QueryRecord.id.desc()).limit(1)
+    with Session(engine) as session:
+        return session.exec(statement).first()
+
+# 讀取屬於該用戶的問答記錄，在執行緒中呼叫
+def load_user_record(user_id: int, record_id: int):
+    statement = select(QueryRecord).where(
+        QueryRecord.id == record_id,
+        QueryRecord.user_id == user_id
+    )
+    with Session(engine) as session:
+        return session.exec(statement).first()
+
+# 刪除屬於該用戶的問答記錄，在執行緒中呼叫
+def delete_user_record(user_id: int, record_id: int) -> bool:
+    """刪除記錄，記錄不存在或不屬於該用戶時回傳 False"""
+    with Session(engine) as session:
+        result = session.exec(
+            delete(QueryRecord).where(QueryRecord.id == record_id, QueryRecord.user_id == user_id)
+        )
+        session.commit()
+        return result.rowcount > 0
 
-v_session=Annotated[Session,Depends(creat_session)]
 
 #開serve初始化DB
 @asynccontextmanager
 async def lifespan(app:FastAPI):
     creat_db()
     print("資料庫建立完成")
+    # 載入尚未到期的撤銷記錄
+    await asyncio.to_thread(revocation_store.sync)
+    # 在背景初始化 RAG 服務，登入與歷史記錄等 API 不需等待模型載入
+    app.state.rag_init_task = asyncio.create_task(asyncio.to_thread(init_rag_service))
     yield
+    rag_pool.shutdown()
+    auth_pool.shutdown()
 
 #安全性設定
-#加密方法
-pw_content=CryptContext(schemes=["bcrypt"],deprecated="auto") 
+# bcrypt 的成本 (2^rounds 次運算)，調高後較低成本的舊雜湊會在用戶下次登入時重新雜湊
+BCRYPT_ROUNDS = int(os.getenv("bcrypt_rounds", "12"))
+
+# 密碼雜湊工作池設定，bcrypt 是 CPU 密集的工作，不在 event loop 中執行，也不佔用 FastAPI 的執行緒池
+AUTH_MAX_WORKERS = int(os.getenv("auth_max_workers", "0")) or (os.cpu_count() or 2)
+AUTH_QUEUE_SIZE = int(os.getenv("auth_queue_size", "64"))
+AUTH_TIMEOUT_SECONDS = float(os.getenv("auth_timeout_seconds", "10"))
+AUTH_RETRY_AFTER_SECONDS = int(os.getenv("auth_retry_after_seconds", "2"))
+
+auth_pool = BoundedWorkerPool(
+    name="auth-worker",
+    max_workers=AUTH_MAX_WORKERS,
+    max_queue=AUTH_QUEUE_SIZE,
+    timeout=AUTH_TIMEOUT_SECONDS,
+    retry_after=AUTH_RETRY_AFTER_SECONDS
+)
+
+#加密方法 (min_rounds 讓成本較低的雜湊在驗證時標記為需要更新)
+pw_content=CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS
+)
 
 #密碼加密
 def hash_password(password:str)->str:
@@ -142,27 +478,63 @@ def hash_password(password:str)->str:
 def verfiy_password(plain_password:str,hash_password:str):
     return pw_content.verify(plain_password,hash_password)
 
+# 在 auth 工作池中執行密碼雜湊或驗證
+async def run_auth_task(func, *args):
+    """工作池已滿時回傳 429，逾時回傳 503"""
+    try:
+        return await auth_pool.run(func, *args)
+    except WorkerPoolSaturated as e:
+        logger.warning("auth 工作池已滿，拒絕請求")
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="系統忙碌中，請稍後再試",
+            headers={"Retry-After": str(e.retry_after)}
+        )
+    except asyncio.TimeoutError:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="驗證逾時，請稍後再試",
+            headers={"Retry-After": str(AUTH_RETRY_AFTER_SECONDS)}
+        )
+
+# 更新用戶的密碼雜湊
+def update_password_hash(user_id: int, hashed_password: str):
+    with Session(engine) as session:
+        user = session.get(User, user_id)
+        if user is not None:
+            user.hashed_password = hashed_password
+            session.add(user)
+            session.commit()
+
 #驗證使用者登入
-def verfiy_user(session:v_session,user_name:str,password:str):
-    user=session.exec(select(User).where(User.user_name==user_name)).first()
-    if not user or not verfiy_password(password,user.hashed_password):
+async def verfiy_user(user_name:str,password:str):
+    user = await asyncio.to_thread(get_user_by_name, user_name)
+    if not user:
         return None
+    valid, new_hash = await run_auth_task(pw_content.verify_and_update, password, user.hashed_password)
+    if not valid:
+        return None
+    # 雜湊設定過時 (bcrypt 成本低於 BCRYPT_ROUNDS 或舊版格式) 時以新設定重新雜湊
+    if new_hash:
+        await asyncio.to_thread(update_password_hash, user.id, new_hash)
+        logger.info(f"用戶 {user.id} 的密碼已重新雜湊")
     return user
 
-token_blacklist: Dict[str, datetime] = {}
-
-# 定期清理黑名單中已過期的token
-def clean_token_blacklist():
-    """清理黑名單中已過期的token"""
-    global token_blacklist
-    current_time = datetime.now()
-    token_blacklist = {jti: exp_time for jti, exp_time in token_blacklist.items() if exp_time > current_time}
+# 已登出token的撤銷記錄，database 模式下多個 worker 共用 (每隔 token_revocation_sync_seconds 秒同步)
+TOKEN_REVOCATION_BACKEND = os.getenv("token_revocation_backend", "database")
+TOKEN_REVOCATION_SYNC_SECONDS = float(os.getenv("token_revocation_sync_seconds", "1"))
+revocation_store = create_revocation_store(
+    TOKEN_REVOCATION_BACKEND,
+    engine=engine,
+    sync_seconds=TOKEN_REVOCATION_SYNC_SECONDS
+)
 
-# 檢查token是否在黑名單中
-def is_token_blacklisted(jti: str) -> bool:
-    """檢查token是否在黑名單中"""
-    clean_token_blacklist()
-    return jti in token_blacklist
+# 檢查token是否已登出
+async def is_token_blacklisted(jti: str) -> bool:
+    """檢查token是否已登出，需要同步其他 worker 的記錄時在執行緒中讀取資料庫"""
+    if revocation_store.sync_due():
+        await asyncio.to_thread(revocation_store.sync)
+    return revocation_store.is_revoked(jti)
 
 #產生JWT
 def create_access_token(user_id: int, user_name: str, expires_delta: Optional[timedelta] = None):
@@ -227,41 +599,52 @@ app.add_middleware(
 )
 
 
+# 檢查用戶名與email是否可註冊
+def check_user_available(user_name: str, email: str):
+    with Session(engine) as session:
+        # 檢查用戶名是否已存在
+        statement = select(User).where(User.user_name == user_name)
+        db_user = session.exec(statement).first()
+        if db_user:
+            raise HTTPException(status_code=400, detail="用戶名已被使用")
+
+        # 檢查email是否已存在
+        statement = select(User).where(User.email == email)
+        db_user = session.exec(statement).first()
+        if db_user:
+            raise HTTPException(status_code=400, detail="email已被使用")
+
+# 寫入新用戶
+def add_user(user: UserCreate, hashed_password: str):
+    with Session(engine) as session:
+        db_user = User(
+            user_name=user.user_name,
+            email=user.email,
+            hashed_password=hashed_password,
+            created_at=datetime.now()
+        )
+        session.add(db_user)
+        session.commit()
+        session.refresh(db_user)
+        return db_user
+
 # 用戶註冊
 @app.post("/api/register", response_model=UserResponse)
-def register_user(user: UserCreate, session: v_session):
+async def register_user(user: UserCreate):
     """註冊新用戶"""
-    # 檢查用戶名是否已存在
-    statement = select(User).where(User.user_name == user.user_name)
-    db_user = session.exec(statement).first()
-    if db_user:
-        raise HTTPException(status_code=400, detail="用戶名已被使用")
-    
-    # 檢查email是否已存在
-    statement = select(User).where(User.email == user.email)
-    db_user = session.exec(statement).first()
-    if db_user:
-        raise HTTPException(status_code=400, detail="email已被使用")
+    # 先檢查是否重複，避免為無法註冊的請求計算雜湊
+    await asyncio.to_thread(check_user_available, user.user_name, user.email)
     
     # 創建新用戶
-    hashed_password = hash_password(user.password)
-    db_user = User(
-        user_name=user.user_name,
-        email=user.email,
-        hashed_password=hashed_password,
-        created_at=datetime.now()
-    )
-    session.add(db_user)
-    session.commit()
-    session.refresh(db_user)
-    return db_user
+    hashed_password = await run_auth_task(hash_password, user.password)
+    return await asyncio.to_thread(add_user, user, hashed_password)
 
 # 登入
 @app.post("/api/token", response_model=token)
-async def login_for_access_token(form_data: Annotated[OAuth2PasswordRequestForm, Depends()],session:v_session):
+async def login_for_access_token(form_data: Annotated[OAuth2PasswordRequestForm, Depends()]):
     """登入並獲取token"""
     # 認證用戶
-    user = verfiy_user(session, form_data.username, form_data.password)
+    user = await verfiy_user(form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -277,8 +660,33 @@ async def login_for_access_token(form_data: Annotated[OAuth2PasswordRequestForm,
 
     return {"access_token": access_token, "token_type": "bearer"}
 
+def get_user_by_name(user_name: str):
+    """以用戶名稱查詢用戶，查詢完立即歸還連線"""
+    with Session(engine) as session:
+        return session.exec(select(User).where(User.user_name == user_name)).first()
+
+def get_user_by_id(user_id: int):
+    """以用戶ID (token 中的 id) 查詢用戶"""
+    with Session(engine) as session:
+        return session.get(User, user_id)
+
+# 移除快取的用戶資料 (登出、停用帳號時呼叫)
+def invalidate_user_cache(user_id: int):
+    if user_cache is not None:
+        user_cache.pop(user_id)
+
+# 啟用或停用帳號
+def set_user_active(user_id: int, is_active: bool):
+    with Session(engine) as session:
+        user = session.get(User, user_id)
+        if user is not None:
+            user.is_active = is_active
+            session.add(user)
+            session.commit()
+    invalidate_user_cache(user_id)
+
 # 獲取當前用戶
-async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], session:v_session):
+async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]):
     """從token獲取當前用戶"""
     #定義錯誤訊息
     credentials_exception = HTTPException(
@@ -292,12 +700,13 @@ async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], sessio
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
         jti: str = payload.get("jti")
+        user_id: Optional[int] = payload.get("id")
         
         if username is None or jti is None:
             raise credentials_exception
         
         # 檢查token是否在黑名單中
-        if is_token_blacklisted(jti):
+        if await is_token_blacklisted(jti):
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="token已登出",
@@ -308,10 +717,17 @@ async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], sessio
     except JWTError:
         raise credentials_exception
     
-    # 獲取用戶資料
-    statement = select(User).where(User.user_name == token_data.username)
-    user = session.exec(statement).first()
+    # 獲取用戶資料，先查快取；未命中時在執行緒中查詢，且不佔用整個請求期間的連線
+    user = user_cache.get(user_id) if user_cache is not None and user_id is not None else None
     if user is None:
+        if user_id is not None:
+            user = await asyncio.to_thread(get_user_by_id, user_id)
+        else:
+            user = await asyncio.to_thread(get_user_by_name, token_data.username)
+        # 只快取活躍的用戶，已停用的用戶每次都重新確認
+        if user is not None and user.is_active and user_cache is not None:
+            user_cache.set(user.id, user)
+    if user is None or user.user_name != token_data.username:
         raise credentials_exception
     return user
 
@@ -328,6 +744,13 @@ async def read_users_me(current_user: Annotated[User, Depends(get_current_active
     """獲取當前登入用戶資訊"""
     return current_user
 
+# 停用當前用戶的帳號
+@app.post("/users/me/deactivate")
+async def deactivate_users_me(current_user: Annotated[User, Depends(get_current_active_user)]):
+    """停用當前登入用戶的帳號，之後的請求回傳用戶已停用"""
+    await asyncio.to_thread(set_user_active, current_user.id, False)
+    return {"message": "帳號已停用"}
+
 # 登出 API
 @app.post("/api/logout")
 async def logout(
@@ -347,9 +770,9 @@ async def logout(
                 detail="無法處理token"
             )
         
-        # 將token加入黑名單
-        exp_datetime = datetime.fromtimestamp(exp)
-        token_blacklist[jti] = exp_datetime
+        # 撤銷token (database 模式下寫入資料庫)
+        await asyncio.to_thread(revocation_store.revoke, jti, exp)
+        invalidate_user_cache(current_user.id)
         
         return {"message": "登出成功"}
     
@@ -364,35 +787,32 @@ async def logout(
 async def get_user_history(
     skip: int = 0,
     limit: int = 10,
-    current_user: Annotated[User, Depends(get_current_active_user)] = None,
-    session: v_session = None
+    cursor: Optional[str] = None,
+    summary: bool = False,
+    current_user: Annotated[User, Depends(get_current_active_user)] = None
 ):
-    """獲取用戶的問答歷史記錄"""
-    
-    statement = select(QueryRecord).where(QueryRecord.user_id == current_user.id).order_by(QueryRecord.created_at.desc()).offset(skip).limit(limit)
-    
-    records = session.exec(statement).all()
-    
-    # 獲取總記錄數
-    total_count = session.exec(select(QueryRecord).where(QueryRecord.user_id == current_user.id)).all()
-    
-    return {
-        "records": records,
-        "total": len(total_count)
-    }
+    """
+    獲取用戶的問答歷史記錄
+
+    - skip/limit: 依頁碼分頁
+    - cursor: 上一頁回傳的 next_cursor，從該記錄之後繼續讀取 (忽略 skip)，深頁不需掃描前面的記錄
+    - summary: 回覆只保留前段文字，完整內容以 /api/history/{record_id} 取得
+    """
+    if limit < 1 or limit > 100:
+        raise HTTPException(status_code=400, detail="limit 需介於 1 到 100")
+    try:
+        return await asyncio.to_thread(load_user_history, current_user.id, max(skip, 0), limit, cursor, summary)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="無效的游標")
 
 # 獲取最新的用戶問答
 @app.get("/api/history/latest", response_model=QueryRecordResponse)
 async def get_latest_record(
-    current_user: Annotated[User, Depends(get_current_active_user)] = None,
-    session: v_session = None
+    current_user: Annotated[User, Depends(get_current_active_user)] = None
 ):
     """獲取用戶最新的問答記錄"""
     
-    statement = select(QueryRecord).where(QueryRecord.user_id == current_user.id)\
-        .order_by(QueryRecord.created_at.desc()).limit(1)
-    
-    record = session.exec(statement).first()
+    record = await asyncio.to_thread(load_latest_record, current_user.id)
     
     if not record:
         raise HTTPException(status_code=404, detail="無問答記錄")
@@ -403,18 +823,12 @@ async def get_latest_record(
 @app.get("/api/history/{record_id}", response_model=QueryRecordResponse)
 async def get_record_by_id(
     record_id: int,
-    current_user: Annotated[User, Depends(get_current_active_user)] = None,
-    session: v_session = None
+    current_user: Annotated[User, Depends(get_current_active_user)] = None
 ):
     """根據ID獲取特定的問答記錄"""
     
     # 查詢指定的記錄，並確保屬於當前用戶
-    statement = select(QueryRecord).where(
-        QueryRecord.id == record_id,
-        QueryRecord.user_id == current_user.id
-    )
-    
-    record = session.exec(statement).first()
+    record = await asyncio.to_thread(load_user_record, current_user.id, record_id)
     
     if not record:
         raise HTTPException(status_code=404, detail="記錄不存在或無權存取")
@@ -425,63 +839,207 @@ async def get_record_by_id(
 @app.delete("/api/history/{record_id}")
 async def delete_record(
     record_id: int,
-    current_user: Annotated[User, Depends(get_current_active_user)] = None,
-    session: v_session = None
+    current_user: Annotated[User, Depends(get_current_active_user)] = None
 ):
     """刪除問答記錄"""
     
-    # 查詢指定的記錄，並確保屬於當前用戶
-    statement = select(QueryRecord).where(
-        QueryRecord.id == record_id,
-        QueryRecord.user_id == current_user.id
-    )
-    
-    record = session.exec(statement).first()
+    # 只刪除屬於當前用戶的記錄
+    deleted = await asyncio.to_thread(delete_user_record, current_user.id, record_id)
     
-    if not record:
+    if not deleted:
         raise HTTPException(status_code=404, detail="記錄不存在或無權存取")
     
-    # 刪除記錄
-    session.delete(record)
-    session.commit()
-    
     return {"message": "記錄刪除成功"}
 
+# 目前 worker 的行程與記憶體用量，多 worker 模式下可比較各 worker 的 pss
+def worker_process_stats():
+    from package.model_server import process_memory
+    return {"pid": os.getpid(), "model_server": MODEL_SERVER_SOCKET, **process_memory()}
+
+# 用戶快取統計數據，命中次數即為省下的資料庫查詢次數
+def user_cache_stats():
+    if user_cache is None:
+        return {"enabled": False}
+    stats = user_cache.stats()
+    return {"enabled": True, **stats, "db_lookups_avoided": stats["hits"], "db_lookups": stats["misses"]}
+
+# 存活檢查
+@app.get("/healthz")
+async def healthz():
+    """服務是否存活 (不需等待 RAG 服務)"""
+    return {"status": "ok"}
+
+# 就緒檢查
+@app.get("/readyz")
+async def readyz():
+    """RAG 服務是否已可處理查詢"""
+    if rag_service is None:
+        return JSONResponse(
+            content=rag_state,
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            headers={"Retry-After": str(RAG_WARMUP_RETRY_AFTER_SECONDS)}
+        )
+    return rag_state
+
+# 服務統計數據
+@app.get("/api/metrics")
+async def get_metrics():
+    """取得工作池與快取的統計數據"""
+    metrics = {
+        "rag_state": rag_state["status"],
+        "rag_pool": rag_pool.stats(),
+        "rag_stream_pool": rag_stream_pool.stats(),
+        "auth_pool": auth_pool.stats(),
+        "user_cache": user_cache_stats(),
+        "token_revocation": revocation_store.stats(),
+        "database": await asyncio.to_thread(describe_engine, engine),
+        "process": worker_process_stats()
+    }
+    if rag_service is not None:
+        # 使用模型伺服器時會查詢伺服器的統計數據，在執行緒中執行
+        metrics.update(await asyncio.to_thread(rag_service.get_metrics))
+    return metrics
+
+# 處理 request body
+def parse_query_content(body) -> str:
+    """從 request body 取出用戶查詢"""
+    if isinstance(body, dict):
+        return body["content"]
+    # 如果不是字典，嘗試解析 JSON
+    return json.loads(body)["content"]
+
+def parse_query_expansion(body) -> Optional[str]:
+    """從 request body 取出查詢擴展方式 (選填)，未指定時回傳 None 使用預設值"""
+    if not isinstance(body, dict):
+        body = json.loads(body)
+    mode = body.get("query_expansion")
+    if mode is not None and mode not in QUERY_EXPANSION_MODES:
+        raise ValueError(f"query_expansion 必須是 {', '.join(QUERY_EXPANSION_MODES)} 其中之一")
+    return mode
+
 @app.post("/api/search")
 async def response(
     body=Body(None), 
     current_user: Annotated[User, Depends(get_current_active_user)] = None, 
-    session: v_session = None
+    rag_service: v_rag_service = None
 ):
     """
     處理用戶旅遊推薦請求
     """
     try:
-        # 處理 request body
-        if isinstance(body, dict):
-            user_query = body["content"]
-        else:
-            # 如果不是字典，嘗試解析 JSON
-            user_query = json.loads(body)["content"]
+        user_query = parse_query_content(body)
+        query_expansion = parse_query_expansion(body)
+    except Exception as e:
+        return JSONResponse(content={"error": f"處理請求時發生錯誤: {str(e)}"}, status_code=400)
+    
+    try:
         logger.info(f"收到用戶查詢: {user_query}")
         
-        # RAG
-        original_response, response_json = rag_service.process_product_comparison(user_query)
+        # RAG，在工作池中執行避免阻塞 event loop
+        if RAG_ASYNC:
+            original_response, response_json = await rag_pool.run(
+                rag_service.aprocess_product_comparison, user_query, query_expansion=query_expansion
+            )
+        else:
+            original_response, response_json = await rag_pool.run(
+                rag_service.process_product_comparison, user_query, query_expansion=query_expansion
+            )
         
         # 儲存問答記錄到資料庫
-        query_record = QueryRecord(
-            user_id=current_user.id,
-            query=user_query,
-            response=original_response
-        )
-        session.add(query_record)
-        session.commit()
-        session.refresh(query_record)
+        await asyncio.to_thread(save_query_record, current_user.id, user_query, original_response)
         
         # 回傳 JSON 結果
         return JSONResponse(content=response_json)
-        
+    
+    except WorkerPoolSaturated as e:
+        logger.warning(f"RAG 工作池已滿，拒絕查詢: {user_query}")
+        return JSONResponse(
+            content={"error": "系統忙碌中，請稍後再試"},
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            headers={"Retry-After": str(e.retry_after)}
+        )
+    except asyncio.TimeoutError:
+        logger.error(f"RAG 查詢逾時 ({RAG_TIMEOUT_SECONDS} 秒): {user_query}")
+        return JSONResponse(
+            content={"error": "查詢逾時，請稍後再試"},
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT
+        )
     except Exception as e:
         logger.error(f"處理請求時發生錯誤: {str(e)}")
         error_response = {"error": f"處理請求時發生錯誤: {str(e)}"}
         return JSONResponse(content=error_response, status_code=500)
+
+
+# 組成 Server-Sent Event
+def sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.post("/api/search/stream")
+async def stream_response(
+    request: Request,
+    body=Body(None),
+    current_user: Annotated[User, Depends(get_current_active_user)] = None,
+    rag_service: v_rag_service = None
+):
+    """
+    以 Server-Sent Events 串流回傳旅遊推薦
+    
+    事件順序: sources (檢索來源) → 多個 token (生成文字) → done (含問答記錄ID)，
+    發生錯誤時送出 error。串流完整結束後才寫入一次問答記錄，用戶端中途斷線時會取消 Gemini 呼叫。
+    """
+    try:
+        user_query = parse_query_content(body)
+        query_expansion = parse_query_expansion(body)
+    except Exception as e:
+        return JSONResponse(content={"error": f"處理請求時發生錯誤: {str(e)}"}, status_code=400)
+    logger.info(f"收到用戶串流查詢: {user_query}")
+    
+    # 在開始串流前取得名額，已滿時直接回傳 429
+    try:
+        rag_stream = rag_stream_pool.stream(rag_service.astream_query, user_query, query_expansion=query_expansion)
+    except WorkerPoolSaturated as e:
+        logger.warning(f"RAG 工作池已滿，拒絕串流查詢: {user_query}")
+        return JSONResponse(
+            content={"error": "系統忙碌中，請稍後再試"},
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            headers={"Retry-After": str(e.retry_after)}
+        )
+    
+    user_id = current_user.id
+    
+    async def event_generator():
+        answer_parts = []
+        try:
+            async for event, data in rag_stream:
+                if await request.is_disconnected():
+                    logger.info(f"用戶端已斷線，取消查詢: {user_query}")
+                    return
+                if event == "sources":
+                    yield sse_event("sources", {"sources": data})
+                else:
+                    answer_parts.append(data)
+                    yield sse_event("token", {"text": data})
+            
+            # 串流完成後寫入一次問答記錄 (依賴注入的 session 在回應開始前就已關閉，需自行建立)
+            record_id = await asyncio.to_thread(save_query_record, user_id, user_query, "".join(answer_parts))
+            
+            yield sse_event("done", {"record_id": record_id})
+            
+        except asyncio.TimeoutError:
+            logger.error(f"RAG 串流查詢逾時 ({RAG_TIMEOUT_SECONDS} 秒): {user_query}")
+            yield sse_event("error", {"error": "查詢逾時，請稍後再試"})
+        except Exception as e:
+            logger.error(f"串流處理請求時發生錯誤: {str(e)}")
+            yield sse_event("error", {"error": f"處理請求時發生錯誤: {str(e)}"})
+        finally:
+            # 關閉上游產生器，連帶取消 Gemini 串流並釋放名額
+            await rag_stream.aclose()
+    
+    return StreamingResponse(
+        event_generator(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"  # 避免 nginx 緩衝串流
+        }
+    )
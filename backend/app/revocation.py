@@ -0,0 +1,223 @@
+"""
+已登出 token 的撤銷記錄
+
+每個請求只在記憶體中檢查 (雜湊表查詢)，過期的記錄以最小堆積依到期時間移除，不需掃描全部記錄。
+database 模式另外把撤銷記錄寫入資料庫，各 worker 每隔 sync_seconds 秒讀取其他 worker 新增的記錄，
+多個 uvicorn worker (或多台主機共用 Postgres) 時登出在所有 worker 生效。
+"""
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import SQLModel, Field, Session, select, delete
+import heapq
+import threading
+import time
+import logging
+
+# 設置日誌
+logger = logging.getLogger(__name__)
+
+# 撤銷記錄的儲存方式
+#   memory: 只存在目前的行程，多個 worker 時登出只在處理登出請求的 worker 生效
+#   database: 寫入資料庫，各 worker 定期同步
+REVOCATION_BACKENDS = ("memory", "database")
+
+
+class RevokedToken(SQLModel, table=True):
+    """已撤銷的 token (時間皆為 epoch 秒數)"""
+    __tablename__ = "revoked_token"
+
+    jti: str = Field(primary_key=True)
+    expires_at: float = Field(index=True)
+    revoked_at: float = Field(index=True)
+
+
+class MemoryRevocationStore:
+    """
+    記憶體中的撤銷記錄 (執行緒安全)
+
+    jti -> 到期時間的雜湊表負責查詢，(到期時間, jti) 的最小堆積負責依序移除過期記錄，
+    每次操作只移除已到期的記錄，攤銷成本為 O(log n)。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._expires = {}
+        self._heap = []
+
+        # 統計數據
+        self.revocations = 0
+        self.expirations = 0
+        self.checks = 0
+        self.rejected = 0
+
+    def _expire(self, now):
+        while self._heap and self._heap[0][0] <= now:
+            expires_at, jti = heapq.heappop(self._heap)
+            # 同一個 jti 可能以較晚的到期時間重新加入，只移除最新的那一筆
+            if self._expires.get(jti) == expires_at:
+                del self._expires[jti]
+                self.expirations += 1
+
+    def revoke(self, jti, expires_at):
+        """
+        撤銷 token
+
+        Args:
+            jti: token 的 JWT ID
+            expires_at: token 的到期時間 (epoch 秒數)，到期後不需再保留
+        """
+        now = time.time()
+        if expires_at <= now:
+            return
+        with self._lock:
+            self._expire(now)
+            if self._expires.get(jti, 0) >= expires_at:
+                return
+            self._expires[jti] = expires_at
+            heapq.heappush(self._heap, (expires_at, jti))
+            self.revocations += 1
+
+    def is_revoked(self, jti):
+        """token 是否已撤銷"""
+        with self._lock:
+            self._expire(time.time())
+            self.checks += 1
+            revoked = jti in self._expires
+            if revoked:
+                self.rejected += 1
+            return revoked
+
+    def sync_due(self):
+        """記憶體模式不需要同步"""
+        return False
+
+    def sync(self):
+        return None
+
+    def __len__(self):
+        with self._lock:
+            return len(self._expires)
+
+    def stats(self):
+        """取得撤銷記錄的統計數據"""
+        with self._lock:
+            return {
+                "backend": "memory",
+                "entries": len(self._expires),
+                "revocations": self.revocations,
+                "expirations": self.expirations,
+                "checks": self.checks,
+                "rejected": self.rejected,
+            }
+
+
+class DatabaseRevocationStore(MemoryRevocationStore):
+    """
+    寫入資料庫的撤銷記錄
+
+    撤銷時同時寫入本地記憶體與 revoked_token 資料表；查詢只看本地記憶體，
+    由 sync() 讀取 revoked_at 在上次同步之後的記錄 (以索引查詢，不掃描整個資料表)，
+    並每隔 sweep_seconds 秒刪除已到期的記錄。
+    """
+
+    def __init__(self, engine, sync_seconds=1.0, sweep_seconds=60.0, lookback_seconds=5.0):
+        """
+        初始化
+
+        Args:
+            engine: 資料庫引擎
+            sync_seconds: 同步其他 worker 撤銷記錄的間隔秒數 (登出在其他 worker 生效的最長延遲)
+            sweep_seconds: 刪除資料表中已到期記錄的間隔秒數
+            lookback_seconds: 同步時往前多讀取的秒數，容許各 worker 的時鐘誤差與較晚提交的交易
+        """
+        super().__init__()
+        self.engine = engine
+        self.sync_seconds = sync_seconds
+        self.sweep_seconds = sweep_seconds
+        self.lookback_seconds = lookback_seconds
+
+        self._sync_lock = threading.Lock()
+        # None 表示尚未同步，第一次同步讀取所有未到期的記錄
+        self._synced_until = None
+        self._last_sync = float("-inf")
+        self._last_sweep = time.monotonic()
+
+        # 統計數據
+        self.syncs = 0
+        self.synced = 0
+        self.swept = 0
+
+    def revoke(self, jti, expires_at):
+        super().revoke(jti, expires_at)
+        if expires_at <= time.time():
+            return
+        with Session(self.engine) as session:
+            session.add(RevokedToken(jti=jti, expires_at=expires_at, revoked_at=time.time()))
+            try:
+                session.commit()
+            except IntegrityError:
+                # 已由其他請求撤銷
+                session.rollback()
+
+    def sync_due(self):
+        """距離上次同步是否已超過 sync_seconds"""
+        return time.monotonic() - self._last_sync >= self.sync_seconds
+
+    def sync(self):
+        """讀取其他 worker 新增的撤銷記錄，已有其他執行緒在同步時直接返回"""
+        if not self._sync_lock.acquire(blocking=False):
+            return
+        try:
+            started = time.time()
+            if self._synced_until is None:
+                statement = select(RevokedToken.jti, RevokedToken.expires_at).where(RevokedToken.expires_at > started)
+            else:
+                statement = select(RevokedToken.jti, RevokedToken.expires_at).where(
+                    RevokedToken.revoked_at >= self._synced_until - self.lookback_seconds
+                )
+            with Session(self.engine) as session:
+                rows = session.exec(statement).all()
+                if time.monotonic() - self._last_sweep >= self.sweep_seconds:
+                    result = session.exec(delete(RevokedToken).where(RevokedToken.expires_at <= started))
+                    session.commit()
+                    self._last_sweep = time.monotonic()
+                    self.swept += result.rowcount or 0
+
+            for jti, expires_at in rows:
+                MemoryRevocationStore.revoke(self, jti, expires_at)
+            self._synced_until = started
+            self._last_sync = time.monotonic()
+            self.syncs += 1
+            self.synced += len(rows)
+        except Exception as e:
+            # 資料庫暫時無法使用時沿用本地記錄，下次請求再重試
+            logger.warning(f"同步 token 撤銷記錄失敗: {e}")
+            self._last_sync = time.monotonic()
+        finally:
+            self._sync_lock.release()
+
+    def stats(self):
+        stats = super().stats()
+        stats.update({
+            "backend": "database",
+            "sync_seconds": self.sync_seconds,
+            "syncs": self.syncs,
+            "synced_rows": self.synced,
+            "swept_rows": self.swept,
+        })
+        return stats
+
+
+def create_revocation_store(backend="database", engine=None, sync_seconds=1.0):
+    """
+    依設定建立撤銷記錄
+
+    Args:
+        backend: memory 或 database
+        engine: database 模式使用的資料庫引擎
+        sync_seconds: database 模式同步其他 worker 撤銷記錄的間隔秒數
+    """
+    if backend not in REVOCATION_BACKENDS:
+        raise ValueError(f"不支援的 token 撤銷記錄儲存方式: {backend}")
+    if backend == "memory":
+        return MemoryRevocationStore()
+    return DatabaseRevocationStore(engine, sync_seconds=sync_seconds)
@@ -0,0 +1,298 @@
+import csv
+import re
+import unicodedata
+import logging
+
+# 設置日誌
+logger = logging.getLogger(__name__)
+
+# 各欄位可能的標題名稱，依序比對
+COLUMN_ALIASES = {
+    "name": ("名稱", "景點名稱", "景點", "name", "title"),
+    "county": ("縣市", "城市", "city", "county", "region"),
+    "district": ("鄉鎮市區", "鄉鎮", "行政區", "區域", "town", "district"),
+    "category": ("類別", "分類", "類型", "category", "class", "type"),
+    "address": ("地址", "address", "add"),
+}
+
+# 臺灣的縣市，CSV 沒有縣市欄位時仍可辨識
+TAIWAN_COUNTIES = (
+    "臺北市", "新北市", "桃園市", "臺中市", "臺南市", "高雄市", "基隆市", "新竹市", "嘉義市",
+    "新竹縣", "苗栗縣", "彰化縣", "南投縣", "雲林縣", "嘉義縣", "屏東縣", "宜蘭縣", "花蓮縣",
+    "臺東縣", "澎湖縣", "金門縣", "連江縣",
+)
+
+# 縣市的其他常用稱呼
+EXTRA_PLACE_ALIASES = {
+    "馬祖": ("連江縣",),
+    "北部": ("臺北市", "新北市", "基隆市", "桃園市"),
+    "南部": ("臺南市", "高雄市", "屏東縣"),
+}
+
+# 旅遊主題的同義詞，查詢中出現任一詞彙時以整組詞彙擴展
+TOPIC_SYNONYMS = (
+    ("親子", "兒童", "小孩", "家庭", "遛小孩"),
+    ("看海", "海邊", "海景", "海灘", "海岸", "沙灘"),
+    ("夜市", "小吃", "美食"),
+    ("藝術", "美術館", "藝文", "文創", "展覽"),
+    ("溫泉", "泡湯"),
+    ("步道", "健行", "登山", "爬山"),
+    ("古蹟", "歷史", "老街", "文化資產"),
+    ("廟宇", "寺廟", "宮廟", "信仰"),
+    ("自然", "森林", "生態", "國家公園"),
+    ("夜景", "觀景", "展望"),
+    ("博物館", "展覽館", "紀念館"),
+    ("購物", "商圈", "逛街", "百貨"),
+    ("露營", "營地"),
+)
+
+# 寫入向量資料庫 metadata 的結構化欄位，也是檢索前過濾的欄位
+STRUCTURED_FIELDS = ("county", "district", "category")
+
+# 一列可能有多個類別，Chroma 的 metadata 值不能是列表，每個類別另外寫入一個布林欄位「category:類別」
+CATEGORY_KEY_PREFIX = "category:"
+
+# metadata 的寫入方式，改變時需要更新所有區塊的 metadata 並重建結構化欄位索引
+METADATA_VERSION = 2
+
+# 從地址取出縣市與鄉鎮市區
+_ADDRESS = re.compile(r"^[\d\s]*(?P<county>[一-鿿]{2}[縣市])(?P<district>[一-鿿]{1,3}?[鄉鎮市區])")
+
+
+def normalize(text):
+    """全形轉半形並統一「台/臺」"""
+    return unicodedata.normalize("NFKC", text or "").strip().replace("台", "臺")
+
+
+def detect_columns(fieldnames):
+    """
+    依標題辨識 CSV 中的結構化欄位
+
+    Returns:
+        dict: {欄位用途: 欄位名稱}，找不到的用途不會出現
+    """
+    columns = {}
+    normalized = {name: normalize(name).lower() for name in fieldnames or [] if name}
+    for role, aliases in COLUMN_ALIASES.items():
+        # 先找完全相同的標題，再找包含別名的標題
+        for alias in aliases:
+            match = next((name for name, norm in normalized.items() if norm == alias), None)
+            if match is None:
+                match = next((name for name, norm in normalized.items() if alias in norm), None)
+            if match is not None and match not in columns.values():
+                columns[role] = match
+                break
+    return columns
+
+
+def parse_address(address):
+    """從地址取出 (縣市, 鄉鎮市區)，無法辨識時回傳 (None, None)"""
+    match = _ADDRESS.match(normalize(address))
+    if not match or match.group("county") not in TAIWAN_COUNTIES:
+        return None, None
+    return match.group("county"), match.group("district")
+
+
+def split_categories(value):
+    """類別欄位可能有多個值，以常見的分隔符號切開"""
+    categories = (normalize(category) for category in re.split(r"[,，、/;；|]", value or ""))
+    return [category for category in categories if len(category) >= 2]
+
+
+def category_key(category):
+    """類別對應的 metadata 布林欄位名稱"""
+    return f"{CATEGORY_KEY_PREFIX}{category}"
+
+
+def row_metadata(row, columns):
+    """
+    取出一列的結構化欄位
+
+    縣市與鄉鎮市區優先使用對應欄位，沒有時從地址解析；鄉鎮市區以「縣市+鄉鎮市區」表示。
+    category 為第一個類別 (顯示用)，每個類別另有 category_key(類別) 的布林欄位供過濾使用。
+
+    Args:
+        row: csv.DictReader 讀出的一列
+        columns: detect_columns 的結果
+
+    Returns:
+        dict: {"county", "district", "category", "category:類別"...} 中有值的欄位
+    """
+    county = district = None
+    if "address" in columns:
+        county, district = parse_address(row.get(columns["address"]))
+    if "county" in columns and row.get(columns["county"]):
+        county = normalize(row[columns["county"]])
+    if "district" in columns and row.get(columns["district"]):
+        district = normalize(row[columns["district"]])
+
+    metadata = {}
+    if county:
+        metadata["county"] = county
+        if district:
+            metadata["district"] = f"{county}{district}"
+    if "category" in columns:
+        categories = split_categories(row.get(columns["category"]))
+        if categories:
+            metadata["category"] = categories[0]
+            for category in categories:
+                metadata[category_key(category)] = True
+    return metadata
+
+
+def _place_aliases(name):
+    """產生地名的別名，例如「臺北市」→ 臺北市、臺北 (查詢比對前會先將「台」轉為「臺」)"""
+    aliases = {name}
+    if len(name) >= 3 and name[-1] in "縣市鄉鎮區":
+        aliases.add(name[:-1])
+    return aliases
+
+
+class AttractionCatalog:
+    """
+    從景點 CSV 整理出的地名與主題詞典
+
+    地名包含縣市與鄉鎮市區 (含省略「市/縣/區」的別名)，
+    主題包含內建的同義詞與 CSV 中的類別值，供本地查詢擴展使用。
+    """
+
+    def __init__(self, columns=None):
+        self.columns = columns or {}
+        # 別名 -> 正式地名列表 (例如「新竹」同時對應新竹市與新竹縣)
+        self.place_aliases = {}
+        # 詞彙 -> 同義詞組
+        self.topic_terms = {}
+        # 鄉鎮市區 -> 所屬縣市
+        self.district_counties = {}
+        self.categories = set()
+        self._pattern = None
+
+        for county in TAIWAN_COUNTIES:
+            self.add_place(county)
+        for alias, places in EXTRA_PLACE_ALIASES.items():
+            for place in places:
+                self.place_aliases.setdefault(alias, [])
+                if place not in self.place_aliases[alias]:
+                    self.place_aliases[alias].append(place)
+        for group in TOPIC_SYNONYMS:
+            for term in group:
+                self.topic_terms[term] = group
+
+    def add_place(self, place):
+        """加入地名及其別名"""
+        for alias in _place_aliases(place):
+            places = self.place_aliases.setdefault(alias, [])
+            if place not in places:
+                places.append(place)
+        self._pattern = None
+
+    def add_district(self, county, district):
+        """加入鄉鎮市區，以「縣市+鄉鎮市區」作為正式地名"""
+        place = f"{county}{district}"
+        self.district_counties[place] = county
+        # 「東區」這類只有兩個字的區名太容易誤判，只使用完整名稱
+        if len(district) >= 3:
+            for alias in _place_aliases(district):
+                places = self.place_aliases.setdefault(alias, [])
+                if place not in places:
+                    places.append(place)
+        self.add_place(place)
+
+    def add_category(self, category):
+        """加入 CSV 中的類別值，類別包含內建主題詞彙時併入該組同義詞"""
+        self.categories.add(category)
+        group = next((g for term, g in self.topic_terms.items() if term in category), None)
+        self.topic_terms.setdefault(category, (category,) + tuple(group or ()))
+        self._pattern = None
+
+    @classmethod
+    def from_csv(cls, path, encoding="utf-8"):
+        """
+        從景點 CSV 建立詞典
+
+        Args:
+            path: CSV 檔案路徑
+            encoding: 檔案編碼
+
+        Returns:
+            AttractionCatalog: 詞典
+        """
+        with open(path, newline="", encoding=encoding) as f:
+            reader = csv.DictReader(f)
+            catalog = cls(detect_columns(reader.fieldnames))
+            columns = catalog.columns
+            for row in reader:
+                metadata = row_metadata(row, columns)
+                if "county" in metadata:
+                    catalog.add_place(metadata["county"])
+                if "district" in metadata:
+                    county = metadata["county"]
+                    catalog.add_district(county, metadata["district"][len(county):])
+                if "category" in columns:
+                    for category in split_categories(row.get(columns["category"])):
+                        catalog.add_category(category)
+
+        logger.info(
+            f"景點詞典已建立: 欄位 {columns}，{len(catalog.place_aliases)} 個地名別名，"
+            f"{len(catalog.topic_terms)} 個主題詞彙"
+        )
+        return catalog
+
+    def _matcher(self):
+        """所有別名與主題詞彙的正規表示式，長的詞彙優先比對"""
+        if self._pattern is None:
+            terms = sorted(set(self.place_aliases) | set(self.topic_terms), key=len, reverse=True)
+            self._pattern = re.compile("|".join(re.escape(term) for term in terms))
+        return self._pattern
+
+    def match(self, query):
+        """
+        找出查詢中提到的地名與主題 (查詢需先以 normalize 處理)
+
+        Returns:
+            tuple: ([(查詢中的詞彙, [正式地名])], [同義詞組])
+        """
+        places = []
+        topics = []
+        for found in self._matcher().finditer(query):
+            term = found.group()
+            if term in self.place_aliases:
+                places.append((term, self.place_aliases[term]))
+            elif self.topic_terms[term] not in topics:
+                topics.append(self.topic_terms[term])
+        return places, topics
+
+    def parse_filters(self, query):
+        """
+        從查詢解析檢索前的過濾條件
+
+        提到鄉鎮市區時以鄉鎮市區過濾，只提到縣市時以縣市過濾；
+        提到的主題對應到 CSV 中的類別時以類別過濾。
+
+        Args:
+            query: 使用者查詢
+
+        Returns:
+            dict: {"county": [...], "district": [...], "category": [...]} 中有條件的欄位
+        """
+        places, topics = self.match(normalize(query))
+        names = list(dict.fromkeys(name for _, canonical in places for name in canonical))
+        districts = [name for name in names if name in self.district_counties]
+        # 已指定鄉鎮市區的縣市不再整個縣市納入
+        covered = {self.district_counties[name] for name in districts}
+        counties = [name for name in names if name not in self.district_counties and name not in covered]
+
+        topic_terms = {term for group in topics for term in group}
+        categories = sorted(
+            category for category in self.categories
+            if topic_terms & set(self.topic_terms.get(category, (category,)))
+        )
+
+        filters = {}
+        if counties:
+            filters["county"] = counties
+        if districts:
+            filters["district"] = districts
+        if categories:
+            filters["category"] = categories
+        return filters
@@ -0,0 +1,206 @@
+from langchain_core.documents import Document
+import re
+import threading
+import logging
+
+from .ingest import CHUNK_OVERLAP
+
+# 設置日誌
+logger = logging.getLogger(__name__)
+
+# 中文 (含日文假名) 字元大約各佔一個 token，英數詞彙大約每四個字元一個 token
+_CJK_CHAR = re.compile(r"[぀-ヿ㐀-䶿一-鿿豈-﫿]")
+_WORD = re.compile(r"[A-Za-z0-9]+")
+_OTHER = re.compile(r"[^\sA-Za-z0-9぀-ヿ㐀-䶿一-鿿豈-﫿]")
+
+
+def estimate_tokens(text):
+    """
+    估計文字的 token 數量
+
+    不呼叫 Gemini 的 count_tokens API，以字元類型估算：中文一字一個 token，
+    英數詞彙每四個字元一個 token，標點符號各一個 token。
+    """
+    if not text:
+        return 0
+    words = sum((len(word) + 3) // 4 for word in _WORD.findall(text))
+    return len(_CJK_CHAR.findall(text)) + words + len(_OTHER.findall(text))
+
+
+def _chunk_position(document):
+    """從 chunk_id (列識別-區塊序號) 取得 (列識別, 區塊序號)，沒有 chunk_id 時回傳 None"""
+    chunk_id = document.metadata.get("chunk_id")
+    if not chunk_id or "-" not in chunk_id:
+        return None
+    row_id, index = chunk_id.rsplit("-", 1)
+    return (row_id, int(index)) if index.isdigit() else None
+
+
+def _merge_overlap(previous, following, min_overlap=4):
+    """
+    接上同一列相鄰的兩個區塊，去除分割時重疊的文字
+
+    重疊不會超過分割設定的 CHUNK_OVERLAP，太短的重疊視為巧合。
+    """
+    for size in range(min(len(previous), len(following), CHUNK_OVERLAP), min_overlap - 1, -1):
+        if previous.endswith(following[:size]):
+            return previous + following[size:]
+    return previous + "\n" + following
+
+
+class ContextPacker:
+    """
+    "stuff" 問答鏈的內容組合
+
+    重新排序後的區塊依序經過：
+    1. 移除分數過低的尾端 (低於第一名分數的 min_score_ratio 倍)
+    2. 同一個景點 (同一列) 的區塊合併為一份文件，相鄰區塊去除重疊文字
+    3. 移除內容已包含在其他文件中的重複區塊
+    4. 依排名放入文件，直到 token 預算用完
+    並統計組合前後的 token 數量與每個請求的提示 token 數量。
+    """
+
+    def __init__(self, token_budget=1500, min_score_ratio=0.1, score_key="relevance_score"):
+        """
+        初始化
+
+        Args:
+            token_budget: 內容 (不含提示模板與問題) 的 token 上限
+            min_score_ratio: 保留的區塊分數至少為第一名的幾倍，0 表示不移除
+            score_key: 重新排序分數在 metadata 中的欄位
+        """
+        self.token_budget = token_budget
+        self.min_score_ratio = min_score_ratio
+        self.score_key = score_key
+
+        # 統計數據
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.input_chunks = 0
+        self.output_documents = 0
+        self.input_tokens = 0
+        self.context_tokens = 0
+        self.dropped_low_score = 0
+        self.merged = 0
+        self.deduplicated = 0
+        self.over_budget = 0
+        self.prompts = 0
+        self.prompt_tokens = 0
+
+    def _drop_low_scores(self, documents):
+        scores = [document.metadata.get(self.score_key) for document in documents]
+        if not documents or self.min_score_ratio <= 0 or scores[0] is None or scores[0] <= 0:
+            return documents
+        threshold = scores[0] * self.min_score_ratio
+        return [
+            document for document, score in zip(documents, scores)
+            if score is None or score >= threshold
+        ]
+
+    def _merge_rows(self, documents):
+        """同一列的區塊合併，合併後的文件排在該列最高排名區塊的位置"""
+        groups = {}
+        order = []
+        for document in documents:
+            position = _chunk_position(document)
+            key = position[0] if position else id(document)
+            if key not in groups:
+                groups[key] = []
+                order.append(key)
+            groups[key].append((position[1] if position else 0, document))
+
+        merged = []
+        for key in order:
+            chunks = sorted(groups[key], key=lambda item: item[0])
+            if len(chunks) == 1:
+                merged.append(chunks[0][1])
+                continue
+            text = chunks[0][1].page_content
+            for (previous_index, _), (index, document) in zip(chunks, chunks[1:]):
+                if index == previous_index + 1:
+                    text = _merge_overlap(text, document.page_content)
+                else:
+                    text += "\n" + document.page_content
+            # 以排名最高的區塊 metadata 為準
+            best = groups[key][0][1]
+            metadata = {**best.metadata, "merged_chunks": [document.metadata.get("chunk_id") for _, document in chunks]}
+            merged.append(Document(page_content=text, metadata=metadata))
+        return merged
+
+    @staticmethod
+    def _deduplicate(documents):
+        kept = []
+        for document in documents:
+            text = document.page_content.strip()
+            if any(text in other.page_content for other in kept):
+                continue
+            kept.append(document)
+        return kept
+
+    def pack(self, documents):
+        """
+        組合內容
+
+        Args:
+            documents: 依重新排序分數排列的區塊
+
+        Returns:
+            list: 放入提示的文件
+        """
+        documents = list(documents)
+        input_tokens = sum(estimate_tokens(document.page_content) for document in documents)
+
+        scored = self._drop_low_scores(documents)
+        merged = self._merge_rows(scored)
+        unique = self._deduplicate(merged)
+
+        packed = []
+        used = 0
+        for document in unique:
+            tokens = estimate_tokens(document.page_content)
+            if packed and used + tokens > self.token_budget:
+                continue
+            packed.append(document)
+            used += tokens
+
+        with self._lock:
+            self.requests += 1
+            self.input_chunks += len(documents)
+            self.output_documents += len(packed)
+            self.input_tokens += input_tokens
+            self.context_tokens += used
+            self.dropped_low_score += len(documents) - len(scored)
+            self.merged += len(scored) - len(merged)
+            self.deduplicated += len(merged) - len(unique)
+            self.over_budget += len(unique) - len(packed)
+        logger.info(
+            f"內容組合: {len(documents)} 個區塊 → {len(packed)} 份文件，"
+            f"約 {input_tokens} → {used} tokens"
+        )
+        return packed
+
+    def record_prompt(self, prompt_text):
+        """記錄送給 Gemini 的提示 token 數量，回傳估計值"""
+        tokens = estimate_tokens(prompt_text)
+        with self._lock:
+            self.prompts += 1
+            self.prompt_tokens += tokens
+        logger.info(f"提示約 {tokens} tokens")
+        return tokens
+
+    def stats(self):
+        """取得內容組合的統計數據"""
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "token_budget": self.token_budget,
+                "avg_input_chunks": self.input_chunks / self.requests if self.requests else 0.0,
+                "avg_output_documents": self.output_documents / self.requests if self.requests else 0.0,
+                "avg_input_tokens": self.input_tokens / self.requests if self.requests else 0.0,
+                "avg_context_tokens": self.context_tokens / self.requests if self.requests else 0.0,
+                "avg_prompt_tokens": self.prompt_tokens / self.prompts if self.prompts else 0.0,
+                "dropped_low_score": self.dropped_low_score,
+                "merged": self.merged,
+                "deduplicated": self.deduplicated,
+                "over_budget": self.over_budget,
+            }
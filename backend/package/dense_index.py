@@ -0,0 +1,248 @@
+from langchain_core.documents import Document
+from .attraction_catalog import METADATA_VERSION
+import json
+import os
+import shutil
+import time
+import logging
+import numpy as np
+
+# 設置日誌
+logger = logging.getLogger(__name__)
+
+# 向量索引存放目錄名稱，放在向量資料庫目錄中
+DENSE_INDEX_DIRNAME = "dense_index"
+
+# 向量檢索方式
+#   chroma: Chroma (HNSW)
+#   numpy: 將所有區塊向量放在一個 mmap 載入的矩陣中，以矩陣乘法做精確搜尋
+VECTOR_BACKENDS = ("chroma", "numpy")
+VECTOR_DTYPES = ("float32", "float16")
+
+# float16 矩陣分段轉為 float32 計算的列數，限制暫存記憶體
+FLOAT16_BLOCK_ROWS = 16384
+
+
+class DenseIndex:
+    """
+    以 numpy 矩陣存放的向量索引
+
+    所有區塊向量存放在一個連續的 (區塊數量, 維度) 矩陣中，區塊 ID、內容與 metadata 以平行陣列存放，
+    區塊位置與 SparseIndex / MetadataIndex 相同，過濾條件可以直接以區塊位置表示。
+    陣列以 mmap 載入；向量已正規化，內積即為餘弦相似度，以 argpartition 取前 k 名。
+    """
+
+    FILES = ("vectors", "chunk_ids", "contents", "metadatas")
+
+    def __init__(self, vectors, chunk_ids, contents, metadatas, meta):
+        self.vectors = vectors
+        self.chunk_ids = chunk_ids
+        self.contents = contents
+        self.metadatas = metadatas
+        self.meta = meta
+        self._positions = {str(chunk_id): i for i, chunk_id in enumerate(chunk_ids)}
+
+    def __len__(self):
+        return len(self.chunk_ids)
+
+    @classmethod
+    def build(cls, items, dtype="float32", meta=None):
+        """
+        從區塊建立索引
+
+        Args:
+            items: [(chunk_id, 內容, metadata, 向量)]，可以是產生器
+            dtype: 矩陣的資料型別 float32 或 float16 (記憶體減半，分數有微小誤差)
+            meta: 額外記錄在索引中的資訊 (例如來源檔案雜湊)
+
+        Returns:
+            DenseIndex: 存放在記憶體中的索引
+        """
+        if dtype not in VECTOR_DTYPES:
+            raise ValueError(f"不支援的向量資料型別: {dtype}")
+        chunk_ids, contents, metadatas, vectors = [], [], [], []
+        for chunk_id, content, metadata, vector in items:
+            chunk_ids.append(chunk_id)
+            contents.append(content or "")
+            metadatas.append(json.dumps(metadata or {}, ensure_ascii=False))
+            vectors.append(np.asarray(vector, dtype=np.float32))
+
+        matrix = np.vstack(vectors).astype(dtype) if vectors else np.empty((0, 0), dtype=dtype)
+        meta = dict(meta or {})
+        meta.update({"dtype": dtype, "documents": len(chunk_ids), "dim": int(matrix.shape[1])})
+
+        def strings(values):
+            return np.asarray(values, dtype=f"<U{max([len(v) for v in values] or [1])}")
+
+        return cls(
+            vectors=matrix,
+            chunk_ids=strings(chunk_ids),
+            contents=strings(contents),
+            metadatas=strings(metadatas),
+            meta=meta
+        )
+
+    def save(self, index_dir):
+        """寫入索引目錄 (先寫入暫存目錄再取代，避免中斷時留下不完整的索引)"""
+        tmp_dir = f"{index_dir}.tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        for name in self.FILES:
+            np.save(os.path.join(tmp_dir, f"{name}.npy"), getattr(self, name))
+        with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(self.meta, f, ensure_ascii=False)
+        shutil.rmtree(index_dir, ignore_errors=True)
+        os.replace(tmp_dir, index_dir)
+
+    @classmethod
+    def load(cls, index_dir, mmap=True):
+        """以 mmap 載入索引，目錄不存在或格式錯誤時回傳 None"""
+        try:
+            with open(os.path.join(index_dir, "meta.json"), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            arrays = {
+                name: np.load(os.path.join(index_dir, f"{name}.npy"), mmap_mode="r" if mmap else None)
+                for name in cls.FILES
+            }
+            return cls(meta=meta, **arrays)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.error(f"載入向量索引時出錯: {str(e)}")
+            return None
+
+    def _scores(self, queries, allowed=None):
+        """計算 (查詢數量, 候選區塊數量) 的相似度矩陣"""
+        matrix = self.vectors if allowed is None else self.vectors[allowed]
+        if matrix.dtype == np.float32:
+            return queries @ matrix.T
+        # numpy 的 float16 矩陣乘法沒有 BLAS 加速，分段轉為 float32 計算
+        return np.hstack([
+            queries @ matrix[start:start + FLOAT16_BLOCK_ROWS].astype(np.float32).T
+            for start in range(0, len(matrix), FLOAT16_BLOCK_ROWS)
+        ])
+
+    def search(self, vectors, k=10, allowed=None):
+        """
+        批次搜尋所有查詢向量
+
+        Args:
+            vectors: 查詢向量 (已正規化)
+            k: 每個查詢回傳的區塊數量
+            allowed: 限制搜尋範圍的區塊位置 (排序後的陣列)，None 表示不限制
+
+        Returns:
+            list: 每個查詢的 (區塊位置陣列, 分數陣列)，依分數由高到低排列
+        """
+        queries = np.asarray(vectors, dtype=np.float32)
+        if queries.ndim == 1:
+            queries = queries[None, :]
+        if len(self) == 0 or (allowed is not None and len(allowed) == 0):
+            empty = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32))
+            return [empty for _ in range(len(queries))]
+
+        scores = self._scores(queries, allowed)
+        k = min(k, scores.shape[1])
+        if k < scores.shape[1]:
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        else:
+            top = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind="stable")
+        top = np.take_along_axis(top, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+        if allowed is not None:
+            top = np.asarray(allowed)[top]
+        return list(zip(top, top_scores))
+
+    def document(self, position):
+        """取得區塊位置的文件"""
+        return Document(
+            page_content=str(self.contents[position]),
+            metadata=json.loads(str(self.metadatas[position]))
+        )
+
+    def fetch_documents(self, chunk_ids):
+        """依區塊 ID 取得文件，回傳順序與 ID 順序相同 (與 chroma_document_fetcher 相同的介面)"""
+        return [
+            self.document(self._positions[chunk_id])
+            for chunk_id in chunk_ids if chunk_id in self._positions
+        ]
+
+
+def _iter_embeddings(vector_store, chunk_ids=None, batch_size=5000):
+    """
+    讀取向量資料庫中區塊的 ID、內容、metadata 與向量
+
+    有指定 chunk_ids 時依其順序讀取 (與稀疏索引的區塊位置一致)，否則依資料庫順序讀取全部區塊。
+    """
+    include = ["documents", "metadatas", "embeddings"]
+    if chunk_ids is None:
+        offset = 0
+        while True:
+            result = vector_store.get(include=include, limit=batch_size, offset=offset)
+            if not result["ids"]:
+                return
+            yield from zip(result["ids"], result["documents"], result["metadatas"], result["embeddings"])
+            offset += len(result["ids"])
+        return
+
+    for start in range(0, len(chunk_ids), batch_size):
+        batch = [str(chunk_id) for chunk_id in chunk_ids[start:start + batch_size]]
+        result = vector_store.get(ids=batch, include=include)
+        by_id = {
+            chunk_id: (content, metadata, vector)
+            for chunk_id, content, metadata, vector in zip(
+                result["ids"], result["documents"], result["metadatas"], result["embeddings"]
+            )
+        }
+        for chunk_id in batch:
+            yield (chunk_id, *by_id[chunk_id])
+
+
+def load_fresh_dense_index(index_dir, source_sha256, embedding_fingerprint, dtype="float32", chunk_ids=None):
+    """載入與資料檔、嵌入模型、稀疏索引相符的向量索引 (不開啟向量資料庫)，不存在或不符時回傳 None"""
+    index = DenseIndex.load(index_dir)
+    if (index is not None
+            and index.meta.get("source_sha256") == source_sha256
+            and index.meta.get("embedding_fingerprint") == embedding_fingerprint
+            and index.meta.get("dtype") == dtype
+            and index.meta.get("metadata_version") == METADATA_VERSION
+            and (chunk_ids is None or np.array_equal(index.chunk_ids, chunk_ids))):
+        return index
+    return None
+
+
+def ensure_dense_index(vector_store, index_dir, source_sha256, embedding_fingerprint, dtype="float32",
+                       chunk_ids=None):
+    """
+    載入向量索引，不存在或與資料檔、嵌入模型、稀疏索引不符時從向量資料庫重新匯出
+
+    Args:
+        vector_store: Chroma 向量資料庫 (寫入流程仍以 Chroma 為準，這裡只匯出向量)
+        index_dir: 索引目錄
+        source_sha256: 資料檔雜湊
+        embedding_fingerprint: 嵌入模型的指紋
+        dtype: 矩陣的資料型別
+        chunk_ids: 稀疏索引的區塊 ID，提供時區塊位置與稀疏索引一致
+
+    Returns:
+        DenseIndex: 以 mmap 載入的索引
+    """
+    index = load_fresh_dense_index(index_dir, source_sha256, embedding_fingerprint, dtype, chunk_ids)
+    if index is not None:
+        return index
+
+    started = time.perf_counter()
+    index = DenseIndex.build(
+        _iter_embeddings(vector_store, chunk_ids),
+        dtype=dtype,
+        meta={"source_sha256": source_sha256, "embedding_fingerprint": embedding_fingerprint,
+              "metadata_version": METADATA_VERSION}
+    )
+    index.save(index_dir)
+    logger.info(
+        f"向量索引已建立: {index.meta['documents']} 個區塊 ({dtype})，"
+        f"耗時 {time.perf_counter() - started:.2f} 秒"
+    )
+    return DenseIndex.load(index_dir)
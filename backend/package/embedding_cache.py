@@ -0,0 +1,327 @@
+from langchain_core.embeddings import Embeddings
+from langchain_core.runnables.config import run_in_executor
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import os
+import re
+import threading
+import time
+import unicodedata
+import logging
+import numpy as np
+
+from .ttl_cache import TTLCache
+
+# 設置日誌
+logger = logging.getLogger(__name__)
+
+# 共用快取檔案的格式版本，格式改變時重建檔案
+SHARED_CACHE_MAGIC = b"QVEC0001"
+SHARED_CACHE_HEADER_SIZE = 64
+
+# 共用快取每個鍵可存放的位置數量 (組相聯)，同一組已滿時取代最舊的項目
+SHARED_CACHE_WAYS = 4
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_query_text(text):
+    """
+    查詢嵌入前的正規化
+
+    全形轉半形 (NFKC) 並合併空白，只做不改變語意的處理，
+    快取中的向量即為正規化後文字的向量，與不使用快取時完全相同。
+    """
+    return _WHITESPACE.sub(" ", unicodedata.normalize("NFKC", text)).strip()
+
+
+def _key_hash(key):
+    """64 位元的鍵雜湊，0 保留給空位置"""
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little") | 1
+
+
+class SharedVectorCache:
+    """
+    以 mmap 檔案存放、可由多個 worker 行程共用的查詢向量快取
+
+    檔案為固定數量的位置 (組相聯)，每個位置存放鍵雜湊、寫入時間與向量。
+    寫入時以檔案鎖互斥，並先清除檢查碼、寫入向量後再寫回檢查碼；
+    讀取不需加鎖，複製向量前後檢查碼都符合才視為命中，寫入中的項目會被當作未命中。
+    """
+
+    def __init__(self, path, fingerprint, max_entries=4096, ttl_seconds=None):
+        """
+        初始化共用快取 (檔案在第一次寫入或讀取時才開啟)
+
+        Args:
+            path: 快取檔案路徑
+            fingerprint: 嵌入模型與前綴的指紋，與檔案中記錄的不同時重建檔案
+            max_entries: 位置數量
+            ttl_seconds: 項目存活秒數，None 表示不會過期
+        """
+        self.path = path
+        self.fingerprint = hashlib.sha1(fingerprint.encode("utf-8")).digest()[:16]
+        self.sets = max(1, max_entries // SHARED_CACHE_WAYS)
+        self.max_entries = self.sets * SHARED_CACHE_WAYS
+        self.ttl_seconds = ttl_seconds
+
+        self._records = None
+        self._local = threading.Lock()
+
+        # 統計數據 (只計算本行程)
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+
+    def _dtype(self, dim):
+        return np.dtype([
+            ("check", "<u8"),
+            ("key", "<u8"),
+            ("stored_at", "<f8"),
+            ("vector", "<f4", (dim,)),
+        ])
+
+    def _header(self, dim):
+        header = SHARED_CACHE_MAGIC + self.fingerprint + np.asarray([dim, self.max_entries], dtype="<u4").tobytes()
+        return header.ljust(SHARED_CACHE_HEADER_SIZE, b"\0")
+
+    def _read_dim(self):
+        """讀取檔案標頭，檔案不存在或與目前設定不符時回傳 None"""
+        try:
+            with open(self.path, "rb") as f:
+                header = f.read(SHARED_CACHE_HEADER_SIZE)
+        except FileNotFoundError:
+            return None
+        if len(header) < SHARED_CACHE_HEADER_SIZE or not header.startswith(SHARED_CACHE_MAGIC):
+            return None
+        dim, entries = np.frombuffer(header, dtype="<u4", count=2, offset=len(SHARED_CACHE_MAGIC) + 16)
+        if header != self._header(int(dim)) or int(entries) != self.max_entries:
+            return None
+        size = SHARED_CACHE_HEADER_SIZE + self._dtype(int(dim)).itemsize * self.max_entries
+        if os.path.getsize(self.path) != size:
+            return None
+        return int(dim)
+
+    def _open(self, dim=None):
+        """開啟 (必要時建立) 快取檔案，dim 為 None 時只開啟已存在的檔案"""
+        with self._local:
+            if self._records is not None:
+                return self._records
+            existing = self._read_dim()
+            if existing is None or (dim is not None and existing != dim):
+                if dim is None:
+                    return None
+                with self._file_lock():
+                    # 取得鎖之後再確認一次，其他 worker 可能已經建立
+                    existing = self._read_dim()
+                    if existing is None or existing != dim:
+                        self._create(dim)
+                        existing = dim
+            self._records = np.memmap(
+                self.path, dtype=self._dtype(existing), mode="r+",
+                offset=SHARED_CACHE_HEADER_SIZE, shape=(self.max_entries,)
+            )
+            return self._records
+
+    def _create(self, dim):
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(tmp_path, "wb") as f:
+            f.write(self._header(dim))
+            f.truncate(SHARED_CACHE_HEADER_SIZE + self._dtype(dim).itemsize * self.max_entries)
+        os.replace(tmp_path, self.path)
+        logger.info(f"已建立共用查詢向量快取: {self.path} ({self.max_entries} 個位置)")
+
+    @contextmanager
+    def _file_lock(self):
+        """跨行程的寫入鎖"""
+        with open(f"{self.path}.lock", "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _slots(self, key_hash):
+        start = (key_hash % self.sets) * SHARED_CACHE_WAYS
+        return range(start, start + SHARED_CACHE_WAYS)
+
+    def get(self, key):
+        """讀取向量，未命中、過期或寫入中時回傳 None"""
+        records = self._records if self._records is not None else self._open()
+        if records is None:
+            self.misses += 1
+            return None
+        key_hash = _key_hash(key)
+        now = time.time()
+        for slot in self._slots(key_hash):
+            record = records[slot]
+            if record["check"] != key_hash or record["key"] != key_hash:
+                continue
+            if self.ttl_seconds is not None and now - record["stored_at"] > self.ttl_seconds:
+                break
+            vector = np.array(record["vector"], dtype=np.float32)
+            if record["check"] == key_hash and record["key"] == key_hash:
+                self.hits += 1
+                return vector
+        self.misses += 1
+        return None
+
+    def set(self, key, vector):
+        """寫入向量，同一組已滿時取代最舊的項目"""
+        vector = np.asarray(vector, dtype=np.float32)
+        records = self._open(len(vector))
+        if records is None or records.dtype["vector"].shape != vector.shape:
+            return
+        key_hash = _key_hash(key)
+        with self._file_lock():
+            slots = list(self._slots(key_hash))
+            slot = next((s for s in slots if records[s]["key"] == key_hash), None)
+            if slot is None:
+                slot = min(slots, key=lambda s: records[s]["stored_at"])
+            record = records[slot]
+            record["check"] = 0
+            record["key"] = key_hash
+            record["vector"] = vector
+            record["stored_at"] = time.time()
+            record["check"] = key_hash
+        self.writes += 1
+
+    def stats(self):
+        """取得快取統計數據"""
+        total = self.hits + self.misses
+        return {
+            "path": self.path,
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "writes": self.writes,
+        }
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    為嵌入模型加上輸入前綴與查詢向量快取
+
+    查詢加上查詢前綴、段落加上段落前綴 (e5 模型)，所有呼叫路徑都經過這裡，
+    向量資料庫、檢索與語意快取使用的向量因此一致。
+    查詢向量先查行程內的 LRU，再查跨 worker 的共用快取，都未命中時才批次嵌入。
+    段落 (寫入向量資料庫的區塊) 不會被快取。
+    """
+
+    def __init__(self, embeddings, query_prefix="", passage_prefix="", max_entries=4096, ttl_seconds=None,
+                 shared_path=None, fingerprint=""):
+        """
+        初始化
+
+        Args:
+            embeddings: 底層的嵌入模型
+            query_prefix: 查詢前綴
+            passage_prefix: 段落前綴
+            max_entries: 行程內快取的項目上限，0 表示不快取
+            ttl_seconds: 快取項目的存活秒數，None 表示不會過期
+            shared_path: 共用快取檔案路徑，None 表示只使用行程內快取
+            fingerprint: 嵌入模型的指紋，用來確認共用快取檔案可以沿用
+        """
+        self.embeddings = embeddings
+        self.query_prefix = query_prefix
+        self.passage_prefix = passage_prefix
+        self.cache = TTLCache(max_entries=max_entries, ttl_seconds=ttl_seconds) if max_entries else None
+        self.shared_cache = None
+        if shared_path and max_entries:
+            self.shared_cache = SharedVectorCache(
+                shared_path,
+                fingerprint=f"{fingerprint}|{query_prefix}",
+                max_entries=max_entries,
+                ttl_seconds=ttl_seconds
+            )
+
+        # 統計數據
+        self._lock = threading.Lock()
+        self.embedded = 0
+        self.embed_seconds = 0.0
+
+    def query_key(self, text):
+        """查詢實際送入模型的文字，也是快取鍵"""
+        return self.query_prefix + normalize_query_text(text)
+
+    def _lookup(self, key):
+        if self.cache is None:
+            return None
+        vector = self.cache.get(key)
+        if vector is None and self.shared_cache is not None:
+            vector = self.shared_cache.get(key)
+            if vector is not None:
+                self.cache.set(key, vector)
+        return vector
+
+    def _embed_keys(self, keys, vectors=None):
+        """
+        嵌入多個查詢，只計算未命中快取的部分 (重複的查詢只計算一次)
+
+        Args:
+            keys: 查詢鍵
+            vectors: 已查過快取的結果，None 時在此查詢
+
+        Returns:
+            list: float32 numpy 向量，順序與 keys 相同
+        """
+        if vectors is None:
+            vectors = [self._lookup(key) for key in keys]
+        missing = list(dict.fromkeys(key for key, vector in zip(keys, vectors) if vector is None))
+        if missing:
+            started = time.perf_counter()
+            computed = {
+                key: np.asarray(vector, dtype=np.float32)
+                for key, vector in zip(missing, self.embeddings.embed_documents(missing))
+            }
+            with self._lock:
+                self.embedded += len(missing)
+                self.embed_seconds += time.perf_counter() - started
+            for key, vector in computed.items():
+                # 快取中的向量由多個請求共用，不可修改
+                vector.setflags(write=False)
+                if self.cache is not None:
+                    self.cache.set(key, vector)
+                if self.shared_cache is not None:
+                    self.shared_cache.set(key, vector)
+            vectors = [computed[key] if vector is None else vector for key, vector in zip(keys, vectors)]
+        return vectors
+
+    def embed_queries(self, texts):
+        """
+        批次嵌入多個查詢 (例如多查詢檢索的子查詢)
+
+        Returns:
+            list: float32 numpy 向量
+        """
+        return self._embed_keys([self.query_key(text) for text in texts])
+
+    def embed_query(self, text):
+        return self.embed_queries([text])[0].tolist()
+
+    async def aembed_query(self, text):
+        # 命中快取時直接回傳，不需切換到執行緒
+        key = self.query_key(text)
+        vector = self._lookup(key)
+        if vector is None:
+            vector = (await run_in_executor(None, self._embed_keys, [key], [None]))[0]
+        return vector.tolist()
+
+    def embed_documents(self, texts):
+        return self.embeddings.embed_documents([self.passage_prefix + text for text in texts])
+
+    def stats(self):
+        """取得快取統計數據"""
+        with self._lock:
+            stats = {
+                "embedded": self.embedded,
+                "avg_embed_ms": self.embed_seconds / self.embedded * 1000 if self.embedded else 0.0,
+            }
+        if self.cache is not None:
+            stats["local"] = self.cache.stats()
+        if self.shared_cache is not None:
+            stats["shared"] = self.shared_cache.stats()
+        return stats
@@ -0,0 +1,167 @@
+from langchain_core.embeddings import Embeddings
+import os
+import threading
+import logging
+import numpy as np
+
+# 設置日誌
+logger = logging.getLogger(__name__)
+
+# 嵌入模型的執行方式
+#   torch: sentence-transformers (PyTorch)，有 GPU 時自動使用
+#   onnx: ONNX Runtime，不需載入 PyTorch，向量與 torch 相同 (浮點誤差內)
+#   onnx_int8: ONNX Runtime 動態 int8 量化，較快且較省記憶體，向量為近似值
+EMBEDDING_BACKENDS = ("torch", "onnx", "onnx_int8")
+
+# e5 模型以前綴區分查詢與段落，訓練時即如此使用，省略會降低檢索品質
+E5_QUERY_PREFIX = "query: "
+E5_PASSAGE_PREFIX = "passage: "
+
+
+def text_prefixes(model_name):
+    """
+    取得模型需要的輸入前綴
+
+    Returns:
+        tuple: (查詢前綴, 段落前綴)，非 e5 模型皆為空字串
+    """
+    if "e5" in model_name.lower().rsplit("/", 1)[-1].split("-"):
+        return E5_QUERY_PREFIX, E5_PASSAGE_PREFIX
+    return "", ""
+
+
+def detect_device():
+    """有 GPU 時使用 cuda，只有 torch 執行方式需要"""
+    import torch
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+class OnnxEmbeddings(Embeddings):
+    """
+    以 ONNX Runtime 執行的句子嵌入模型
+
+    使用 tokenizers 分詞、ONNX Runtime 推論，再以 attention mask 做平均池化與 L2 正規化，
+    與 sentence-transformers 的 e5 模型設定相同，不需要 PyTorch。
+    """
+
+    def __init__(self, model_name, quantize=False, cache_dir=None, batch_size=32, max_length=512,
+                 num_threads=None):
+        """
+        初始化模型
+
+        Args:
+            model_name: Hugging Face 模型名稱 (需提供 onnx/model.onnx 與 tokenizer.json)
+            quantize: 是否使用動態 int8 量化的模型 (第一次使用時產生並存放在 cache_dir)
+            cache_dir: 量化模型的存放目錄，None 時放在 Hugging Face 快取目錄旁
+            batch_size: 每批推論的文字數量
+            max_length: 輸入的最大 token 數量
+            num_threads: ONNX Runtime 使用的執行緒數量，None 表示由 ONNX Runtime 決定
+        """
+        import onnxruntime
+        from huggingface_hub import hf_hub_download
+        from tokenizers import Tokenizer
+
+        self.model_name = model_name
+        self.batch_size = batch_size
+
+        model_path = hf_hub_download(model_name, "onnx/model.onnx")
+        if quantize:
+            model_path = self._quantized_model(model_path, cache_dir)
+
+        self.tokenizer = Tokenizer.from_file(hf_hub_download(model_name, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length)
+        self.tokenizer.enable_padding()
+
+        options = onnxruntime.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(
+            model_path, options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+        # 分詞器的 padding 設定不是執行緒安全的
+        self._lock = threading.Lock()
+        logger.info(f"已載入 ONNX 嵌入模型: {model_path}")
+
+    @staticmethod
+    def _quantized_model(model_path, cache_dir):
+        """產生 (或使用已存在的) 動態 int8 量化模型"""
+        cache_dir = cache_dir or os.path.dirname(model_path)
+        quantized_path = os.path.join(cache_dir, "model_int8.onnx")
+        if not os.path.exists(quantized_path):
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = f"{quantized_path}.tmp"
+            quantize_dynamic(model_path, tmp_path, weight_type=QuantType.QInt8)
+            os.replace(tmp_path, quantized_path)
+            logger.info(f"已產生 int8 量化模型: {quantized_path}")
+        return quantized_path
+
+    def encode(self, texts):
+        """
+        將文字轉為已正規化的向量
+
+        Returns:
+            numpy.ndarray: (文字數量, 維度) 的 float32 陣列
+        """
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            with self._lock:
+                encodings = self.tokenizer.encode_batch(texts[start:start + self.batch_size])
+            input_ids = np.asarray([e.ids for e in encodings], dtype=np.int64)
+            attention_mask = np.asarray([e.attention_mask for e in encodings], dtype=np.int64)
+            inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+            if "token_type_ids" in self.input_names:
+                inputs["token_type_ids"] = np.asarray([e.type_ids for e in encodings], dtype=np.int64)
+
+            hidden = self.session.run(None, inputs)[0]
+            # 平均池化，只計算非 padding 的 token
+            mask = attention_mask[:, :, None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            vectors.append(pooled.astype(np.float32))
+        if not vectors:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.concatenate(vectors)
+
+    def embed_documents(self, texts):
+        # 與 HuggingFaceEmbeddings 相同，以空白取代換行
+        return self.encode([text.replace("\n", " ") for text in texts]).tolist()
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+def create_embeddings(model_name, backend="torch", device=None, **kwargs):
+    """
+    依執行方式建立嵌入模型
+
+    Args:
+        model_name: Hugging Face 模型名稱
+        backend: torch、onnx 或 onnx_int8
+        device: torch 執行方式使用的裝置，None 時自動偵測
+        **kwargs: 傳給 OnnxEmbeddings 的其他參數
+
+    Returns:
+        Embeddings: langchain 的嵌入模型
+    """
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(f"不支援的嵌入模型執行方式: {backend}")
+
+    if backend == "torch":
+        from langchain_huggingface import HuggingFaceEmbeddings
+
+        device = device or detect_device()
+        logger.info(f"使用設備: {device}")
+        return HuggingFaceEmbeddings(
+            model_name=model_name,
+            model_kwargs={
+                'device': device
+            },
+            encode_kwargs={
+                'normalize_embeddings': True
+            }
+        )
+
+    return OnnxEmbeddings(model_name, quantize=backend == "onnx_int8", **kwargs)
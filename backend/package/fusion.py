@@ -0,0 +1,94 @@
+import numpy as np
+
+# 合併方式
+#   rrf: 加權 Reciprocal Rank Fusion，只看名次
+#   blend: 各結果列表的分數先以 min-max 正規化到 [0, 1] 再加權相加
+FUSION_MODES = ("rrf", "blend")
+
+
+class HybridFusion:
+    """
+    向量與 BM25 檢索結果的合併器
+
+    直接以區塊 ID 與分數陣列計算，所有子查詢的結果一次以 np.unique + bincount 累加，
+    不需要先建立 Document，只回傳合併後的前 top_n 個區塊 ID。
+    兩種檢索各取多少區塊 (dense_depth / sparse_depth) 也在這裡設定，方便依延遲調整檢索深度。
+    """
+
+    def __init__(self, mode="rrf", weights=(0.8, 0.2), rrf_k=60, dense_depth=10, sparse_depth=10, top_n=50):
+        """
+        初始化合併器
+
+        Args:
+            mode: 合併方式 rrf 或 blend
+            weights: 向量與 BM25 結果的權重
+            rrf_k: RRF 的平滑常數，越大名次差異的影響越小
+            dense_depth: 每個子查詢的向量檢索區塊數量
+            sparse_depth: 每個子查詢的 BM25 檢索區塊數量，0 表示不使用 BM25
+            top_n: 合併後保留的候選區塊數量 (送入重新排序)
+        """
+        if mode not in FUSION_MODES:
+            raise ValueError(f"不支援的合併方式: {mode}")
+        self.mode = mode
+        self.weights = tuple(weights)
+        self.rrf_k = rrf_k
+        self.dense_depth = dense_depth
+        self.sparse_depth = sparse_depth
+        self.top_n = top_n
+
+    def _contributions(self, scores, weight):
+        """單一結果列表中各區塊的加權分數"""
+        if self.mode == "rrf":
+            return weight / (np.arange(1, len(scores) + 1, dtype=np.float64) + self.rrf_k)
+        scores = np.asarray(scores, dtype=np.float64)
+        low, high = scores.min(), scores.max()
+        if high - low <= 0:
+            return np.full(len(scores), weight, dtype=np.float64)
+        return weight * (scores - low) / (high - low)
+
+    def fuse(self, dense_rankings, sparse_rankings, top_n=None):
+        """
+        合併所有子查詢的結果並依區塊 ID 去重
+
+        Args:
+            dense_rankings: 每個子查詢的向量檢索結果 [(區塊 ID, 分數)]，依分數由高到低排列
+            sparse_rankings: 每個子查詢的 BM25 檢索結果，格式相同
+            top_n: 回傳的區塊數量，None 時使用初始化的設定
+
+        Returns:
+            tuple: (區塊 ID 陣列, 合併分數陣列)，依合併分數由高到低排列，同分時先出現的排前面
+        """
+        ids, contributions = [], []
+        for rankings, weight in ((dense_rankings, self.weights[0]), (sparse_rankings, self.weights[1])):
+            for chunk_ids, scores in rankings:
+                if len(chunk_ids) == 0:
+                    continue
+                ids.append(np.asarray(chunk_ids).astype(str))
+                contributions.append(self._contributions(scores, weight))
+        if not ids:
+            return np.empty(0, dtype=str), np.empty(0, dtype=np.float64)
+
+        ids = np.concatenate(ids)
+        unique, first_seen, inverse = np.unique(ids, return_index=True, return_inverse=True)
+        totals = np.bincount(inverse, weights=np.concatenate(contributions))
+
+        top_n = self.top_n if top_n is None else top_n
+        if len(totals) > top_n:
+            # 先取出可能進入前 top_n 的區塊 (含同分)，再完整排序
+            threshold = np.partition(totals, len(totals) - top_n)[len(totals) - top_n]
+            candidates = np.flatnonzero(totals >= threshold)
+        else:
+            candidates = np.arange(len(totals))
+        order = candidates[np.lexsort((first_seen[candidates], -totals[candidates]))][:top_n]
+        return unique[order], totals[order]
+
+    def config(self):
+        """目前的設定 (用於統計數據)"""
+        return {
+            "mode": self.mode,
+            "weights": list(self.weights),
+            "rrf_k": self.rrf_k,
+            "dense_depth": self.dense_depth,
+            "sparse_depth": self.sparse_depth,
+            "top_n": self.top_n,
+        }
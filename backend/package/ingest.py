@@ -0,0 +1,504 @@
+"""
+向量資料庫寫入流程
+
+服務啟動時由 TravelRAGService 呼叫 ingest() 增量更新；也可離線執行，預先建立索引後再掛載到服務容器：
+
+    python -m package.ingest --batch-size 64 --threads 4
+"""
+from contextlib import contextmanager
+import argparse
+import csv
+import fcntl
+import hashlib
+import itertools
+import json
+import os
+import time
+import logging
+
+from .attraction_catalog import METADATA_VERSION, STRUCTURED_FIELDS, detect_columns, row_metadata
+from .embeddings import text_prefixes
+
+# 設置日誌
+logger = logging.getLogger(__name__)
+
+# 嵌入模型名稱
+EMBEDDING_MODEL_NAME = "intfloat/multilingual-e5-small"
+
+# 文件分割設定
+CHUNK_SIZE = 300
+CHUNK_OVERLAP = 50
+SPLIT_SEPARATORS = ["\n\n", "\n", "。", "，", " ", ""]
+
+# 清單檔名稱，存放在向量資料庫目錄中
+MANIFEST_FILENAME = "ingest_manifest.json"
+
+# 寫入鎖檔名稱，存放在向量資料庫目錄中
+BUILD_LOCK_FILENAME = ".build.lock"
+
+# 每批寫入向量資料庫的區塊數量 (Chroma 單次寫入有數量上限)，也是中斷後可繼續的單位
+DEFAULT_WRITE_BATCH_SIZE = 1000
+
+# 每次分割的 CSV 列數
+ROWS_PER_SPLIT = 256
+
+
+def metadata_fingerprint():
+    """寫入 metadata 的結構化欄位，改變時需要更新所有區塊的 metadata (不需重新嵌入)"""
+    return f"{'|'.join(STRUCTURED_FIELDS)}|v{METADATA_VERSION}"
+
+
+def embedding_fingerprint():
+    """嵌入模型、段落前綴與分割設定的指紋，改變時需要重建整個向量資料庫"""
+    _, passage_prefix = text_prefixes(EMBEDDING_MODEL_NAME)
+    return (f"{EMBEDDING_MODEL_NAME}|passage_prefix={passage_prefix!r}"
+            f"|chunk_size={CHUNK_SIZE}|chunk_overlap={CHUNK_OVERLAP}")
+
+
+def file_sha256(path):
+    """計算檔案內容的 SHA-256"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _sha1(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def _metadata_hash(metadata):
+    return _sha1(json.dumps(metadata, ensure_ascii=False, sort_keys=True, default=str))
+
+
+def stream_csv_documents(path, encoding="utf-8"):
+    """
+    逐列讀取 CSV 並產生文件，內容格式與 CSVLoader 相同 (每個欄位一行「欄位: 值」)
+
+    metadata 除了 source 與 row 之外，另外加入縣市、鄉鎮市區與類別等結構化欄位，供檢索前過濾使用。
+
+    Args:
+        path: CSV 檔案路徑
+        encoding: 檔案編碼
+
+    Yields:
+        Document: 每列一個文件
+    """
+    from langchain_core.documents import Document
+
+    with open(path, newline="", encoding=encoding) as f:
+        reader = csv.DictReader(f)
+        columns = detect_columns(reader.fieldnames)
+        for i, row in enumerate(reader):
+            content = "\n".join(
+                f"{k.strip() if k is not None else k}: "
+                f"{v.strip() if isinstance(v, str) else ','.join(map(str.strip, v)) if isinstance(v, list) else v}"
+                for k, v in row.items()
+            )
+            metadata = {"source": str(path), "row": i}
+            metadata.update(row_metadata(row, columns))
+            yield Document(page_content=content, metadata=metadata)
+
+
+class IngestionManifest:
+    """
+    向量資料庫的寫入清單
+
+    記錄每個區塊的 ID 與內容雜湊、來源檔案雜湊以及嵌入設定，
+    用來判斷哪些區塊需要重新嵌入、更新或刪除。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.source_sha256 = None
+        self.embedding_fingerprint = None
+        self.metadata_fingerprint = None
+        # chunk_id -> {"content": 內容雜湊, "metadata": metadata 雜湊}
+        self.chunks = {}
+        self.exists = False
+
+    @classmethod
+    def load(cls, path):
+        """載入清單檔，不存在或格式錯誤時回傳空的清單"""
+        manifest = cls(path)
+        if not os.path.exists(path):
+            return manifest
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            manifest.source_sha256 = data.get("source_sha256")
+            manifest.embedding_fingerprint = data.get("embedding_fingerprint")
+            manifest.metadata_fingerprint = data.get("metadata_fingerprint")
+            manifest.chunks = data.get("chunks", {})
+            manifest.exists = True
+        except Exception as e:
+            logger.error(f"載入寫入清單時出錯，將重新建立: {str(e)}")
+        return manifest
+
+    def save(self):
+        """寫入清單檔 (先寫入暫存檔再取代，避免中斷時留下不完整的檔案)"""
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "source_sha256": self.source_sha256,
+                    "embedding_fingerprint": self.embedding_fingerprint,
+                    "metadata_fingerprint": self.metadata_fingerprint,
+                    "chunks": self.chunks,
+                },
+                f,
+                ensure_ascii=False
+            )
+        os.replace(tmp_path, self.path)
+        self.exists = True
+
+
+def build_chunks(documents, split_documents, seen_keys=None):
+    """
+    將文件分割為區塊，並為每個區塊產生穩定的 ID
+
+    CSV 每一列以第一個欄位 (通常為景點ID或名稱) 作為識別，列的順序改變不影響 ID；
+    同一列分割出的區塊依序編號。
+
+    Args:
+        documents: 原始文件列表 (每列一個文件)
+        split_documents: 分割函式，接收文件列表並回傳區塊列表
+        seen_keys: 已出現過的列識別與次數，分批呼叫時需共用
+
+    Returns:
+        list: [(chunk_id, 區塊文件)]
+    """
+    if seen_keys is None:
+        seen_keys = {}
+
+    row_ids = []
+    for doc_index, document in enumerate(documents):
+        row_key = document.page_content.split("\n", 1)[0].strip()
+        # 第一個欄位重複時加上出現次數區分
+        occurrence = seen_keys.get(row_key, 0)
+        seen_keys[row_key] = occurrence + 1
+        row_ids.append(_sha1(f"{row_key}\x00{occurrence}")[:16])
+        # 暫時記錄來源文件的位置，分割後用來對應區塊
+        document.metadata["_doc_index"] = doc_index
+
+    chunks = []
+    chunk_counts = {}
+    for chunk in split_documents(documents):
+        doc_index = chunk.metadata.pop("_doc_index")
+        index = chunk_counts.get(doc_index, 0)
+        chunk_counts[doc_index] = index + 1
+        chunk_id = f"{row_ids[doc_index]}-{index}"
+        chunk.metadata["chunk_id"] = chunk_id
+        chunks.append((chunk_id, chunk))
+
+    for document in documents:
+        document.metadata.pop("_doc_index", None)
+    return chunks
+
+
+def iter_chunks(documents, split_documents, rows_per_split=ROWS_PER_SPLIT):
+    """
+    分批分割文件並產生區塊，文件可以是逐列讀取的產生器
+
+    Yields:
+        tuple: (chunk_id, 區塊文件)
+    """
+    documents = iter(documents)
+    seen_keys = {}
+    while True:
+        rows = list(itertools.islice(documents, rows_per_split))
+        if not rows:
+            return
+        yield from build_chunks(rows, split_documents, seen_keys)
+
+
+def _batches(items, batch_size):
+    for start in range(0, len(items), batch_size):
+        yield items[start:start + batch_size]
+
+
+def _write_batch(vector_store, batch, embed_texts):
+    """寫入一批區塊，有提供 embed_texts 時以預先計算的向量直接寫入底層 collection"""
+    ids = [chunk_id for chunk_id, _ in batch]
+    chunks = [chunk for _, chunk in batch]
+    if embed_texts is None:
+        # Chroma 以 upsert 寫入，相同 ID 的舊區塊會被取代
+        vector_store.add_documents(chunks, ids=ids)
+        return
+    embeddings = embed_texts([chunk.page_content for chunk in chunks])
+    vector_store._collection.upsert(
+        ids=ids,
+        embeddings=[list(map(float, vector)) for vector in embeddings],
+        documents=[chunk.page_content for chunk in chunks],
+        metadatas=[chunk.metadata for chunk in chunks]
+    )
+
+
+def sync_vector_store(vector_store, chunks, manifest, batch_size=DEFAULT_WRITE_BATCH_SIZE,
+                      embed_texts=None, progress=None):
+    """
+    依清單比對區塊，只嵌入新增或內容改變的區塊並刪除已移除的區塊
+
+    區塊以串流方式處理，每累積 batch_size 個需要嵌入的區塊就寫入一次並更新清單，
+    中斷後重新執行會略過已寫入的區塊。
+
+    Args:
+        vector_store: Chroma 向量資料庫
+        chunks: build_chunks/iter_chunks 產生的 (chunk_id, 區塊文件)
+        manifest: IngestionManifest，會就地更新
+        batch_size: 每批寫入的區塊數量
+        embed_texts: 批次嵌入函式，None 時使用向量資料庫本身的嵌入模型
+        progress: 每批寫入後呼叫的函式，參數為已嵌入的區塊數量
+
+    Returns:
+        dict: 新增、更新、僅更新 metadata、刪除與未變更的區塊數量
+    """
+    old_entries = dict(manifest.chunks)
+    new_entries = {}
+    pending = []
+    to_update_metadata = []
+    counts = {"added": 0, "updated": 0, "metadata_updated": 0, "deleted": 0, "unchanged": 0}
+    embedded = 0
+
+    def flush():
+        nonlocal embedded
+        _write_batch(vector_store, pending, embed_texts)
+        for chunk_id, _ in pending:
+            manifest.chunks[chunk_id] = new_entries[chunk_id]
+        # 每批寫入後更新清單，中斷後可從此處繼續
+        manifest.save()
+        embedded += len(pending)
+        pending.clear()
+        if progress:
+            progress(embedded)
+
+    for chunk_id, chunk in chunks:
+        entry = {
+            "content": _sha1(chunk.page_content),
+            "metadata": _metadata_hash(chunk.metadata),
+        }
+        new_entries[chunk_id] = entry
+        old_entry = old_entries.get(chunk_id)
+        if old_entry is None:
+            counts["added"] += 1
+            pending.append((chunk_id, chunk))
+        elif old_entry["content"] != entry["content"]:
+            counts["updated"] += 1
+            pending.append((chunk_id, chunk))
+        elif old_entry["metadata"] != entry["metadata"]:
+            # 內容未變 (例如只有列號改變) 不需要重新嵌入
+            counts["metadata_updated"] += 1
+            to_update_metadata.append((chunk_id, chunk))
+        else:
+            counts["unchanged"] += 1
+
+        if len(pending) >= batch_size:
+            flush()
+
+    if pending:
+        flush()
+
+    if not new_entries:
+        raise RuntimeError("沒有任何區塊可寫入，保留現有的向量資料庫")
+
+    for batch in _batches(to_update_metadata, batch_size):
+        # langchain 的 Chroma 沒有只更新 metadata 的介面，直接使用底層 collection
+        vector_store._collection.update(
+            ids=[chunk_id for chunk_id, _ in batch],
+            metadatas=[chunk.metadata for _, chunk in batch]
+        )
+
+    removed_ids = [chunk_id for chunk_id in old_entries if chunk_id not in new_entries]
+    for batch in _batches(removed_ids, batch_size):
+        vector_store.delete(ids=batch)
+    counts["deleted"] = len(removed_ids)
+
+    manifest.chunks = new_entries
+    return counts
+
+
+def is_up_to_date(manifest_path, source_path, embedding_fingerprint):
+    """
+    向量資料庫是否已包含目前的資料檔 (只讀取清單，不開啟向量資料庫)
+
+    Returns:
+        tuple: (是否不需寫入, 資料檔雜湊)
+    """
+    manifest = IngestionManifest.load(manifest_path)
+    source_sha256 = file_sha256(source_path)
+    up_to_date = (manifest.exists
+                  and manifest.source_sha256 == source_sha256
+                  and manifest.embedding_fingerprint == embedding_fingerprint
+                  and manifest.metadata_fingerprint == metadata_fingerprint())
+    return up_to_date, source_sha256
+
+
+def ingest(vector_store, manifest_path, source_path, embedding_fingerprint, load_documents, split_documents,
+           batch_size=DEFAULT_WRITE_BATCH_SIZE, embed_texts=None, progress=None):
+    """
+    將資料檔增量寫入向量資料庫
+
+    資料檔、嵌入設定與結構化欄位都未改變時直接略過；結構化欄位改變時只更新 metadata；嵌入設定改變或沒有清單 (舊版建立的資料庫) 時清空後全部重建。
+
+    Args:
+        vector_store: Chroma 向量資料庫
+        manifest_path: 清單檔路徑
+        source_path: 資料檔路徑
+        embedding_fingerprint: 嵌入模型與分割設定的指紋
+        load_documents: 載入資料檔的函式，回傳文件列表或逐列產生文件的產生器
+        split_documents: 分割函式，接收文件列表並回傳區塊列表
+        batch_size: 每批寫入的區塊數量
+        embed_texts: 批次嵌入函式，None 時使用向量資料庫本身的嵌入模型
+        progress: 每批寫入後呼叫的函式，參數為已嵌入的區塊數量
+
+    Returns:
+        dict: 各類區塊數量、資料檔雜湊與耗時 (秒)
+    """
+    started = time.perf_counter()
+    manifest = IngestionManifest.load(manifest_path)
+    source_sha256 = file_sha256(source_path)
+
+    if (manifest.exists
+            and manifest.source_sha256 == source_sha256
+            and manifest.embedding_fingerprint == embedding_fingerprint
+            and manifest.metadata_fingerprint == metadata_fingerprint()):
+        report = {"added": 0, "updated": 0, "metadata_updated": 0, "deleted": 0,
+                  "unchanged": len(manifest.chunks), "skipped": True, "source_sha256": source_sha256}
+        report["seconds"] = round(time.perf_counter() - started, 3)
+        logger.info(f"資料檔未變更，略過寫入向量資料庫: {report}")
+        return report
+
+    if not manifest.exists or manifest.embedding_fingerprint != embedding_fingerprint:
+        # 舊版資料庫的區塊 ID 無法對應，或嵌入設定改變，需全部重建
+        existing_ids = vector_store.get(include=[])["ids"]
+        for batch in _batches(existing_ids, batch_size):
+            vector_store.delete(ids=batch)
+        if existing_ids:
+            logger.info(f"嵌入設定改變或缺少寫入清單，已清除 {len(existing_ids)} 個舊區塊")
+        manifest.chunks = {}
+        manifest.embedding_fingerprint = embedding_fingerprint
+
+    documents = load_documents()
+    if documents is None:
+        raise RuntimeError("無法載入文件")
+    chunks = iter_chunks(documents, split_documents)
+
+    # 寫入途中中斷時來源雜湊仍為舊值，下次啟動會繼續比對
+    manifest.source_sha256 = None
+    report = sync_vector_store(vector_store, chunks, manifest, batch_size, embed_texts, progress)
+    manifest.source_sha256 = source_sha256
+    manifest.metadata_fingerprint = metadata_fingerprint()
+    manifest.save()
+
+    report["skipped"] = False
+    report["source_sha256"] = source_sha256
+    report["seconds"] = round(time.perf_counter() - started, 3)
+    logger.info(f"向量資料庫增量寫入完成: {report}")
+    return report
+
+
+@contextmanager
+def build_lock(persist_directory):
+    """
+    跨行程的寫入鎖
+
+    多個 worker 同時啟動 (或離線寫入工具與服務同時執行) 時，只有取得鎖的行程寫入向量資料庫與重建索引，
+    其他行程等待後看到已更新的清單與索引，直接載入。
+    """
+    with open(os.path.join(persist_directory, BUILD_LOCK_FILENAME), "a+") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def default_paths():
+    """與 TravelRAGService 相同的預設資料檔與向量資料庫路徑"""
+    backend_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    data_path = os.path.join(backend_dir, "data", "attractions.csv")
+    if not os.path.exists(data_path):
+        data_path = os.path.join(os.path.dirname(backend_dir), "data", "attractions.csv")
+    return data_path, os.path.join(backend_dir, "chroma_db")
+
+
+def main(argv=None):
+    """離線建立或更新向量資料庫"""
+    default_data_path, default_persist_directory = default_paths()
+    parser = argparse.ArgumentParser(description="離線建立台灣旅遊 RAG 的向量資料庫")
+    parser.add_argument("--data", default=default_data_path, help="景點 CSV 檔案路徑")
+    parser.add_argument("--persist-dir", default=default_persist_directory, help="向量資料庫目錄")
+    parser.add_argument("--batch-size", type=int, default=64, help="嵌入模型每批編碼的區塊數量")
+    parser.add_argument("--write-batch-size", type=int, default=DEFAULT_WRITE_BATCH_SIZE,
+                        help="每批寫入向量資料庫的區塊數量 (也是中斷後可繼續的單位)")
+    parser.add_argument("--threads", type=int, default=os.cpu_count(), help="PyTorch 使用的 CPU 執行緒數量")
+    parser.add_argument("--processes", type=int, default=1, help="平行編碼的行程數量，大於 1 時使用多行程")
+    parser.add_argument("--device", default="cpu", help="嵌入模型使用的裝置")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+    import torch
+    from langchain_chroma import Chroma
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+    from sentence_transformers import SentenceTransformer
+    from .sparse_index import SPARSE_INDEX_DIRNAME, ensure_sparse_index
+
+    torch.set_num_threads(args.threads)
+    model = SentenceTransformer(EMBEDDING_MODEL_NAME, device=args.device)
+    pool = model.start_multi_process_pool(["cpu"] * args.processes) if args.processes > 1 else None
+
+    _, passage_prefix = text_prefixes(EMBEDDING_MODEL_NAME)
+
+    def embed_texts(texts):
+        # 與服務端 CachedEmbeddings + HuggingFaceEmbeddings 相同的前處理，向量才會一致
+        texts = [(passage_prefix + text).replace("\n", " ") for text in texts]
+        if pool is not None:
+            vectors = model.encode_multi_process(texts, pool, batch_size=args.batch_size)
+            return vectors / (vectors ** 2).sum(axis=1, keepdims=True) ** 0.5
+        return model.encode(texts, batch_size=args.batch_size, normalize_embeddings=True)
+
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=CHUNK_SIZE,
+        chunk_overlap=CHUNK_OVERLAP,
+        separators=SPLIT_SEPARATORS
+    )
+
+    os.makedirs(args.persist_dir, exist_ok=True)
+    vector_store = Chroma(persist_directory=args.persist_dir)
+
+    started = time.perf_counter()
+
+    def progress(embedded):
+        elapsed = time.perf_counter() - started
+        print(f"已嵌入 {embedded} 個區塊，{embedded / elapsed:.1f} chunks/s", flush=True)
+
+    with build_lock(args.persist_dir):
+        try:
+            report = ingest(
+                vector_store=vector_store,
+                manifest_path=os.path.join(args.persist_dir, MANIFEST_FILENAME),
+                source_path=args.data,
+                embedding_fingerprint=embedding_fingerprint(),
+                load_documents=lambda: stream_csv_documents(args.data),
+                split_documents=text_splitter.split_documents,
+                batch_size=args.write_batch_size,
+                embed_texts=embed_texts,
+                progress=progress
+            )
+        finally:
+            if pool is not None:
+                model.stop_multi_process_pool(pool)
+
+        # 稀疏索引與向量資料庫使用相同的區塊 ID，一併建立
+        ensure_sparse_index(vector_store, os.path.join(args.persist_dir, SPARSE_INDEX_DIRNAME), report["source_sha256"])
+
+    embedded = report["added"] + report["updated"]
+    throughput = embedded / report["seconds"] if report["seconds"] else 0.0
+    print(json.dumps(report, ensure_ascii=False))
+    print(f"共嵌入 {embedded} 個區塊，耗時 {report['seconds']} 秒，平均 {throughput:.1f} chunks/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+import json
+import os
+import logging
+import numpy as np
+
+from .attraction_catalog import CATEGORY_KEY_PREFIX, STRUCTURED_FIELDS, category_key
+
+# 設置日誌
+logger = logging.getLogger(__name__)
+
+# 結構化欄位的反向索引檔名，與稀疏索引放在同一個目錄，區塊位置與稀疏索引相同
+METADATA_INDEX_FILENAME = "metadata_index.json"
+
+
+class MetadataIndex:
+    """
+    結構化欄位的反向索引 (欄位 -> 值 -> 區塊位置)
+
+    與 SparseIndex 一起建立，區塊位置相同，可直接用來限制 BM25 的搜尋範圍，
+    也用來在送出 Chroma 查詢前確認過濾條件是否有符合的區塊。
+    """
+
+    def __init__(self, postings=None):
+        # 欄位 -> {值: 排序後的區塊位置陣列}
+        self.postings = postings or {field: {} for field in STRUCTURED_FIELDS}
+
+    @classmethod
+    def build(cls, metadatas):
+        """
+        從區塊 metadata 建立索引
+
+        類別以 category_key 的布林欄位建立，一個區塊的每個類別都會被索引；
+        舊版只有 category 欄位的 metadata 則以該欄位建立。
+
+        Args:
+            metadatas: 依區塊位置排列的 metadata，可以是產生器
+        """
+        lists = {field: {} for field in STRUCTURED_FIELDS}
+        for position, metadata in enumerate(metadatas):
+            metadata = metadata or {}
+            for field in ("county", "district"):
+                value = metadata.get(field)
+                if value:
+                    lists[field].setdefault(value, []).append(position)
+            categories = [key[len(CATEGORY_KEY_PREFIX):] for key, value in metadata.items()
+                          if key.startswith(CATEGORY_KEY_PREFIX) and value]
+            if not categories and metadata.get("category"):
+                categories = [metadata["category"]]
+            for category in categories:
+                lists["category"].setdefault(category, []).append(position)
+        return cls({
+            field: {value: np.asarray(positions, dtype=np.int32) for value, positions in values.items()}
+            for field, values in lists.items()
+        })
+
+    def save(self, index_dir):
+        """寫入索引目錄"""
+        path = os.path.join(index_dir, METADATA_INDEX_FILENAME)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(
+                {field: {value: positions.tolist() for value, positions in values.items()}
+                 for field, values in self.postings.items()},
+                f,
+                ensure_ascii=False
+            )
+
+    @classmethod
+    def load(cls, index_dir):
+        """載入索引，不存在或格式錯誤時回傳 None"""
+        try:
+            with open(os.path.join(index_dir, METADATA_INDEX_FILENAME), "r", encoding="utf-8") as f:
+                data = json.load(f)
+            return cls({
+                field: {value: np.asarray(positions, dtype=np.int32) for value, positions in values.items()}
+                for field, values in data.items()
+            })
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.error(f"載入結構化欄位索引時出錯: {str(e)}")
+            return None
+
+    def _field_positions(self, field, values):
+        arrays = [self.postings.get(field, {}).get(value) for value in values]
+        arrays = [array for array in arrays if array is not None]
+        if not arrays:
+            return np.empty(0, dtype=np.int32)
+        return np.unique(np.concatenate(arrays))
+
+    def resolve(self, filters):
+        """
+        計算符合過濾條件的區塊位置
+
+        地點條件 (縣市或鄉鎮市區任一符合) 與類別條件同時成立。
+
+        Args:
+            filters: AttractionCatalog.parse_filters 的結果
+
+        Returns:
+            numpy.ndarray: 排序後的區塊位置
+        """
+        result = None
+        places = [self._field_positions(field, filters[field]) for field in ("county", "district") if field in filters]
+        if places:
+            result = np.unique(np.concatenate(places))
+        if "category" in filters:
+            categories = self._field_positions("category", filters["category"])
+            result = categories if result is None else np.intersect1d(result, categories, assume_unique=True)
+        return result
+
+
+def build_where(filters):
+    """
+    將過濾條件轉為 Chroma 的 where 條件
+
+    類別以 category_key 的布林欄位比對，區塊的任一類別符合即可。
+
+    Returns:
+        dict: Chroma where 條件，沒有條件時回傳 None
+    """
+    places = [{field: {"$in": list(filters[field])}} for field in ("county", "district") if filters.get(field)]
+    clauses = []
+    if len(places) == 1:
+        clauses.append(places[0])
+    elif places:
+        clauses.append({"$or": places})
+    categories = [{category_key(category): True} for category in filters.get("category") or ()]
+    if len(categories) == 1:
+        clauses.append(categories[0])
+    elif categories:
+        clauses.append({"$or": categories})
+    if not clauses:
+        return None
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
@@ -0,0 +1,375 @@
+"""
+模型伺服器：多個 uvicorn worker 共用一份嵌入模型與 cross-encoder
+
+    cd backend
+    python -m package.model_server --socket /tmp/travel-rag-models.sock
+
+worker 設定 model_server_socket 後以 RemoteEmbeddings 與 RemoteCrossEncoder 經由 Unix socket 呼叫，
+不需各自載入 PyTorch 或 ONNX 模型；索引則由各 worker 以 mmap 載入，同一份檔案的頁面在行程間共用。
+"""
+from langchain_core.embeddings import Embeddings
+from multiprocessing.connection import AuthenticationError, Client, Listener
+import argparse
+import os
+import threading
+import time
+import logging
+import numpy as np
+
+# 設置日誌
+logger = logging.getLogger(__name__)
+
+DEFAULT_SOCKET_PATH = "/tmp/travel-rag-models.sock"
+
+
+def process_memory():
+    """
+    目前行程的記憶體用量 (MB)
+
+    rss 包含與其他行程共用的頁面 (mmap 的索引、fork 前載入的函式庫)，
+    pss 將共用頁面依共用的行程數平分，加總各 worker 的 pss 即為實際用量。只支援 Linux。
+    """
+    memory = {}
+    for path, fields in (("/proc/self/status", {"VmRSS": "rss_mb"}),
+                         ("/proc/self/smaps_rollup", {"Pss": "pss_mb", "Shared_Clean": "shared_clean_mb"})):
+        try:
+            with open(path) as f:
+                for line in f:
+                    name, _, value = line.partition(":")
+                    if name in fields:
+                        memory[fields[name]] = round(int(value.split()[0]) / 1024, 1)
+        except OSError:
+            continue
+    return memory
+
+
+def default_authkey():
+    """model_server_authkey 未設定時使用 secret_key，伺服器與 worker 讀取相同的 .env，兩者皆未設定時回傳 None"""
+    key = os.getenv("model_server_authkey") or os.getenv("secret_key")
+    return key.encode("utf-8") if key else None
+
+
+def _require_authkey(authkey):
+    """連線會以 pickle 傳遞資料，不接受未驗證的連線"""
+    if not authkey:
+        raise ValueError("模型伺服器需要連線金鑰，請設定 model_server_authkey 或 secret_key")
+    return authkey
+
+
+class ModelServer:
+    """
+    以 Unix socket 提供嵌入與重新排序的模型伺服器
+
+    每個連線一個執行緒；同一個模型的推論依序執行，避免多個請求同時推論時互相搶奪 CPU 執行緒。
+    請求格式為 (方法名稱, 參數)，回應為 ("ok", 結果) 或 ("error", 錯誤訊息)。
+    """
+
+    def __init__(self, address, embeddings=None, cross_encoder=None, *, authkey):
+        """
+        初始化模型伺服器
+
+        Args:
+            address: Unix socket 路徑
+            embeddings: langchain 的嵌入模型 (不含 e5 前綴，由 worker 的 CachedEmbeddings 加上)
+            cross_encoder: sentence-transformers 的 CrossEncoder，None 表示不提供重新排序
+            authkey: 連線驗證用的金鑰 (必填，未通過驗證的連線會被拒絕)
+        """
+        self.address = address
+        self.embeddings = embeddings
+        self.cross_encoder = cross_encoder
+        self.authkey = _require_authkey(authkey)
+
+        self._embed_lock = threading.Lock()
+        self._rerank_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.started_at = time.time()
+
+        # 統計數據
+        self.connections = 0
+        self.requests = 0
+        self.errors = 0
+        self.embedded_texts = 0
+        self.reranked_pairs = 0
+
+    def embed(self, texts):
+        if self.embeddings is None:
+            raise RuntimeError("模型伺服器未載入嵌入模型")
+        with self._embed_lock:
+            vectors = np.asarray(self.embeddings.embed_documents(list(texts)), dtype=np.float32)
+        with self._stats_lock:
+            self.embedded_texts += len(texts)
+        return vectors
+
+    def rerank(self, pairs, batch_size=16):
+        if self.cross_encoder is None:
+            raise RuntimeError("模型伺服器未載入 cross-encoder")
+        with self._rerank_lock:
+            scores = self.cross_encoder.predict(list(pairs), batch_size=batch_size, show_progress_bar=False)
+        with self._stats_lock:
+            self.reranked_pairs += len(pairs)
+        return np.asarray(scores, dtype=np.float32)
+
+    def stats(self):
+        """取得模型伺服器的統計數據"""
+        with self._stats_lock:
+            return {
+                "pid": os.getpid(),
+                "uptime_seconds": round(time.time() - self.started_at, 1),
+                "embeddings": type(self.embeddings).__name__ if self.embeddings is not None else None,
+                "cross_encoder": self.cross_encoder is not None,
+                "connections": self.connections,
+                "requests": self.requests,
+                "errors": self.errors,
+                "embedded_texts": self.embedded_texts,
+                "reranked_pairs": self.reranked_pairs,
+                "memory": process_memory(),
+            }
+
+    def handle(self, method, args):
+        """執行一個請求"""
+        if method == "embed":
+            return self.embed(*args)
+        if method == "rerank":
+            return self.rerank(*args)
+        if method in ("ping", "stats"):
+            return self.stats()
+        raise ValueError(f"不支援的方法: {method}")
+
+    def _serve_connection(self, connection):
+        with self._stats_lock:
+            self.connections += 1
+        with connection:
+            while True:
+                try:
+                    method, args = connection.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    reply = ("ok", self.handle(method, args))
+                except Exception as e:
+                    logger.error(f"模型伺服器處理 {method} 時出錯: {str(e)}")
+                    with self._stats_lock:
+                        self.errors += 1
+                    reply = ("error", f"{type(e).__name__}: {e}")
+                with self._stats_lock:
+                    self.requests += 1
+                try:
+                    connection.send(reply)
+                except OSError:
+                    return
+
+    def serve_forever(self):
+        """開始接受 worker 的連線 (不會返回)"""
+        if os.path.exists(self.address):
+            # 上次未正常結束留下的 socket 檔案
+            os.unlink(self.address)
+        # socket 檔案只允許同一個用戶連線
+        previous_umask = os.umask(0o077)
+        try:
+            listener = Listener(self.address, family="AF_UNIX", authkey=self.authkey)
+        finally:
+            os.umask(previous_umask)
+        logger.info(f"模型伺服器已就緒: {self.address}")
+
+        with listener:
+            while True:
+                try:
+                    connection = listener.accept()
+                except (AuthenticationError, OSError) as e:
+                    logger.warning(f"拒絕模型伺服器連線: {str(e)}")
+                    continue
+                threading.Thread(target=self._serve_connection, args=(connection,), daemon=True).start()
+
+
+class ModelServerError(RuntimeError):
+    """模型伺服器回傳錯誤或無法連線"""
+
+
+class ModelClient:
+    """
+    模型伺服器的用戶端 (執行緒安全)
+
+    連線不能同時被多個執行緒使用，閒置的連線放回連線池重複使用；
+    伺服器重新啟動造成連線中斷時重新連線一次。
+    """
+
+    def __init__(self, address, authkey, timeout=30.0, max_idle=8):
+        """
+        初始化用戶端
+
+        Args:
+            address: 模型伺服器的 Unix socket 路徑
+            authkey: 連線驗證用的金鑰 (必填，需與伺服器相同)
+            timeout: 等待回應的秒數
+            max_idle: 保留的閒置連線數量
+        """
+        self.address = address
+        self.authkey = _require_authkey(authkey)
+        self.timeout = timeout
+        self.max_idle = max_idle
+
+        self._lock = threading.Lock()
+        self._idle = []
+
+        # 統計數據
+        self.calls = 0
+        self.reconnects = 0
+        self.total_seconds = 0.0
+
+    def _acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return Client(self.address, family="AF_UNIX", authkey=self.authkey)
+
+    def _release(self, connection):
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    def _discard_idle(self):
+        """關閉所有閒置的連線 (伺服器重新啟動後都已失效)"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+    def _request(self, connection, method, args):
+        """送出請求並等待回應，逾時時關閉連線 (回應可能稍後才抵達，不能再重複使用)"""
+        connection.send((method, args))
+        if not connection.poll(self.timeout):
+            connection.close()
+            raise ModelServerError(f"模型伺服器 {method} 逾時 ({self.timeout} 秒)")
+        return connection.recv()
+
+    def call(self, method, *args):
+        """
+        呼叫模型伺服器
+
+        Raises:
+            ModelServerError: 伺服器回傳錯誤、逾時或無法連線
+        """
+        started = time.perf_counter()
+        for attempt in range(2):
+            try:
+                connection = self._acquire()
+            except (OSError, EOFError, AuthenticationError) as e:
+                raise ModelServerError(f"無法連線到模型伺服器 {self.address}: {e}") from e
+            try:
+                status, result = self._request(connection, method, args)
+            except (EOFError, OSError) as e:
+                # 閒置的連線可能因伺服器重新啟動而中斷，其他閒置連線也一併捨棄後重新連線
+                connection.close()
+                self._discard_idle()
+                if attempt:
+                    raise ModelServerError(f"模型伺服器連線中斷: {e}") from e
+                with self._lock:
+                    self.reconnects += 1
+                continue
+            self._release(connection)
+            break
+
+        with self._lock:
+            self.calls += 1
+            self.total_seconds += time.perf_counter() - started
+        if status != "ok":
+            raise ModelServerError(result)
+        return result
+
+    def wait_ready(self, timeout=300.0, interval=1.0):
+        """等待模型伺服器就緒 (伺服器可能仍在載入模型)"""
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                return self.call("ping")
+            except ModelServerError as e:
+                if time.monotonic() >= deadline:
+                    raise ModelServerError(f"等待模型伺服器逾時: {e}") from e
+                time.sleep(interval)
+
+    def stats(self):
+        """用戶端與伺服器的統計數據"""
+        with self._lock:
+            stats = {
+                "address": self.address,
+                "calls": self.calls,
+                "reconnects": self.reconnects,
+                "avg_ms": self.total_seconds / self.calls * 1000 if self.calls else 0.0,
+            }
+        try:
+            stats["server"] = self.call("stats")
+        except ModelServerError as e:
+            stats["server"] = {"error": str(e)}
+        return stats
+
+
+class RemoteEmbeddings(Embeddings):
+    """經由模型伺服器計算的嵌入模型"""
+
+    def __init__(self, client):
+        self.client = client
+
+    def embed_documents(self, texts):
+        if not texts:
+            return []
+        return self.client.call("embed", list(texts)).tolist()
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+class RemoteCrossEncoder:
+    """經由模型伺服器計算的 cross-encoder，提供 CrossEncoderReranker 使用的 predict 介面"""
+
+    def __init__(self, client):
+        self.client = client
+
+    def predict(self, pairs, batch_size=16, show_progress_bar=False):
+        if not pairs:
+            return np.empty(0, dtype=np.float32)
+        return self.client.call("rerank", [tuple(pair) for pair in pairs], batch_size)
+
+
+def main():
+    from dotenv import load_dotenv
+
+    from .embeddings import create_embeddings
+    from .ingest import EMBEDDING_MODEL_NAME
+    from .rerank import DEFAULT_CROSS_ENCODER_MODEL, load_cross_encoder
+
+    # 與 app.main 讀取相同的 .env
+    load_dotenv(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app", ".env"))
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description="多個 worker 共用的模型伺服器")
+    parser.add_argument("--socket", default=os.getenv("model_server_socket") or DEFAULT_SOCKET_PATH)
+    parser.add_argument("--embedding-backend", default=os.getenv("embedding_backend", "torch"))
+    parser.add_argument("--embedding-threads", type=int, default=int(os.getenv("embedding_threads", "0")))
+    parser.add_argument("--reranker-backend", default=os.getenv("reranker_backend", "cohere"),
+                        help="cross_encoder 時同時載入 cross-encoder")
+    parser.add_argument("--reranker-model", default=os.getenv("reranker_model") or DEFAULT_CROSS_ENCODER_MODEL)
+    parser.add_argument("--reranker-onnx-file", default=os.getenv("reranker_onnx_file") or None)
+    parser.add_argument("--check", action="store_true", help="只檢查設定 (連線金鑰) 後結束，不載入模型")
+    args = parser.parse_args()
+
+    authkey = default_authkey()
+    if not authkey:
+        parser.exit(1, "模型伺服器需要連線金鑰，請設定 model_server_authkey 或 secret_key\n")
+    if args.check:
+        return
+
+    embedding_kwargs = {}
+    if args.embedding_backend != "torch" and args.embedding_threads:
+        embedding_kwargs["num_threads"] = args.embedding_threads
+    embeddings = create_embeddings(EMBEDDING_MODEL_NAME, args.embedding_backend, **embedding_kwargs)
+    cross_encoder = None
+    if args.reranker_backend == "cross_encoder":
+        cross_encoder = load_cross_encoder(args.reranker_model, "cpu", args.reranker_onnx_file)
+
+    ModelServer(args.socket, embeddings, cross_encoder, authkey=authkey).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+import threading
+import logging
+
+from .attraction_catalog import normalize
+
+# 設置日誌
+logger = logging.getLogger(__name__)
+
+# 查詢擴展方式
+#   llm: 由 Gemini 產生子查詢 (多一次 API 呼叫與速率限制排隊)
+#   local: 以景點詞典的地名與主題同義詞擴展，不需網路呼叫
+#   none: 只使用原始查詢
+QUERY_EXPANSION_MODES = ("llm", "local", "none")
+
+# 目前請求指定的擴展方式，None 表示使用預設值
+_query_expansion = ContextVar("query_expansion", default=None)
+
+
+@contextmanager
+def query_expansion_mode(mode):
+    """在此範圍內的檢索使用指定的查詢擴展方式，None 表示使用預設值"""
+    if mode is not None and mode not in QUERY_EXPANSION_MODES:
+        raise ValueError(f"不支援的查詢擴展方式: {mode}")
+    token = _query_expansion.set(mode)
+    try:
+        yield
+    finally:
+        _query_expansion.reset(token)
+
+
+class QueryExpander:
+    """
+    查詢擴展，將使用者查詢轉為多個子查詢
+
+    擴展方式可由設定指定預設值，也可在每個請求以 query_expansion_mode 覆寫。
+    語言模型產生失敗時改用本地擴展。
+    """
+
+    def __init__(self, query_llm=None, catalog=None, default_mode="llm", include_original=False,
+                 max_local_queries=4):
+        """
+        初始化查詢擴展
+
+        Args:
+            query_llm: 產生子查詢的語言模型，None 時無法使用 llm 模式
+            catalog: AttractionCatalog，None 時無法使用 local 模式
+            default_mode: 預設的擴展方式
+            include_original: llm 模式是否也使用原始查詢 (與 MultiQueryRetriever 相同，預設不使用)
+            max_local_queries: local 模式最多產生的子查詢數量
+        """
+        if default_mode not in QUERY_EXPANSION_MODES:
+            raise ValueError(f"不支援的查詢擴展方式: {default_mode}")
+        self.catalog = catalog
+        self.default_mode = default_mode
+        self.include_original = include_original
+        self.max_local_queries = max_local_queries
+
+        self.query_chain = None
+        if query_llm is not None:
+            # 延後載入，只有使用語言模型時才需要
+            from langchain.retrievers.multi_query import DEFAULT_QUERY_PROMPT, LineListOutputParser
+            self.query_chain = DEFAULT_QUERY_PROMPT | query_llm | LineListOutputParser()
+
+        # 統計數據
+        self._lock = threading.Lock()
+        self._counts = {mode: 0 for mode in QUERY_EXPANSION_MODES}
+        self.llm_failures = 0
+
+    def resolve_mode(self, mode=None):
+        """決定實際使用的擴展方式，指定的方式無法使用時依序改用 local、none"""
+        mode = mode or _query_expansion.get() or self.default_mode
+        if mode == "llm" and self.query_chain is None:
+            mode = "local"
+        if mode == "local" and self.catalog is None:
+            mode = "none"
+        with self._lock:
+            self._counts[mode] += 1
+        return mode
+
+    def expand(self, query, mode=None):
+        """
+        擴展查詢
+
+        Args:
+            query: 使用者查詢
+            mode: 擴展方式，None 時使用目前請求或預設的方式
+
+        Returns:
+            list: 子查詢列表
+        """
+        mode = self.resolve_mode(mode)
+        if mode == "llm":
+            try:
+                return self._llm_queries(query, self.query_chain.invoke({"question": query}))
+            except Exception as e:
+                return self._llm_fallback(query, e)
+        if mode == "local":
+            return self.expand_local(query)
+        return [query]
+
+    async def aexpand(self, query, mode=None):
+        """非同步擴展查詢"""
+        mode = self.resolve_mode(mode)
+        if mode == "llm":
+            try:
+                return self._llm_queries(query, await self.query_chain.ainvoke({"question": query}))
+            except Exception as e:
+                return self._llm_fallback(query, e)
+        if mode == "local":
+            return self.expand_local(query)
+        return [query]
+
+    def _llm_queries(self, query, generated):
+        """整理語言模型產生的子查詢，沒有結果時使用原始查詢"""
+        queries = [q.strip() for q in generated or [] if q and q.strip()]
+        if self.include_original or not queries:
+            queries.insert(0, query)
+        # 去除重複的子查詢，保留順序
+        return list(dict.fromkeys(queries))
+
+    def _llm_fallback(self, query, error):
+        """語言模型產生失敗時改用本地擴展"""
+        with self._lock:
+            self.llm_failures += 1
+        logger.error(f"產生子查詢時出錯，改用本地擴展: {str(error)}")
+        return self.expand_local(query) if self.catalog is not None else [query]
+
+    def expand_local(self, query):
+        """
+        以景點詞典擴展查詢
+
+        除原始查詢外，產生：地名換成正式名稱的查詢 (例如「台北」→「臺北市」、「淡水」→「新北市淡水區」)，
+        以及地名加上主題同義詞的關鍵字查詢 (例如「高雄市 看海 海邊 海景 海灘」)。
+        """
+        normalized = normalize(query)
+        places, topics = self.catalog.match(normalized)
+        queries = [query]
+
+        if places:
+            rewritten = normalized
+            for term, canonical in places:
+                rewritten = rewritten.replace(term, " ".join(canonical), 1)
+            queries.append(rewritten)
+
+        place_names = list(dict.fromkeys(name for _, canonical in places for name in canonical))
+        for topic in topics:
+            queries.append(" ".join(place_names + list(topic)))
+
+        # 只提到鄉鎮市區時加上所屬縣市，擴大到鄰近的景點
+        counties = [
+            self.catalog.district_counties[name] for name in place_names
+            if name in self.catalog.district_counties
+        ]
+        if counties and topics:
+            queries.append(" ".join(list(dict.fromkeys(counties)) + list(topics[0])))
+
+        return list(dict.fromkeys(queries))[:self.max_local_queries]
+
+    def stats(self):
+        """取得各擴展方式的使用次數"""
+        with self._lock:
+            return {
+                "default_mode": self.default_mode,
+                "counts": dict(self._counts),
+                "llm_failures": self.llm_failures,
+            }
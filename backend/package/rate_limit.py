@@ -0,0 +1,266 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from langchain_core.runnables import Runnable
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+import logging
+
+# 設置日誌
+logger = logging.getLogger(__name__)
+
+# 預設的請求優先順序，數字越小越優先
+DEFAULT_PRIORITY = 10
+
+# 目前請求的優先順序，跨越 langchain 的執行緒與協程仍會保留
+_request_priority = ContextVar("request_priority", default=DEFAULT_PRIORITY)
+
+# 呼叫端放棄等待的時間點 (time.monotonic())，None 表示不限
+_request_deadline = ContextVar("request_deadline", default=None)
+
+
+class RateLimitTimeout(TimeoutError):
+    """在期限內未取得令牌，呼叫端已放棄等待，不應再送出 API 呼叫"""
+
+
+@contextmanager
+def request_priority(priority):
+    """在此範圍內送出的 API 呼叫使用指定的優先順序排隊"""
+    token = _request_priority.set(priority)
+    try:
+        yield
+    finally:
+        _request_priority.reset(token)
+
+
+@contextmanager
+def request_deadline(deadline):
+    """在此範圍內排隊等待令牌最多到 deadline (time.monotonic()) 為止"""
+    token = _request_deadline.set(deadline)
+    try:
+        yield
+    finally:
+        _request_deadline.reset(token)
+
+
+def current_deadline():
+    """目前範圍的等待期限，None 表示不限"""
+    return _request_deadline.get()
+
+
+class TokenBucket:
+    """令牌桶，以固定速率補充令牌，最多累積 burst 個"""
+
+    def __init__(self, requests_per_second, burst=1):
+        self.requests_per_second = requests_per_second
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last_refill = time.monotonic()
+
+    def try_consume(self):
+        """
+        嘗試取得一個令牌
+
+        Returns:
+            float: 0 表示成功取得，否則為還需等待的秒數
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.requests_per_second)
+        self.last_refill = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.requests_per_second
+
+
+class RateLimitScheduler:
+    """
+    多組令牌桶的速率限制排程器
+
+    每個用途 (例如 query_generation、answer_generation、rerank) 各有獨立的預算，
+    同一用途下每把 API 金鑰各有一個令牌桶，以輪詢方式分配。
+    等待中的請求依優先順序 (數字越小越優先)、再依抵達順序取得令牌。
+    """
+
+    def __init__(self, limits, check_every_n_seconds=0.1):
+        """
+        初始化排程器
+
+        Args:
+            limits: {用途: {"requests_per_second": 速率, "burst": 最大累積數, "keys": 金鑰數量}}
+            check_every_n_seconds: 等待時檢查令牌的間隔秒數
+        """
+        self.check_every_n_seconds = check_every_n_seconds
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._cursors = {}
+        self._waiters = {}
+        self._sequence = itertools.count()
+        self._stats = {}
+
+        for purpose, limit in limits.items():
+            self._buckets[purpose] = [
+                TokenBucket(limit["requests_per_second"], limit.get("burst", 1))
+                for _ in range(max(1, limit.get("keys", 1)))
+            ]
+            self._cursors[purpose] = 0
+            self._waiters[purpose] = []
+            self._stats[purpose] = {"granted": 0, "expired": 0, "total_wait": 0.0, "max_wait": 0.0}
+
+    def _try_grant(self, purpose, ticket):
+        """
+        排在最前面時嘗試取得令牌 (呼叫端需持有鎖)
+
+        Returns:
+            tuple: (金鑰索引或 None, 建議等待秒數)
+        """
+        waiters = self._waiters[purpose]
+        if waiters[0] is not ticket:
+            return None, self.check_every_n_seconds
+
+        # 從上次使用的下一把金鑰開始輪詢
+        buckets = self._buckets[purpose]
+        start = self._cursors[purpose]
+        shortest_wait = None
+        for offset in range(len(buckets)):
+            key_index = (start + offset) % len(buckets)
+            wait = buckets[key_index].try_consume()
+            if wait == 0:
+                self._cursors[purpose] = key_index + 1
+                heapq.heappop(waiters)
+                return key_index, 0.0
+            shortest_wait = wait if shortest_wait is None else min(shortest_wait, wait)
+        return None, shortest_wait
+
+    def _enqueue(self, purpose, priority):
+        """加入等待佇列"""
+        if priority is None:
+            priority = _request_priority.get()
+        ticket = (priority, next(self._sequence))
+        with self._lock:
+            heapq.heappush(self._waiters[purpose], ticket)
+        return ticket
+
+    def _dequeue(self, purpose, ticket):
+        """放棄等待 (例如請求被取消)"""
+        with self._lock:
+            waiters = self._waiters[purpose]
+            if ticket in waiters:
+                waiters.remove(ticket)
+                heapq.heapify(waiters)
+
+    def _record_wait(self, purpose, wait):
+        """記錄排隊等待時間"""
+        with self._lock:
+            stats = self._stats[purpose]
+            stats["granted"] += 1
+            stats["total_wait"] += wait
+            stats["max_wait"] = max(stats["max_wait"], wait)
+        if wait > 1:
+            logger.info(f"{purpose} 速率限制排隊 {wait:.2f} 秒")
+
+    def _check_deadline(self, purpose, deadline):
+        """已超過期限時放棄等待 (不消耗令牌)，回傳距離期限的秒數"""
+        if deadline is None:
+            return self.check_every_n_seconds
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            with self._lock:
+                self._stats[purpose]["expired"] += 1
+            raise RateLimitTimeout(f"{purpose} 在期限內未取得令牌")
+        return remaining
+
+    def acquire(self, purpose, priority=None, deadline=None):
+        """
+        等待並取得一個令牌
+
+        Args:
+            purpose: 用途名稱
+            priority: 優先順序，未指定時使用目前請求的優先順序
+            deadline: 放棄等待的時間點 (time.monotonic())，逾期時拋出 RateLimitTimeout
+
+        Returns:
+            int: 分配到的金鑰索引
+        """
+        started = time.monotonic()
+        ticket = self._enqueue(purpose, priority)
+        try:
+            while True:
+                remaining = self._check_deadline(purpose, deadline)
+                with self._lock:
+                    key_index, wait = self._try_grant(purpose, ticket)
+                if key_index is not None:
+                    self._record_wait(purpose, time.monotonic() - started)
+                    return key_index
+                time.sleep(min(wait, self.check_every_n_seconds, remaining))
+        except BaseException:
+            self._dequeue(purpose, ticket)
+            raise
+
+    async def aacquire(self, purpose, priority=None, deadline=None):
+        """非同步等待並取得一個令牌，回傳分配到的金鑰索引 (參數同 acquire)"""
+        started = time.monotonic()
+        ticket = self._enqueue(purpose, priority)
+        try:
+            while True:
+                remaining = self._check_deadline(purpose, deadline)
+                with self._lock:
+                    key_index, wait = self._try_grant(purpose, ticket)
+                if key_index is not None:
+                    self._record_wait(purpose, time.monotonic() - started)
+                    return key_index
+                await asyncio.sleep(min(wait, self.check_every_n_seconds, remaining))
+        except BaseException:
+            self._dequeue(purpose, ticket)
+            raise
+
+    def stats(self):
+        """取得各用途的排隊統計數據"""
+        with self._lock:
+            result = {}
+            for purpose, stats in self._stats.items():
+                granted = stats["granted"]
+                result[purpose] = {
+                    "keys": len(self._buckets[purpose]),
+                    "requests_per_second": self._buckets[purpose][0].requests_per_second,
+                    "waiting": len(self._waiters[purpose]),
+                    "granted": granted,
+                    "expired": stats["expired"],
+                    "avg_wait_seconds": stats["total_wait"] / granted if granted else 0.0,
+                    "max_wait_seconds": stats["max_wait"],
+                }
+            return result
+
+
+class ScheduledChatModel(Runnable):
+    """
+    依排程器分配的金鑰輪流呼叫的語言模型
+
+    models 為每把 API 金鑰各建立一個的模型，呼叫前先向排程器取得令牌，
+    再使用分配到的金鑰對應的模型。可直接放入 LLMChain 或 prompt | llm 的管線中。
+    priority 未指定時使用目前請求的優先順序 (request_priority)。
+    """
+
+    def __init__(self, scheduler, purpose, models):
+        self.scheduler = scheduler
+        self.purpose = purpose
+        self.models = models
+
+    def invoke(self, input, config=None, priority=None, **kwargs):
+        key_index = self.scheduler.acquire(self.purpose, priority)
+        return self.models[key_index].invoke(input, config, **kwargs)
+
+    async def ainvoke(self, input, config=None, priority=None, **kwargs):
+        key_index = await self.scheduler.aacquire(self.purpose, priority)
+        return await self.models[key_index].ainvoke(input, config, **kwargs)
+
+    def stream(self, input, config=None, priority=None, **kwargs):
+        key_index = self.scheduler.acquire(self.purpose, priority)
+        yield from self.models[key_index].stream(input, config, **kwargs)
+
+    async def astream(self, input, config=None, priority=None, **kwargs):
+        key_index = await self.scheduler.aacquire(self.purpose, priority)
+        async for chunk in self.models[key_index].astream(input, config, **kwargs):
+            yield chunk
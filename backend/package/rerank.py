@@ -0,0 +1,205 @@
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from langchain_core.callbacks import Callbacks
+from langchain_core.documents import BaseDocumentCompressor, Document
+from pydantic import ConfigDict, PrivateAttr
+from typing import Any, Optional, Sequence
+import asyncio
+import contextvars
+import threading
+import time
+import logging
+
+from .rate_limit import RateLimitTimeout, request_deadline
+
+# 設置日誌
+logger = logging.getLogger(__name__)
+
+# 重新排序的方式
+#   cohere: Cohere rerank API
+#   cross_encoder: 本地的多語言 cross-encoder (CPU 即可執行)
+#   none: 不重新排序，使用檢索合併後的順序
+RERANKER_BACKENDS = ("cohere", "cross_encoder", "none")
+
+# 預設的本地 cross-encoder，支援中文的小型模型
+DEFAULT_CROSS_ENCODER_MODEL = "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1"
+
+
+def load_cross_encoder(model_name=DEFAULT_CROSS_ENCODER_MODEL, device="cpu", onnx_file_name=None, max_length=512):
+    """
+    載入 cross-encoder 模型
+
+    Args:
+        model_name: Hugging Face 模型名稱
+        device: 執行的裝置
+        onnx_file_name: ONNX 模型檔名 (例如量化版本 onnx/model_qint8_avx512_vnni.onnx)，
+            需安裝 sentence-transformers>=3.4 與 optimum[onnxruntime]，None 時使用 PyTorch
+        max_length: 輸入的最大 token 數量
+    """
+    from sentence_transformers import CrossEncoder
+
+    if onnx_file_name:
+        try:
+            return CrossEncoder(
+                model_name,
+                device=device,
+                max_length=max_length,
+                backend="onnx",
+                model_kwargs={"file_name": onnx_file_name}
+            )
+        except Exception as e:
+            logger.error(f"載入 ONNX cross-encoder 時出錯，改用 PyTorch: {str(e)}")
+    return CrossEncoder(model_name, device=device, max_length=max_length)
+
+
+class CrossEncoderReranker(BaseDocumentCompressor):
+    """以本地 cross-encoder 批次計算查詢與文件的相關分數並重新排序"""
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    model: Any
+    top_n: int = 10
+    batch_size: int = 16
+
+    def compress_documents(
+        self,
+        documents: Sequence[Document],
+        query: str,
+        callbacks: Optional[Callbacks] = None,
+    ) -> Sequence[Document]:
+        if not documents:
+            return []
+        scores = self.model.predict(
+            [(query, document.page_content) for document in documents],
+            batch_size=self.batch_size,
+            show_progress_bar=False
+        )
+        ranked = sorted(zip(documents, scores), key=lambda pair: float(pair[1]), reverse=True)
+        results = []
+        for document, score in ranked[:self.top_n]:
+            # 與 CohereRerank 相同，將分數放在 relevance_score
+            document = Document(
+                page_content=document.page_content,
+                metadata={**document.metadata, "relevance_score": float(score)}
+            )
+            results.append(document)
+        return results
+
+
+class TimeoutFallbackReranker(BaseDocumentCompressor):
+    """
+    有逾時限制的重新排序
+
+    先截取前 max_candidates 個候選文件再交給 reranker；reranker 逾時或出錯時，
+    該次請求改用 fallback (未設定時使用原本的順序)，不影響之後的請求。
+    排隊等待 API 令牌最多到逾時為止，逾時後不再送出已被放棄的請求。
+    """
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    reranker: BaseDocumentCompressor
+    fallback: Optional[BaseDocumentCompressor] = None
+    timeout: Optional[float] = 10.0
+    max_candidates: int = 50
+    top_n: int = 10
+    max_workers: int = 4
+
+    _executor: Any = PrivateAttr(default=None)
+    _lock: Any = PrivateAttr(default_factory=threading.Lock)
+    _stats: dict = PrivateAttr(default_factory=lambda: {
+        "calls": 0, "timeouts": 0, "errors": 0, "total_seconds": 0.0
+    })
+
+    def _pool(self):
+        # 同步呼叫需要另一個執行緒才能設定逾時
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="rerank")
+            return self._executor
+
+    def _record(self, started, outcome=None):
+        with self._lock:
+            self._stats["calls"] += 1
+            self._stats["total_seconds"] += time.perf_counter() - started
+            if outcome:
+                self._stats[outcome] += 1
+
+    def _deadline(self):
+        """依逾時秒數計算排隊等待令牌的期限"""
+        return time.monotonic() + self.timeout if self.timeout is not None else None
+
+    def _compress_before_deadline(self, deadline, documents, query):
+        with request_deadline(deadline):
+            return self.reranker.compress_documents(documents, query)
+
+    def _fallback(self, documents, query, reason):
+        logger.warning(f"重新排序{reason}，此次請求改用備用排序")
+        if self.fallback is not None:
+            try:
+                return list(self.fallback.compress_documents(documents, query))
+            except Exception as e:
+                logger.error(f"備用排序出錯: {str(e)}")
+        return list(documents[:self.top_n])
+
+    def compress_documents(
+        self,
+        documents: Sequence[Document],
+        query: str,
+        callbacks: Optional[Callbacks] = None,
+    ) -> Sequence[Document]:
+        documents = list(documents[:self.max_candidates])
+        if not documents:
+            return []
+        started = time.perf_counter()
+        # 複製 context，讓工作執行緒沿用呼叫端的請求優先順序與等待期限
+        context = contextvars.copy_context()
+        future = self._pool().submit(
+            context.run, self._compress_before_deadline, self._deadline(), documents, query
+        )
+        try:
+            results = list(future.result(timeout=self.timeout))
+        except (FutureTimeoutError, RateLimitTimeout):
+            # 無法中斷執行緒：仍在排隊等待令牌時會在期限到時放棄，已送出的請求結果會被丟棄
+            self._record(started, "timeouts")
+            return self._fallback(documents, query, f"逾時 ({self.timeout} 秒)")
+        except Exception as e:
+            self._record(started, "errors")
+            return self._fallback(documents, query, f"出錯 ({str(e)})")
+        self._record(started)
+        return results
+
+    async def acompress_documents(
+        self,
+        documents: Sequence[Document],
+        query: str,
+        callbacks: Optional[Callbacks] = None,
+    ) -> Sequence[Document]:
+        documents = list(documents[:self.max_candidates])
+        if not documents:
+            return []
+        started = time.perf_counter()
+        try:
+            # 預設的 acompress_documents 在執行緒中執行，wait_for 逾時後排隊中的令牌請求也依期限放棄
+            with request_deadline(self._deadline()):
+                results = list(await asyncio.wait_for(
+                    self.reranker.acompress_documents(documents, query), timeout=self.timeout
+                ))
+        except (asyncio.TimeoutError, RateLimitTimeout):
+            self._record(started, "timeouts")
+            return self._fallback(documents, query, f"逾時 ({self.timeout} 秒)")
+        except Exception as e:
+            self._record(started, "errors")
+            return self._fallback(documents, query, f"出錯 ({str(e)})")
+        self._record(started)
+        return results
+
+    def stats(self):
+        """取得重新排序的統計數據"""
+        with self._lock:
+            calls = self._stats["calls"]
+            return {
+                "reranker": type(self.reranker).__name__,
+                "calls": calls,
+                "timeouts": self._stats["timeouts"],
+                "errors": self._stats["errors"],
+                "avg_ms": self._stats["total_seconds"] * 1000 / calls if calls else 0.0,
+            }
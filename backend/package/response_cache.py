@@ -0,0 +1,165 @@
+from concurrent.futures import Future
+import asyncio
+import re
+import threading
+import unicodedata
+import logging
+
+# 設置日誌
+logger = logging.getLogger(__name__)
+
+# 繁簡轉換 (選用)，未安裝 opencc 時使用內建的常用字對照表
+try:
+    from opencc import OpenCC
+    _opencc = OpenCC("s2t")
+except ImportError:
+    _opencc = None
+
+# 意義相同的異體字，統一為同一個字 (只用於產生快取鍵)
+_VARIANT_CHARS = {
+    "臺": "台", "温": "溫", "峯": "峰", "裏": "裡", "綫": "線", "爲": "為", "衆": "眾", "羣": "群",
+}
+_VARIANT_TABLE = str.maketrans(_VARIANT_CHARS)
+
+# 未安裝 opencc 時使用的常用簡體字對照表，只收錄不是繁體正字的簡體字；
+# 「游、划、云、几、么、术、适」等同時是繁體正字的字不轉換，避免「游泳」、「划船」被改寫後與其他查詢共用答案
+_SIMPLIFIED_CHARS = {
+    "湾": "灣", "东": "東", "县": "縣", "乡": "鄉", "镇": "鎮",
+    "区": "區", "园": "園", "馆": "館", "庙": "廟", "岛": "島", "桥": "橋", "车": "車",
+    "铁": "鐵", "场": "場", "门": "門", "观": "觀", "点": "點", "荐": "薦",
+    "吗": "嗎", "这": "這", "个": "個", "们": "們", "亲": "親", "饭": "飯",
+    "厅": "廳", "爱": "愛", "带": "帶", "儿": "兒", "时": "時", "间": "間",
+    "两": "兩", "规": "規", "计": "計", "过": "過", "还": "還",
+    "远": "遠", "边": "邊", "阳": "陽", "兰": "蘭", "义": "義", "龙": "龍", "凤": "鳳",
+    "丽": "麗", "雾": "霧", "风": "風", "梦": "夢", "农": "農", "历": "歷",
+    "艺": "藝", "画": "畫", "书": "書", "电": "電", "乐": "樂", "动": "動",
+    "访": "訪", "问": "問", "宫": "宮", "营": "營", "骑": "騎", "买": "買", "体": "體",
+}
+_SIMPLIFIED_TABLE = str.maketrans(_SIMPLIFIED_CHARS)
+
+# 查詢結尾常見的標點，不影響查詢意圖
+_TRAILING_PUNCTUATION = re.compile(r"[\s?!.,;:~。？！，、；：～]+$")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_query(query):
+    """
+    將查詢字串正規化為快取鍵
+
+    全形轉半形 (NFKC)、統一大小寫與空白、去除結尾標點，並將簡體字轉為繁體、統一異體字，
+    讓「陽明山景點推薦？」與「阳明山 景点推荐?」得到相同的鍵。
+    """
+    text = unicodedata.normalize("NFKC", query)
+    if _opencc is not None:
+        text = _opencc.convert(text)
+    else:
+        text = text.translate(_SIMPLIFIED_TABLE)
+    # opencc 不會處理「臺/台」這類異體字，仍需套用對照表
+    text = text.translate(_VARIANT_TABLE)
+    text = _WHITESPACE.sub(" ", text).strip().lower()
+    text = _TRAILING_PUNCTUATION.sub("", text)
+    # 中文字之間的空白沒有意義
+    text = re.sub(r"(?<=[^\x00-\x7f]) (?=[^\x00-\x7f])", "", text)
+    return text
+
+
+class InflightCoalescer:
+    """
+    合併同時進行中的相同請求
+
+    相同鍵的請求同時抵達時，只有第一個請求實際執行，其餘請求等待並共用同一個結果。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._futures = {}
+        # key -> [task, 等待中的請求數]
+        self._tasks = {}
+
+        # 統計數據
+        self.leaders = 0
+        self.coalesced = 0
+
+    def run(self, key, func):
+        """
+        同步執行 func，相同鍵的請求正在執行時等待其結果
+
+        Args:
+            key: 請求鍵
+            func: 無參數的同步函式
+
+        Returns:
+            func 的回傳值
+        """
+        with self._lock:
+            future = self._futures.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = Future()
+                self._futures[key] = future
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+
+        if not is_leader:
+            logger.info(f"合併相同的進行中查詢: {key}")
+            return future.result()
+
+        try:
+            result = func()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._futures.pop(key, None)
+
+    async def arun(self, key, coro_func):
+        """
+        非同步執行 coro_func，相同鍵的請求正在執行時等待其結果
+
+        所有等待者都被取消時 (例如逾時) 才取消實際執行的工作。
+
+        Args:
+            key: 請求鍵
+            coro_func: 無參數的協程函式
+
+        Returns:
+            協程的回傳值
+        """
+        entry = self._tasks.get(key)
+        if entry is None:
+            task = asyncio.ensure_future(coro_func())
+            entry = [task, 0]
+            self._tasks[key] = entry
+            self.leaders += 1
+
+            def remove_entry(_task):
+                if self._tasks.get(key) is entry:
+                    del self._tasks[key]
+
+            task.add_done_callback(remove_entry)
+        else:
+            self.coalesced += 1
+            logger.info(f"合併相同的進行中查詢: {key}")
+
+        entry[1] += 1
+        try:
+            return await asyncio.shield(entry[0])
+        except asyncio.CancelledError:
+            # 最後一個等待者離開時取消實際執行的工作
+            if entry[1] == 1:
+                entry[0].cancel()
+            raise
+        finally:
+            entry[1] -= 1
+
+    def stats(self):
+        """取得合併統計數據"""
+        return {
+            "in_flight": len(self._futures) + len(self._tasks),
+            "executed": self.leaders,
+            "coalesced": self.coalesced,
+        }
@@ -0,0 +1,323 @@
+from concurrent.futures import ThreadPoolExecutor
+from langchain_core.callbacks import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from typing import Any, List
+import asyncio
+import threading
+import time
+import logging
+import numpy as np
+
+from .fusion import HybridFusion
+from .metadata_filter import build_where
+
+# 設置日誌
+logger = logging.getLogger(__name__)
+
+# 檢索流程的各個階段，依序執行 (dense 與 sparse 同時進行)
+STAGES = ("filter", "expand", "embed", "dense", "sparse", "fuse", "rerank", "pack", "total")
+
+
+class RetrievalExecutor:
+    """
+    多查詢檢索的執行器
+
+    取代 MultiQueryRetriever → EnsembleRetriever → CohereRerank 的串列流程：
+    所有子查詢一次批次嵌入，向量與 BM25 搜尋同時進行，候選區塊依 ID 去重並由 HybridFusion 合併後，
+    只為合併後的候選區塊建立文件並送出一次重新排序請求。每個階段的耗時會記錄在日誌與統計數據中。
+    查詢提到地點或類別時，先以結構化欄位過濾再搜尋 (沒有符合的區塊時不過濾)。
+    """
+
+    def __init__(self, vector_store, embeddings, sparse_index=None, fetch_documents=None, expander=None,
+                 reranker=None, fusion=None, top_n=10, max_workers=4,
+                 catalog=None, metadata_index=None, dense_index=None, packer=None):
+        """
+        初始化執行器
+
+        Args:
+            vector_store: Chroma 向量資料庫
+            embeddings: 嵌入模型
+            sparse_index: SparseIndex，None 時只使用向量檢索
+            fetch_documents: 依區塊 ID 取得文件的函式，用於只出現在 BM25 結果中的區塊
+            expander: QueryExpander，None 時只使用原始查詢
+            reranker: 重新排序器 (BaseDocumentCompressor)，None 時依合併分數排序
+            fusion: HybridFusion，設定合併方式與兩種檢索的深度，None 時使用加權 RRF (0.8/0.2)
+            top_n: 沒有重新排序器時回傳的區塊數量
+            max_workers: 同時進行搜尋的執行緒數量
+            catalog: AttractionCatalog，用來從查詢解析過濾條件，None 時不過濾
+            metadata_index: MetadataIndex，用來確認過濾條件有符合的區塊並限制 BM25 的搜尋範圍
+            dense_index: DenseIndex，提供時以 numpy 矩陣做向量檢索，不經過 Chroma
+            packer: ContextPacker，重新排序後合併、去重並依 token 預算截取，None 時不處理
+        """
+        self.vector_store = vector_store
+        self.embeddings = embeddings
+        self.sparse_index = sparse_index
+        # dense_index 本身可以依區塊 ID 取得文件
+        if fetch_documents is None and dense_index is not None:
+            fetch_documents = dense_index.fetch_documents
+        self.fetch_documents = fetch_documents
+        self.reranker = reranker
+        self.fusion = fusion or HybridFusion()
+        self.top_n = top_n
+        self.expander = expander
+        self.catalog = catalog
+        self.metadata_index = metadata_index
+        self.dense_index = dense_index
+        self.packer = packer
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="retrieval")
+
+        # 統計數據
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.filtered = 0
+        self._stage_seconds = {stage: 0.0 for stage in STAGES}
+
+    def expand(self, query):
+        """產生子查詢"""
+        if self.expander is None:
+            return [query]
+        return self.expander.expand(query)
+
+    async def aexpand(self, query):
+        """非同步產生子查詢"""
+        if self.expander is None:
+            return [query]
+        return await self.expander.aexpand(query)
+
+    def plan_filters(self, query):
+        """
+        從查詢解析結構化欄位的過濾條件
+
+        Returns:
+            tuple: (Chroma where 條件, BM25 可搜尋的區塊位置)，不過濾時皆為 None
+        """
+        if self.catalog is None or self.metadata_index is None:
+            return None, None
+        filters = self.catalog.parse_filters(query)
+        allowed = self.metadata_index.resolve(filters) if filters else None
+        if allowed is not None and len(allowed) == 0 and "category" in filters:
+            # 地點與類別同時成立的區塊不存在時只依地點過濾
+            filters.pop("category")
+            allowed = self.metadata_index.resolve(filters) if filters else None
+        if allowed is None or len(allowed) == 0:
+            return None, None
+        logger.info(f"檢索前過濾: {filters}，{len(allowed)} 個區塊")
+        return build_where(filters), allowed
+
+    def embed(self, queries):
+        """一次批次嵌入所有子查詢 (CachedEmbeddings 會加上查詢前綴並略過已快取的子查詢)"""
+        embed_queries = getattr(self.embeddings, "embed_queries", None)
+        if embed_queries is not None:
+            return embed_queries(queries)
+        return [self.embeddings.embed_query(query) for query in queries]
+
+    def dense_search(self, vectors, where=None, allowed=None):
+        """
+        向量檢索，所有子查詢合併為一次 Chroma 查詢 (或一次矩陣乘法)
+
+        Args:
+            vectors: 子查詢向量
+            where: Chroma where 過濾條件
+            allowed: 可搜尋的區塊位置，使用 dense_index 時取代 where
+
+        Returns:
+            tuple: ([每個子查詢的 (區塊 ID, 分數)], {區塊 ID: 文件})，dense_index 時文件在合併後才取得
+        """
+        if self.dense_index is not None:
+            return [
+                (self.dense_index.chunk_ids[positions], scores)
+                for positions, scores in self.dense_index.search(vectors, self.fusion.dense_depth, allowed)
+            ], {}
+
+        result = self.vector_store._collection.query(
+            query_embeddings=[list(map(float, vector)) for vector in vectors],
+            n_results=self.fusion.dense_depth,
+            where=where,
+            include=["documents", "metadatas", "distances"]
+        )
+        rankings = []
+        documents = {}
+        for ids, contents, metadatas, distances in zip(
+            result["ids"], result["documents"], result["metadatas"], result["distances"]
+        ):
+            # 距離越小越相似，取負值作為分數
+            rankings.append((ids, -np.asarray(distances, dtype=np.float32)))
+            for chunk_id, content, metadata in zip(ids, contents, metadatas):
+                documents[chunk_id] = Document(page_content=content, metadata=metadata or {})
+        return rankings, documents
+
+    def sparse_search(self, queries, allowed=None):
+        """BM25 檢索，回傳每個子查詢的 (區塊 ID, 分數)，allowed 為可搜尋的區塊位置"""
+        if self.sparse_index is None or self.fusion.sparse_depth <= 0:
+            return []
+        return [self.sparse_index.search(query, self.fusion.sparse_depth, allowed) for query in queries]
+
+    def fuse(self, dense_rankings, sparse_rankings, documents):
+        """
+        合併所有子查詢的結果並依區塊 ID 去重
+
+        Returns:
+            list: 依合併分數排序的候選文件 (最多 fusion.top_n 個)
+        """
+        ordered_ids = [str(chunk_id) for chunk_id in self.fusion.fuse(dense_rankings, sparse_rankings)[0]]
+
+        # 向量檢索未附內容 (dense_index) 或只出現在 BM25 結果中的區塊需要另外取得內容
+        missing_ids = [chunk_id for chunk_id in ordered_ids if chunk_id not in documents]
+        if missing_ids and self.fetch_documents is not None:
+            for document in self.fetch_documents(missing_ids):
+                documents[document.metadata.get("chunk_id")] = document
+        return [documents[chunk_id] for chunk_id in ordered_ids if chunk_id in documents]
+
+    def _record(self, timings, query_count, candidate_count, filtered=False):
+        """記錄各階段耗時"""
+        with self._lock:
+            self.calls += 1
+            self.filtered += int(filtered)
+            for stage, seconds in timings.items():
+                self._stage_seconds[stage] += seconds
+        logger.info(
+            f"檢索完成: {query_count} 個子查詢、{candidate_count} 個候選區塊，各階段耗時 (ms) "
+            + ", ".join(f"{stage}={seconds * 1000:.1f}" for stage, seconds in timings.items())
+        )
+
+    def retrieve(self, query):
+        """
+        檢索相關文件
+
+        Args:
+            query: 使用者查詢
+
+        Returns:
+            list: 重新排序後的文件
+        """
+        timings = {}
+        started = last = time.perf_counter()
+
+        def mark(stage):
+            nonlocal last
+            now = time.perf_counter()
+            timings[stage] = now - last
+            last = now
+
+        where, allowed = self.plan_filters(query)
+        mark("filter")
+        queries = self.expand(query)
+        mark("expand")
+
+        # BM25 不需要向量，與嵌入及向量檢索同時進行
+        sparse_future = self._executor.submit(self._timed, self.sparse_search, queries, allowed)
+        vectors = self.embed(queries)
+        mark("embed")
+        dense_rankings, documents = self.dense_search(vectors, where, allowed)
+        mark("dense")
+        sparse_rankings, timings["sparse"] = sparse_future.result()
+        last = time.perf_counter()
+
+        candidates = self.fuse(dense_rankings, sparse_rankings, documents)
+        mark("fuse")
+        results = self.rerank(candidates, query)
+        mark("rerank")
+        results = self.pack(results)
+        mark("pack")
+
+        timings["total"] = time.perf_counter() - started
+        self._record(timings, len(queries), len(candidates), where is not None)
+        return results
+
+    async def aretrieve(self, query):
+        """非同步檢索相關文件，嵌入與搜尋在執行緒中進行，不阻塞事件迴圈"""
+        timings = {}
+        started = last = time.perf_counter()
+
+        def mark(stage):
+            nonlocal last
+            now = time.perf_counter()
+            timings[stage] = now - last
+            last = now
+
+        where, allowed = self.plan_filters(query)
+        mark("filter")
+        queries = await self.aexpand(query)
+        mark("expand")
+
+        loop = asyncio.get_running_loop()
+        sparse_future = loop.run_in_executor(self._executor, self._timed, self.sparse_search, queries, allowed)
+        vectors = await loop.run_in_executor(self._executor, self.embed, queries)
+        mark("embed")
+        dense_rankings, documents = await loop.run_in_executor(
+            self._executor, self.dense_search, vectors, where, allowed
+        )
+        mark("dense")
+        sparse_rankings, timings["sparse"] = await sparse_future
+        last = time.perf_counter()
+
+        candidates = await loop.run_in_executor(
+            self._executor, self.fuse, dense_rankings, sparse_rankings, documents
+        )
+        mark("fuse")
+        results = await self.arerank(candidates, query)
+        mark("rerank")
+        results = self.pack(results)
+        mark("pack")
+
+        timings["total"] = time.perf_counter() - started
+        self._record(timings, len(queries), len(candidates), where is not None)
+        return results
+
+    @staticmethod
+    def _timed(func, *args):
+        started = time.perf_counter()
+        return func(*args), time.perf_counter() - started
+
+    def rerank(self, candidates, query):
+        """所有候選區塊只送出一次重新排序請求"""
+        if self.reranker is None or not candidates:
+            return candidates[:self.top_n]
+        return list(self.reranker.compress_documents(candidates, query))
+
+    async def arerank(self, candidates, query):
+        """非同步重新排序"""
+        if self.reranker is None or not candidates:
+            return candidates[:self.top_n]
+        return list(await self.reranker.acompress_documents(candidates, query))
+
+    def pack(self, documents):
+        """組合放入提示的內容"""
+        if self.packer is None:
+            return documents
+        return self.packer.pack(documents)
+
+    def stats(self):
+        """取得各階段的平均耗時 (毫秒)"""
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "filtered": self.filtered,
+                "fusion": self.fusion.config(),
+                "avg_ms": {
+                    stage: seconds * 1000 / self.calls if self.calls else 0.0
+                    for stage, seconds in self._stage_seconds.items()
+                },
+            }
+
+    def shutdown(self):
+        """關閉搜尋執行緒"""
+        self._executor.shutdown(wait=False)
+
+
+class ExecutorRetriever(BaseRetriever):
+    """將 RetrievalExecutor 包裝為 langchain 檢索器，可直接放入 RetrievalQA"""
+
+    executor: Any
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        return self.executor.retrieve(query)
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        return await self.executor.aretrieve(query)
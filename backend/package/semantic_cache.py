@@ -0,0 +1,270 @@
+from collections import OrderedDict
+import json
+import sqlite3
+import threading
+import time
+import logging
+import numpy as np
+
+# 設置日誌
+logger = logging.getLogger(__name__)
+
+
+class SemanticCache:
+    """
+    語意快取，以查詢向量的餘弦相似度比對相近的問題並直接回傳先前的答案
+
+    快取項目存放在連續的 float32 矩陣中，一次矩陣乘法即可比對所有項目；
+    依 TTL 過期，超過數量上限時淘汰最久未使用的項目 (LRU)。
+    項目可指定分區 (例如查詢解析出的縣市與類別)，只在同一分區內比對，
+    避免只差在地名的查詢 (「臺南有什麼景點」與「臺北有什麼景點」) 因向量相近而共用答案。
+    可選擇以 SQLite 持久化，重啟後保留快取內容。
+
+    多個 worker 共用同一個 SQLite 檔案時，列 id 由 SQLite 分配 (AUTOINCREMENT，不重複使用)，
+    淘汰時只刪除本行程寫入的列，其他 worker 仍在記憶體中使用的項目只在過期或指紋改變後刪除。
+    """
+
+    def __init__(self, threshold=0.95, ttl_seconds=86400, max_entries=1000, db_path=None, fingerprint="",
+                 busy_timeout_ms=1000):
+        """
+        初始化語意快取
+
+        Args:
+            threshold: 命中所需的最低餘弦相似度
+            ttl_seconds: 快取項目的存活秒數
+            max_entries: 快取項目數量上限
+            db_path: SQLite 檔案路徑，None 表示只使用記憶體
+            fingerprint: 資料與提示模板的指紋，指紋不同的快取項目會被清除
+            busy_timeout_ms: 其他 worker 佔用 SQLite 寫入鎖時的等待毫秒數，逾時只略過該次寫入
+        """
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.db_path = db_path
+        self.fingerprint = fingerprint
+        self.busy_timeout_ms = busy_timeout_ms
+
+        self._lock = threading.Lock()
+        # key -> (矩陣中的位置, 查詢, 答案, 來源, 建立時間)，順序即為 LRU 順序
+        self._entries = OrderedDict()
+        self._vectors = None
+        self._slot_keys = [None] * max_entries
+        self._slot_partitions = np.full(max_entries, None, dtype=object)
+        self._free_slots = list(range(max_entries - 1, -1, -1))
+        # 只存在記憶體的項目使用負數 key，不會與資料表的列 id 重複
+        self._next_memory_key = -1
+        # 本行程寫入資料表的列 id
+        self._own_keys = set()
+
+        # 統計數據
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._conn = None
+        if db_path:
+            self._open_db()
+
+    def _open_db(self):
+        """開啟 SQLite 持久化資料表並載入有效的快取項目"""
+        try:
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False,
+                                         timeout=self.busy_timeout_ms / 1000)
+            # WAL 模式下讀取不會被其他 worker 的寫入阻塞，寫入之間最多等待 busy_timeout_ms
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+            schema = self._conn.execute(
+                "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'semantic_cache'"
+            ).fetchone()
+            if schema and ("AUTOINCREMENT" not in schema[0] or "partition_key" not in schema[0]):
+                # 舊版由各行程自行分配 id 且沒有分區，快取內容可重建，直接重建資料表
+                self._conn.execute("DROP TABLE semantic_cache")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS semantic_cache (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    query TEXT NOT NULL,
+                    embedding BLOB NOT NULL,
+                    answer TEXT NOT NULL,
+                    sources TEXT NOT NULL,
+                    partition_key TEXT NOT NULL DEFAULT '',
+                    fingerprint TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+                """
+            )
+            # 只清除已過期的項目，指紋不同的項目可能仍被其他 worker 使用，過期後才刪除
+            self._conn.execute(
+                "DELETE FROM semantic_cache WHERE created_at < ?",
+                (time.time() - self.ttl_seconds,)
+            )
+            self._conn.commit()
+
+            rows = self._conn.execute(
+                "SELECT id, query, embedding, answer, sources, partition_key, created_at FROM semantic_cache "
+                "WHERE fingerprint = ? ORDER BY created_at DESC LIMIT ?",
+                (self.fingerprint, self.max_entries)
+            ).fetchall()
+            # 由舊到新載入，讓最新的項目位於 LRU 尾端
+            for row_id, query, embedding, answer, sources, partition, created_at in reversed(rows):
+                vector = np.frombuffer(embedding, dtype=np.float32)
+                self._insert(row_id, query, vector, answer, json.loads(sources), partition, created_at)
+            logger.info(f"已從 {self.db_path} 載入 {len(rows)} 筆語意快取")
+
+        except Exception as e:
+            logger.error(f"開啟語意快取資料庫時出錯: {str(e)}")
+            self._conn = None
+
+    def _insert(self, key, query, vector, answer, sources, partition, created_at):
+        """將項目放入矩陣與 LRU 串列 (呼叫端需持有鎖)"""
+        if self._vectors is None:
+            self._vectors = np.zeros((self.max_entries, vector.shape[0]), dtype=np.float32)
+        slot = self._free_slots.pop()
+        self._vectors[slot] = vector
+        self._slot_keys[slot] = key
+        self._slot_partitions[slot] = partition
+        self._entries[key] = (slot, query, answer, sources, created_at)
+
+    def _remove(self, key, expired=False):
+        """
+        移除項目並歸還矩陣位置 (呼叫端需持有鎖)
+
+        資料表中的列只在本行程寫入或已過期時刪除，其他 worker 寫入的項目由該 worker 淘汰
+        """
+        slot = self._entries.pop(key)[0]
+        self._vectors[slot] = 0.0
+        self._slot_keys[slot] = None
+        self._slot_partitions[slot] = None
+        self._free_slots.append(slot)
+        owned = key in self._own_keys
+        self._own_keys.discard(key)
+        if self._conn is not None and key > 0 and (owned or expired):
+            try:
+                self._conn.execute("DELETE FROM semantic_cache WHERE id = ?", (key,))
+                self._conn.commit()
+            except Exception as e:
+                logger.error(f"刪除語意快取資料庫項目時出錯: {str(e)}")
+
+    def lookup(self, vector, partition=""):
+        """
+        查詢語意相近的快取答案
+
+        Args:
+            vector: 已正規化的查詢向量
+            partition: 分區，只比對同一分區的項目
+
+        Returns:
+            tuple: (答案, 來源列表)，未命中時回傳 None
+        """
+        vector = np.asarray(vector, dtype=np.float32)
+        with self._lock:
+            if not self._entries:
+                self.misses += 1
+                return None
+
+            # 已正規化向量的內積即為餘弦相似度，空位置與其他分區的項目不會命中
+            scores = self._vectors @ vector
+            scores[self._slot_partitions != partition] = -np.inf
+            slot = int(np.argmax(scores))
+            key = self._slot_keys[slot]
+            if key is None or scores[slot] < self.threshold:
+                self.misses += 1
+                return None
+
+            _, query, answer, sources, created_at = self._entries[key]
+            if time.time() - created_at > self.ttl_seconds:
+                self._remove(key, expired=True)
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            logger.info(f"語意快取命中 (相似度 {scores[slot]:.3f}): {query}")
+            return answer, sources
+
+    def store(self, query, vector, answer, sources=None, partition=""):
+        """
+        寫入快取
+
+        Args:
+            query: 原始查詢字串
+            vector: 已正規化的查詢向量
+            answer: 回答內容
+            sources: 檢索來源資訊列表
+            partition: 分區，只有同一分區的查詢會命中
+        """
+        vector = np.asarray(vector, dtype=np.float32)
+        sources = sources or []
+        created_at = time.time()
+        with self._lock:
+            # 超過上限時淘汰最久未使用的項目
+            while len(self._entries) >= self.max_entries:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self.evictions += 1
+
+            key = None
+            if self._conn is not None:
+                try:
+                    cursor = self._conn.execute(
+                        "INSERT INTO semantic_cache "
+                        "(query, embedding, answer, sources, partition_key, fingerprint, created_at) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (query, vector.tobytes(), answer, json.dumps(sources, ensure_ascii=False),
+                         partition, self.fingerprint, created_at)
+                    )
+                    self._conn.commit()
+                    key = cursor.lastrowid
+                    self._own_keys.add(key)
+                except Exception as e:
+                    logger.error(f"寫入語意快取資料庫時出錯: {str(e)}")
+            if key is None:
+                key = self._next_memory_key
+                self._next_memory_key -= 1
+            self._insert(key, query, vector, answer, sources, partition, created_at)
+
+    def set_fingerprint(self, fingerprint):
+        """更新資料與提示模板的指紋，指紋改變時清空快取"""
+        with self._lock:
+            if fingerprint == self.fingerprint:
+                return
+            previous = self.fingerprint
+            self.fingerprint = fingerprint
+            self._clear(previous)
+        logger.info("資料或提示模板已變更，語意快取已清空")
+
+    def clear(self):
+        """清空快取"""
+        with self._lock:
+            self._clear(self.fingerprint)
+
+    def _clear(self, fingerprint):
+        """清空快取並刪除資料表中該指紋的項目，其他指紋的項目留給仍在使用的 worker (呼叫端需持有鎖)"""
+        self._entries.clear()
+        self._vectors = None
+        self._slot_keys = [None] * self.max_entries
+        self._slot_partitions = np.full(self.max_entries, None, dtype=object)
+        self._free_slots = list(range(self.max_entries - 1, -1, -1))
+        self._own_keys.clear()
+        if self._conn is not None:
+            try:
+                self._conn.execute("DELETE FROM semantic_cache WHERE fingerprint = ?", (fingerprint,))
+                self._conn.commit()
+            except Exception as e:
+                logger.error(f"清空語意快取資料庫時出錯: {str(e)}")
+
+    def stats(self):
+        """取得快取統計數據"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "evictions": self.evictions,
+                "threshold": self.threshold,
+                "persistent": self._conn is not None,
+            }
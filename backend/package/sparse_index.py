@@ -0,0 +1,302 @@
+from langchain_core.documents import Document
+import json
+import os
+import re
+import shutil
+import time
+import unicodedata
+import logging
+import numpy as np
+
+from .attraction_catalog import METADATA_VERSION, STRUCTURED_FIELDS
+from .metadata_filter import MetadataIndex
+
+# 設置日誌
+logger = logging.getLogger(__name__)
+
+# 稀疏索引存放目錄名稱，放在向量資料庫目錄中
+SPARSE_INDEX_DIRNAME = "bm25_index"
+
+# 分詞方式改變時需要重建索引
+TOKENIZER_VERSION = "cjk-bigram-v1"
+
+# BM25 參數
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# 英數詞彙的最大長度，超過的部分截斷 (詞彙表以固定寬度字串陣列存放)
+MAX_WORD_LENGTH = 24
+
+# 中文 (含日文假名) 連續字元與英數詞彙
+_CJK_RUN = re.compile(r"[぀-ヿ㐀-䶿一-鿿豈-﫿]+")
+_WORD = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text):
+    """
+    將文字切分為詞彙
+
+    中文以相鄰兩字 (bigram) 為詞彙，單獨一個字時保留單字；英文與數字以連續的英數字為詞彙。
+    """
+    text = unicodedata.normalize("NFKC", text).lower()
+    tokens = []
+    for run in _CJK_RUN.findall(text):
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    tokens.extend(word[:MAX_WORD_LENGTH] for word in _WORD.findall(_CJK_RUN.sub(" ", text)))
+    return tokens
+
+
+def _iter_collection(vector_store, batch_size=5000):
+    """分批讀取向量資料庫中所有區塊的 ID、內容與 metadata"""
+    offset = 0
+    while True:
+        result = vector_store.get(include=["documents", "metadatas"], limit=batch_size, offset=offset)
+        ids = result["ids"]
+        if not ids:
+            return
+        yield from zip(ids, result["documents"], result["metadatas"])
+        offset += len(ids)
+
+
+class SparseIndex:
+    """
+    以 CSR 陣列存放的 BM25 索引
+
+    詞彙表依字典序排列，每個詞彙對應 postings 中的一段 (indptr[t]:indptr[t + 1])，
+    記錄出現的區塊位置與預先計算好的 BM25 權重 (idf 與文件長度正規化都已包含在內)，
+    查詢時只需取出各詞彙的片段加總。所有陣列以 mmap 載入，啟動時間不隨資料量增加。
+    """
+
+    FILES = ("terms", "indptr", "postings", "weights", "chunk_ids")
+
+    def __init__(self, terms, indptr, postings, weights, chunk_ids, meta):
+        self.terms = terms
+        self.indptr = indptr
+        self.postings = postings
+        self.weights = weights
+        self.chunk_ids = chunk_ids
+        self.meta = meta
+
+    def __len__(self):
+        return len(self.chunk_ids)
+
+    @classmethod
+    def build(cls, items, k1=BM25_K1, b=BM25_B, meta=None):
+        """
+        從區塊建立索引
+
+        Args:
+            items: [(chunk_id, 內容)]，可以是產生器
+            k1: BM25 詞頻飽和參數
+            b: BM25 文件長度正規化參數
+            meta: 額外記錄在索引中的資訊 (例如來源檔案雜湊)
+
+        Returns:
+            SparseIndex: 存放在記憶體中的索引
+        """
+        chunk_ids = []
+        doc_lengths = []
+        # 詞彙 -> ([區塊位置], [詞頻])
+        postings = {}
+        for doc_index, (chunk_id, text) in enumerate(items):
+            chunk_ids.append(chunk_id)
+            tokens = tokenize(text or "")
+            doc_lengths.append(len(tokens))
+            counts = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for token, count in counts.items():
+                entry = postings.setdefault(token, ([], []))
+                entry[0].append(doc_index)
+                entry[1].append(count)
+
+        n_docs = len(chunk_ids)
+        doc_lengths = np.asarray(doc_lengths, dtype=np.float32)
+        avg_length = float(doc_lengths.mean()) if n_docs else 0.0
+
+        terms = sorted(postings)
+        indptr = np.zeros(len(terms) + 1, dtype=np.int64)
+        for i, term in enumerate(terms):
+            indptr[i + 1] = indptr[i] + len(postings[term][0])
+        doc_array = np.empty(indptr[-1], dtype=np.int32)
+        weights = np.empty(indptr[-1], dtype=np.float32)
+
+        norm = k1 * (1 - b + b * doc_lengths / avg_length) if n_docs else doc_lengths
+        for i, term in enumerate(terms):
+            docs, counts = postings[term]
+            docs = np.asarray(docs, dtype=np.int32)
+            tf = np.asarray(counts, dtype=np.float32)
+            # BM25Okapi 的 idf
+            idf = np.log((n_docs - len(docs) + 0.5) / (len(docs) + 0.5) + 1)
+            start, end = indptr[i], indptr[i + 1]
+            doc_array[start:end] = docs
+            weights[start:end] = idf * tf * (k1 + 1) / (tf + norm[docs])
+
+        meta = dict(meta or {})
+        meta.update({
+            "tokenizer": TOKENIZER_VERSION,
+            "k1": k1,
+            "b": b,
+            "documents": n_docs,
+            "terms": len(terms),
+            "avg_length": avg_length,
+        })
+        return cls(
+            terms=np.asarray(terms, dtype=f"<U{max([len(t) for t in terms] or [1])}"),
+            indptr=indptr,
+            postings=doc_array,
+            weights=weights,
+            chunk_ids=np.asarray(chunk_ids, dtype=f"<U{max([len(c) for c in chunk_ids] or [1])}"),
+            meta=meta
+        )
+
+    def save(self, index_dir):
+        """寫入索引目錄 (先寫入暫存目錄再取代，避免中斷時留下不完整的索引)"""
+        tmp_dir = f"{index_dir}.tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        for name in self.FILES:
+            np.save(os.path.join(tmp_dir, f"{name}.npy"), getattr(self, name))
+        with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(self.meta, f, ensure_ascii=False)
+        shutil.rmtree(index_dir, ignore_errors=True)
+        os.replace(tmp_dir, index_dir)
+
+    @classmethod
+    def load(cls, index_dir, mmap=True):
+        """以 mmap 載入索引，目錄不存在或格式錯誤時回傳 None"""
+        try:
+            with open(os.path.join(index_dir, "meta.json"), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            arrays = {
+                name: np.load(os.path.join(index_dir, f"{name}.npy"), mmap_mode="r" if mmap else None)
+                for name in cls.FILES
+            }
+            return cls(meta=meta, **arrays)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.error(f"載入稀疏索引時出錯: {str(e)}")
+            return None
+
+    def search(self, query, k=10, allowed=None):
+        """
+        以 BM25 搜尋
+
+        Args:
+            query: 查詢字串
+            k: 回傳的區塊數量
+            allowed: 限制搜尋範圍的區塊位置 (排序後的陣列)，None 表示不限制
+
+        Returns:
+            tuple: (區塊 ID 陣列, 分數陣列)，依分數由高到低排列
+        """
+        tokens = tokenize(query)
+        if not tokens or len(self.terms) == 0:
+            return np.empty(0, dtype=self.chunk_ids.dtype), np.empty(0, dtype=np.float32)
+
+        query_terms, query_counts = np.unique(np.asarray(tokens), return_counts=True)
+        positions = np.searchsorted(self.terms, query_terms)
+        positions = np.minimum(positions, len(self.terms) - 1)
+        found = self.terms[positions] == query_terms
+        positions, query_counts = positions[found], query_counts[found]
+        if len(positions) == 0:
+            return np.empty(0, dtype=self.chunk_ids.dtype), np.empty(0, dtype=np.float32)
+
+        starts, ends = self.indptr[positions], self.indptr[positions + 1]
+        docs = np.concatenate([self.postings[s:e] for s, e in zip(starts, ends)])
+        contributions = np.concatenate([
+            self.weights[s:e] * count for s, e, count in zip(starts, ends, query_counts)
+        ])
+
+        if allowed is not None:
+            keep = np.isin(docs, allowed, assume_unique=False)
+            docs, contributions = docs[keep], contributions[keep]
+            if len(docs) == 0:
+                return np.empty(0, dtype=self.chunk_ids.dtype), np.empty(0, dtype=np.float32)
+
+        # 只在出現過查詢詞彙的區塊上累加分數
+        candidates, inverse = np.unique(docs, return_inverse=True)
+        scores = np.bincount(inverse, weights=contributions).astype(np.float32)
+        if len(scores) > k:
+            top = np.argpartition(-scores, k)[:k]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return self.chunk_ids[candidates[top]], scores[top]
+
+
+def build_sparse_index(vector_store, index_dir, source_sha256=None):
+    """
+    依向量資料庫中的區塊建立稀疏索引，與向量檢索使用相同的區塊 ID
+
+    同時建立結構化欄位的反向索引 (MetadataIndex)，區塊位置與稀疏索引相同。
+
+    Args:
+        vector_store: Chroma 向量資料庫
+        index_dir: 索引目錄
+        source_sha256: 資料檔雜湊，用來判斷索引是否需要重建
+
+    Returns:
+        SparseIndex: 以 mmap 重新載入的索引
+    """
+    started = time.perf_counter()
+    metadatas = []
+
+    def items():
+        for chunk_id, text, metadata in _iter_collection(vector_store):
+            metadatas.append(metadata)
+            yield chunk_id, text
+
+    index = SparseIndex.build(
+        items(),
+        meta={"source_sha256": source_sha256, "metadata_fields": list(STRUCTURED_FIELDS),
+              "metadata_version": METADATA_VERSION}
+    )
+    index.save(index_dir)
+    MetadataIndex.build(metadatas).save(index_dir)
+    logger.info(
+        f"稀疏索引已建立: {index.meta['documents']} 個區塊、{index.meta['terms']} 個詞彙，"
+        f"耗時 {time.perf_counter() - started:.2f} 秒"
+    )
+    return SparseIndex.load(index_dir)
+
+
+def load_fresh_sparse_index(index_dir, source_sha256):
+    """載入與資料檔相符的稀疏索引 (不開啟向量資料庫)，不存在或不符時回傳 None"""
+    index = SparseIndex.load(index_dir)
+    if (index is not None
+            and index.meta.get("source_sha256") == source_sha256
+            and index.meta.get("tokenizer") == TOKENIZER_VERSION
+            and index.meta.get("metadata_fields") == list(STRUCTURED_FIELDS)
+            and index.meta.get("metadata_version") == METADATA_VERSION
+            and MetadataIndex.load(index_dir) is not None):
+        return index
+    return None
+
+
+def ensure_sparse_index(vector_store, index_dir, source_sha256):
+    """載入稀疏索引，不存在或與資料檔不符時重新建立"""
+    index = load_fresh_sparse_index(index_dir, source_sha256)
+    if index is not None:
+        return index
+    return build_sparse_index(vector_store, index_dir, source_sha256)
+
+
+def chroma_document_fetcher(vector_store):
+    """建立依區塊 ID 從 Chroma 取得文件的函式，回傳順序與 ID 順序相同"""
+
+    def fetch_documents(chunk_ids):
+        if not chunk_ids:
+            return []
+        result = vector_store.get(ids=list(chunk_ids), include=["documents", "metadatas"])
+        by_id = {
+            chunk_id: Document(page_content=content, metadata=metadata or {})
+            for chunk_id, content, metadata in zip(result["ids"], result["documents"], result["metadatas"])
+        }
+        return [by_id[chunk_id] for chunk_id in chunk_ids if chunk_id in by_id]
+
+    return fetch_documents
@@ -1,18 +1,44 @@
-from langchain_community.document_loaders import PyPDFLoader, TextLoader, CSVLoader
+from langchain_community.document_loaders import PyPDFLoader, TextLoader
 from langchain_chroma import Chroma
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.chains import RetrievalQA
 from langchain.prompts import PromptTemplate
-from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
-from sentence_transformers import SentenceTransformer
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain.retrievers import EnsembleRetriever
-from langchain_community.retrievers import BM25Retriever
-from langchain.retrievers.multi_query import MultiQueryRetriever
-from langchain_core.rate_limiters import InMemoryRateLimiter
+from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_cohere import CohereRerank
-from langchain.retrievers import ContextualCompressionRetriever
-import torch
+from .attraction_catalog import AttractionCatalog
+from .embedding_cache import CachedEmbeddings
+from .context_packing import ContextPacker
+from .dense_index import DENSE_INDEX_DIRNAME, ensure_dense_index, load_fresh_dense_index
+from .embeddings import create_embeddings, text_prefixes
+from .fusion import HybridFusion
+from .ingest import (
+    CHUNK_OVERLAP,
+    CHUNK_SIZE,
+    EMBEDDING_MODEL_NAME,
+    MANIFEST_FILENAME,
+    SPLIT_SEPARATORS,
+    embedding_fingerprint,
+    build_lock,
+    ingest,
+    is_up_to_date,
+    stream_csv_documents,
+)
+from .rate_limit import (
+    DEFAULT_PRIORITY, RateLimitScheduler, ScheduledChatModel, current_deadline, request_priority
+)
+from .metadata_filter import MetadataIndex
+from .model_server import ModelClient, RemoteCrossEncoder, RemoteEmbeddings
+from .query_expansion import QueryExpander, query_expansion_mode
+from .semantic_cache import SemanticCache
+from .rerank import DEFAULT_CROSS_ENCODER_MODEL, CrossEncoderReranker, TimeoutFallbackReranker, load_cross_encoder
+from .retrieval import ExecutorRetriever, RetrievalExecutor
+from .sparse_index import SPARSE_INDEX_DIRNAME, chroma_document_fetcher, ensure_sparse_index, load_fresh_sparse_index
+from .response_cache import InflightCoalescer, normalize_query
+from .ttl_cache import TTLCache
+from typing import Any, Optional
+import asyncio
+import hashlib
+import json
 import os
 import logging
 
@@ -20,6 +46,37 @@ import logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# 預設的速率限制，Gemini 的兩種用途以每把金鑰計算
+DEFAULT_RATE_LIMITS = {
+    "query_generation": {"requests_per_second": 0.1, "burst": 5},   # 多查詢檢索產生子查詢
+    "answer_generation": {"requests_per_second": 0.15, "burst": 5}, # 生成回答
+    "rerank": {"requests_per_second": 0.16, "burst": 5},            # Cohere 重新排序
+}
+
+# 問答提示模板
+PROMPT_TEMPLATE = """
+            你是一位臺灣旅遊專家，請基於以下資訊回答用戶的旅遊相關問題。
+            如果你不知道答案，請直接說你不知道，不要編造資訊。
+            
+            資訊:
+            {context}
+            
+            用戶問題: {question}
+            
+            請提供詳細、有幫助且符合臺灣當地文化的回答，並盡可能給予具體的建議。
+            如果有多個選擇，請根據場景、用戶喜好和地點的受歡迎程度進行推薦。
+            """
+
+class ScheduledCohereRerank(CohereRerank):
+    """呼叫 Cohere 前先向排程器取得 rerank 令牌，超過呼叫端的等待期限時不送出請求"""
+    
+    scheduler: Optional[Any] = None
+    
+    def compress_documents(self, documents, query, callbacks=None):
+        if self.scheduler is not None:
+            self.scheduler.acquire("rerank", deadline=current_deadline())
+        return super().compress_documents(documents, query, callbacks)
+
 class TravelRAGService:
     """
     台灣旅遊RAG系統，用於處理旅遊相關查詢
@@ -32,10 +89,50 @@ class TravelRAGService:
         Args:
             gemini_api_key: Google Gemini API金鑰
             **kwargs: 其它參數
+                gemini_api_keys: 多把 Gemini API 金鑰，以輪詢方式分配 (預設只使用 gemini_api_key)
+                rate_limits: 各用途的速率限制，格式同 DEFAULT_RATE_LIMITS
+                semantic_cache_enabled: 是否啟用語意快取 (預設 True)
+                semantic_cache_threshold: 語意快取命中所需的相似度 (預設 0.95)
+                semantic_cache_ttl: 語意快取存活秒數 (預設 86400)
+                semantic_cache_max_entries: 語意快取項目上限 (預設 1000)
+                semantic_cache_path: 語意快取 SQLite 檔案路徑，None 表示只使用記憶體
+                response_cache_enabled: 是否啟用完全比對快取 (預設 True)
+                response_cache_ttl: 完全比對快取存活秒數 (預設 3600)
+                response_cache_max_entries: 完全比對快取項目上限 (預設 2000)
+                query_expansion_mode: 預設的查詢擴展方式 llm/local/none (預設 llm)，可在每個請求覆寫
+                reranker_backend: 重新排序方式 cohere/cross_encoder/none (預設 cohere)
+                reranker_model: 本地 cross-encoder 模型名稱
+                reranker_onnx_file: cross-encoder 的 ONNX 模型檔名 (可使用量化版本)，None 表示使用 PyTorch
+                reranker_timeout: 重新排序逾時秒數，逾時時該次請求使用檢索合併後的順序 (預設 10)
+                reranker_max_candidates: 送入重新排序的候選文件上限 (預設 50)
+                metadata_filter_enabled: 查詢提到縣市、鄉鎮市區或類別時是否先過濾再檢索 (預設 True)
+                embedding_backend: 嵌入模型執行方式 torch/onnx/onnx_int8 (預設 torch)
+                embedding_threads: onnx 執行方式使用的執行緒數量，None 表示由 ONNX Runtime 決定
+                query_embedding_cache_size: 查詢向量快取項目上限，0 表示不快取 (預設 4096)
+                query_embedding_cache_ttl: 查詢向量快取存活秒數，None 表示不會過期 (預設 86400)
+                query_embedding_cache_shared_path: 跨 worker 共用的查詢向量快取檔案 (mmap)，None 表示只使用行程內快取
+                vector_backend: 向量檢索方式 chroma/numpy (預設 chroma)，numpy 以 mmap 載入的矩陣做精確搜尋
+                vector_dtype: numpy 向量檢索的矩陣資料型別 float32/float16 (預設 float32)
+                fusion_mode: 向量與 BM25 結果的合併方式 rrf/blend (預設 rrf)
+                fusion_weights: 向量與 BM25 結果的權重 (預設 (0.8, 0.2))
+                fusion_rrf_k: RRF 的平滑常數 (預設 60)
+                fusion_top_n: 合併後送入重新排序的候選區塊數量 (預設與 reranker_max_candidates 相同)
+                retrieval_dense_depth: 每個子查詢的向量檢索區塊數量 (預設 10)
+                retrieval_sparse_depth: 每個子查詢的 BM25 檢索區塊數量，0 表示不使用 BM25 (預設 10)
+                retrieval_top_n: 重新排序 (或不重新排序時依合併分數) 後放入提示的區塊數量 (預設 10)
+                context_packing_enabled: 是否合併、去重並依 token 預算組合提示內容 (預設 True)
+                context_token_budget: 提示內容的 token 上限 (預設 1500)
+                context_min_score_ratio: 重新排序分數低於第一名幾倍的區塊不放入提示 (預設 0.1)
+                model_server_address: 模型伺服器的 Unix socket 路徑，設定時嵌入與 cross-encoder 由模型伺服器計算，
+                    不在本行程載入模型 (多個 worker 共用一份模型)
+                model_server_authkey: 模型伺服器的連線金鑰 (bytes)
+                model_server_timeout: 等待模型伺服器回應的秒數 (預設 30)
         """
         # 設置環境變數
         os.environ["GOOGLE_API_KEY"] = gemini_api_key
-        os.environ["COHERE_API_KEY"] = cohere_api_key
+        # 使用本地 cross-encoder 時可以不設定 Cohere 金鑰
+        if cohere_api_key:
+            os.environ["COHERE_API_KEY"] = cohere_api_key
         # 設置資源路徑
         backend_dir = os.path.dirname(os.path.dirname(__file__))
         
@@ -54,39 +151,129 @@ class TravelRAGService:
         if not os.path.exists(self.data_path):
             logger.warning(f"找不到資料檔案: attractions.csv")
             
-        # 設定設備
-        self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
-        logger.info(f"使用設備: {self.device}")
+        # 設定速率限制，產生子查詢、生成回答與重新排序各有獨立預算，每把 Gemini 金鑰各自計算
+        self.gemini_api_keys = kwargs.get("gemini_api_keys") or [gemini_api_key]
+        rate_limits = {purpose: dict(limit) for purpose, limit in DEFAULT_RATE_LIMITS.items()}
+        for purpose, limit in (kwargs.get("rate_limits") or {}).items():
+            rate_limits.setdefault(purpose, {}).update(limit)
+        rate_limits["query_generation"]["keys"] = len(self.gemini_api_keys)
+        rate_limits["answer_generation"]["keys"] = len(self.gemini_api_keys)
+        self.rate_scheduler = RateLimitScheduler(rate_limits)
         
-        # 設定速率限制
-        self.rate_limiter = InMemoryRateLimiter(
-            requests_per_second=0.05,  
-            check_every_n_seconds=0.1,  
-            max_bucket_size=10,  
+        # 設定嵌入模型，onnx 與 onnx_int8 不需載入 PyTorch
+        self.embedding_backend = kwargs.get("embedding_backend") or "torch"
+        self.model_client = None
+        if kwargs.get("model_server_address"):
+            # 模型由模型伺服器載入 (伺服器的 embedding_backend 需與此設定相同，查詢向量快取以此區分)
+            self.model_client = ModelClient(
+                kwargs["model_server_address"],
+                authkey=kwargs.get("model_server_authkey"),
+                timeout=kwargs.get("model_server_timeout", 30.0)
+            )
+            self.model_client.wait_ready()
+            logger.info(f"使用模型伺服器: {kwargs['model_server_address']}")
+            base_embeddings = RemoteEmbeddings(self.model_client)
+        else:
+            embedding_kwargs = {}
+            if self.embedding_backend != "torch" and kwargs.get("embedding_threads"):
+                embedding_kwargs["num_threads"] = kwargs["embedding_threads"]
+            base_embeddings = create_embeddings(EMBEDDING_MODEL_NAME, self.embedding_backend, **embedding_kwargs)
+        # 所有嵌入都經過 CachedEmbeddings：加上 e5 的查詢/段落前綴，並快取查詢向量
+        query_prefix, passage_prefix = text_prefixes(EMBEDDING_MODEL_NAME)
+        self.embeddings = CachedEmbeddings(
+            base_embeddings,
+            query_prefix=query_prefix,
+            passage_prefix=passage_prefix,
+            max_entries=kwargs.get("query_embedding_cache_size", 4096),
+            ttl_seconds=kwargs.get("query_embedding_cache_ttl", 86400),
+            shared_path=kwargs.get("query_embedding_cache_shared_path"),
+            fingerprint=f"{EMBEDDING_MODEL_NAME}|{self.embedding_backend}"
         )
         
-        # 設定嵌入模型
-        self.embeddings = HuggingFaceEmbeddings(
-            model_name="intfloat/multilingual-e5-small",
-            model_kwargs={
-                'device': self.device
-            },  
-            encode_kwargs={
-                'normalize_embeddings': True
-            }
+        # 設定語言模型，每把金鑰一個模型，由排程器分配
+        gemini_models = [
+            ChatGoogleGenerativeAI(
+                model="gemini-1.5-flash", 
+                temperature=0.2, 
+                google_api_key=api_key
+            )
+            for api_key in self.gemini_api_keys
+        ]
+        self.llm = ScheduledChatModel(self.rate_scheduler, "answer_generation", gemini_models)
+        self.query_llm = ScheduledChatModel(self.rate_scheduler, "query_generation", gemini_models)
+        
+        # 設定語意快取，資料檔或提示模板改變時自動失效
+        self.fingerprint = self.compute_fingerprint()
+        self.semantic_cache = None
+        if kwargs.get("semantic_cache_enabled", True):
+            self.semantic_cache = SemanticCache(
+                threshold=kwargs.get("semantic_cache_threshold", 0.95),
+                ttl_seconds=kwargs.get("semantic_cache_ttl", 86400),
+                max_entries=kwargs.get("semantic_cache_max_entries", 1000),
+                db_path=kwargs.get("semantic_cache_path"),
+                fingerprint=self.fingerprint
+            )
+        
+        # 設定完全比對快取 (以正規化後的查詢字串為鍵)，在語意快取之前先行比對
+        self.response_cache = None
+        if kwargs.get("response_cache_enabled", True):
+            self.response_cache = TTLCache(
+                max_entries=kwargs.get("response_cache_max_entries", 2000),
+                ttl_seconds=kwargs.get("response_cache_ttl", 3600)
+            )
+        
+        # 相同的查詢同時抵達時只執行一次問答鏈
+        self.coalescer = InflightCoalescer()
+        
+        # 查詢擴展方式，local 模式使用景點詞典，不需呼叫 Gemini
+        self.query_expansion_mode = kwargs.get("query_expansion_mode") or "llm"
+        
+        # 向量檢索方式，numpy 模式查詢時不經過 Chroma (寫入流程仍以 Chroma 為準)
+        self.vector_backend = kwargs.get("vector_backend") or "chroma"
+        self.vector_dtype = kwargs.get("vector_dtype") or "float32"
+        
+        # 向量與 BM25 結果的合併方式與檢索深度
+        self.fusion = HybridFusion(
+            mode=kwargs.get("fusion_mode") or "rrf",
+            weights=kwargs.get("fusion_weights") or (0.8, 0.2),
+            rrf_k=kwargs.get("fusion_rrf_k", 60),
+            dense_depth=kwargs.get("retrieval_dense_depth", 10),
+            sparse_depth=kwargs.get("retrieval_sparse_depth", 10),
+            top_n=kwargs.get("fusion_top_n") or kwargs.get("reranker_max_candidates", 50)
         )
         
-        # 設定語言模型
-        self.llm = ChatGoogleGenerativeAI(
-            model="gemini-1.5-flash", 
-            temperature=0.2, 
-            rate_limiter=self.rate_limiter
+        # 提示內容組合，停用時仍統計每個請求的提示 token 數量以便比較
+        self.context_packing_enabled = kwargs.get("context_packing_enabled", True)
+        self.context_packer = ContextPacker(
+            token_budget=kwargs.get("context_token_budget", 1500),
+            min_score_ratio=kwargs.get("context_min_score_ratio", 0.1)
         )
         
+        # 查詢提到地點或類別時先以結構化欄位過濾
+        self.metadata_filter_enabled = kwargs.get("metadata_filter_enabled", True)
+        
+        # 重新排序設定
+        self.reranker_backend = kwargs.get("reranker_backend") or "cohere"
+        self.reranker_model = kwargs.get("reranker_model") or DEFAULT_CROSS_ENCODER_MODEL
+        self.reranker_onnx_file = kwargs.get("reranker_onnx_file")
+        self.reranker_timeout = kwargs.get("reranker_timeout", 10.0)
+        self.reranker_max_candidates = kwargs.get("reranker_max_candidates", 50)
+        
+        # 最後放入提示的區塊數量
+        self.retrieval_top_n = kwargs.get("retrieval_top_n", 10)
+        
         # 初始化其他組件
         self.documents = None
         self.vector_store = None
+        self.sparse_index = None
+        self.metadata_index = None
+        self.dense_index = None
+        self.catalog = None
+        self.ingest_report = None
+        self.retrieval_executor = None
+        self.reranker = None
         self.retriever = None
+        self.prompt = None
         self.qa_chain = None
         
         # 初始化系統
@@ -101,7 +288,11 @@ class TravelRAGService:
         try:
             # 根據檔案類型選擇合適的載入器
             if self.data_path.endswith('.csv'):
-                loader = CSVLoader(self.data_path, encoding='utf-8')
+                # 與 CSVLoader 相同的內容格式，另外取出縣市、鄉鎮市區與類別放入 metadata
+                documents = list(stream_csv_documents(self.data_path))
+                logger.info(f"成功載入 {len(documents)} 個文件從 {self.data_path}")
+                self.documents = documents
+                return documents
             elif self.data_path.endswith('.pdf'):
                 loader = PyPDFLoader(self.data_path)
             elif self.data_path.endswith('.txt'):
@@ -120,7 +311,7 @@ class TravelRAGService:
             logger.error(f"載入文件時出錯: {str(e)}")
             return None
     
-    def split_documents(self, documents, chunk_size=300, chunk_overlap=50):
+    def split_documents(self, documents, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP):
         """將文件分割為更小塊"""
         if not documents:
             return []
@@ -128,7 +319,7 @@ class TravelRAGService:
         text_splitter = RecursiveCharacterTextSplitter(
             chunk_size=chunk_size,
             chunk_overlap=chunk_overlap,
-            separators=["\n\n", "\n", "。", "，", " ", ""]
+            separators=SPLIT_SEPARATORS
         )
         
         splits = text_splitter.split_documents(documents)
@@ -179,64 +370,90 @@ class TravelRAGService:
     
     def setup_retriever(self):
         """設置檢索器"""
-        if not self.vector_store:
+        if not self.vector_store and self.dense_index is None:
             logger.error("沒有向量資料庫，無法設置檢索器")
             return None
             
-        if not self.documents:
-            logger.warning("沒有原始文件，只能使用向量相似度檢索")
-            self.retriever = self.vector_store.as_retriever(
-                search_type="similarity",
-                search_kwargs={'k': 10}
-            )
-            return self.retriever
+        if self.sparse_index is None:
+            logger.warning("沒有稀疏索引，只使用向量相似度檢索")
         
         try:
-            # 設置向量相似度檢索器
-            sim_retriever = self.vector_store.as_retriever(
-                search_type="similarity",
-                search_kwargs={'k': 10}
-            )
+            self.reranker = self.setup_reranker()
             
-            # 設置BM25檢索器
-            bm25_retriever = BM25Retriever.from_documents(
-                documents=self.documents,
-                k=10
-            )
-            
-            # 組合檢索器
-            ensemble_retriever = EnsembleRetriever(
-                retrievers=[sim_retriever, bm25_retriever],
-                weights=[0.8, 0.2]
-            )
-            
-            # 設置多查詢檢索器
-            multi_retriever = MultiQueryRetriever.from_llm(
-                llm=self.llm,
-                retriever=ensemble_retriever
-            )
-            cohere_reranker = CohereRerank(
-                top_n=10,
-                model="rerank-multilingual-v2.0"  # 支持中文
-            )
-
-            self.retriever = ContextualCompressionRetriever(
-                base_retriever=multi_retriever,
-                base_compressor=cohere_reranker  
+            # 子查詢批次嵌入，向量與BM25檢索同時進行，合併去重後只重新排序一次
+            if self.retrieval_executor is not None:
+                self.retrieval_executor.shutdown()
+            self.retrieval_executor = RetrievalExecutor(
+                vector_store=self.vector_store,
+                embeddings=self.embeddings,
+                sparse_index=self.sparse_index,
+                fetch_documents=(
+                    self.dense_index.fetch_documents if self.dense_index is not None
+                    else chroma_document_fetcher(self.vector_store)
+                ),
+                expander=QueryExpander(
+                    query_llm=self.query_llm,
+                    catalog=self.catalog,
+                    default_mode=self.query_expansion_mode
+                ),
+                reranker=self.reranker,
+                catalog=self.catalog if self.metadata_filter_enabled else None,
+                metadata_index=self.metadata_index,
+                dense_index=self.dense_index,
+                fusion=self.fusion,
+                packer=self.context_packer if self.context_packing_enabled else None,
+                top_n=self.retrieval_top_n
             )
+            self.retriever = ExecutorRetriever(executor=self.retrieval_executor)
             logger.info("檢索器設置完成")
             return self.retriever
             
         except Exception as e:
             logger.error(f"設置檢索器時出錯: {str(e)}")
+            if self.vector_store is None:
+                # numpy 模式未開啟 Chroma，沒有可回退的檢索器
+                self.retriever = None
+                return None
             
             # 如果組合檢索器設置失敗，回退到簡單檢索器
             self.retriever = self.vector_store.as_retriever(
                 search_type="similarity",
-                search_kwargs={'k': 10}
+                search_kwargs={'k': self.retrieval_top_n}
             )
             return self.retriever
     
+    def setup_reranker(self):
+        """依設定建立重新排序器，逾時或出錯時只影響該次請求"""
+        if self.reranker_backend == "none":
+            return None
+        
+        try:
+            if self.reranker_backend == "cross_encoder":
+                reranker = CrossEncoderReranker(
+                    model=(
+                        RemoteCrossEncoder(self.model_client) if self.model_client is not None
+                        else load_cross_encoder(self.reranker_model, "cpu", self.reranker_onnx_file)
+                    ),
+                    top_n=self.retrieval_top_n
+                )
+            else:
+                reranker = ScheduledCohereRerank(
+                    top_n=self.retrieval_top_n,
+                    model="rerank-multilingual-v2.0",  # 支持中文
+                    scheduler=self.rate_scheduler
+                )
+        except Exception as e:
+            logger.error(f"建立重新排序器 ({self.reranker_backend}) 時出錯，不進行重新排序: {str(e)}")
+            return None
+        
+        logger.info(f"重新排序方式: {self.reranker_backend}")
+        return TimeoutFallbackReranker(
+            reranker=reranker,
+            timeout=self.reranker_timeout,
+            max_candidates=self.reranker_max_candidates,
+            top_n=self.retrieval_top_n
+        )
+    
     def setup_qa_chain(self):
         """設置問答鏈"""
         if not self.retriever:
@@ -245,24 +462,13 @@ class TravelRAGService:
             
         try:
             # 設置提示模板
-            template = """
-            你是一位臺灣旅遊專家，請基於以下資訊回答用戶的旅遊相關問題。
-            如果你不知道答案，請直接說你不知道，不要編造資訊。
-            
-            資訊:
-            {context}
-            
-            用戶問題: {question}
-            
-            請提供詳細、有幫助且符合臺灣當地文化的回答，並盡可能給予具體的建議。
-            如果有多個選擇，請根據場景、用戶喜好和地點的受歡迎程度進行推薦。
-            """
-            
             prompt = PromptTemplate(
-                template=template,
+                template=PROMPT_TEMPLATE,
                 input_variables=["context", "question"]
             )
             
+            self.prompt = prompt
+            
             # 創建QA鏈
             qa_chain = RetrievalQA.from_chain_type(
                 llm=self.llm,
@@ -281,90 +487,419 @@ class TravelRAGService:
             return None
     
     def initialize_system(self):
-        """初始化整個系統，自動檢測是否存在向量資料庫"""
+        """初始化整個系統，依寫入清單增量更新向量資料庫"""
+        # 資料檔可能已更新，先確認快取是否仍然有效
+        self.invalidate_cache()
+        
         try:
-            # 檢查向量資料庫是否已存在
-            db_exists = os.path.exists(self.persist_directory) and os.listdir(self.persist_directory)
-            
-            if db_exists:
-                logger.info("檢測到現有向量資料庫，嘗試載入...")
-                # 嘗試載入現有向量資料庫
-                if self.load_vector_store():
-                    # 不管是否成功載入文件，我們都加載一次保險
-                    self.documents = self.load_documents()
-                    # 設置檢索器和問答鏈
-                    self.setup_retriever()
-                    self.setup_qa_chain()
-                    logger.info("成功載入現有向量資料庫")
-                    return True
-                else:
-                    logger.warning("現有向量資料庫無法載入，將創建新的資料庫")
-                    db_exists = False
-            
-            # 如果不存在向量資料庫或載入失敗，創建新的
-            if not db_exists:
-                # 載入文件
-                documents = self.load_documents()
-                if not documents:
-                    logger.error("無法載入文件，系統初始化失敗")
-                    return False
-                
-                # 分割文件
-                splits = self.split_documents(documents)
-                
-                # 創建向量資料庫
-                if not self.create_vector_store(splits):
-                    logger.error("創建向量資料庫失敗")
-                    return False
-                
-                # 設置檢索器和問答鏈
-                self.setup_retriever()
-                self.setup_qa_chain()
-                logger.info("成功創建新的向量資料庫")
-                return True
-                
-            return False
+            if not os.path.exists(self.data_path):
+                logger.error("資料檔案不存在，系統初始化失敗")
+                return False
+            
+            # 多個 worker 同時啟動時只有一個行程開啟 Chroma、寫入與重建索引；
+            # numpy 模式下其他行程看到已更新的索引後直接以 mmap 載入，不開啟 Chroma
+            with build_lock(self.persist_directory):
+                if not (self.vector_backend == "numpy" and self.load_fresh_indexes()):
+                    # 載入向量資料庫 (不存在時建立空的資料庫)
+                    if not self.load_vector_store():
+                        logger.error("載入向量資料庫失敗")
+                        return False
+                    self.build_indexes()
+            
+            if self.vector_backend == "numpy" and self.dense_index is None:
+                # 不改用 Chroma 查詢：多個 worker 同時查詢 Chroma 並不安全
+                logger.error("numpy 向量索引無法使用，系統初始化失敗")
+                return False
+            
+            # 景點詞典 (地名與主題同義詞)，供本地查詢擴展使用
+            try:
+                if self.data_path.endswith('.csv'):
+                    self.catalog = AttractionCatalog.from_csv(self.data_path)
+            except Exception as e:
+                logger.error(f"建立景點詞典時出錯: {str(e)}")
+                self.catalog = None
+            
+            # 設置檢索器和問答鏈
+            self.setup_retriever()
+            self.setup_qa_chain()
+            logger.info("向量資料庫已就緒")
+            return True
             
         except Exception as e:
             logger.error(f"初始化系統時發生錯誤: {str(e)}")
             return False
     
-    def process_query(self, query):
-        """處理用戶查詢"""
+    def load_fresh_indexes(self):
+        """
+        資料檔未變更且稀疏索引與向量索引皆為最新時直接以 mmap 載入，不開啟 Chroma
+
+        Returns:
+            bool: 是否已載入所有索引
+        """
+        up_to_date, source_sha256 = is_up_to_date(
+            os.path.join(self.persist_directory, MANIFEST_FILENAME),
+            self.data_path,
+            self.embedding_fingerprint()
+        )
+        if not up_to_date:
+            return False
+        sparse_index_dir = os.path.join(self.persist_directory, SPARSE_INDEX_DIRNAME)
+        sparse_index = load_fresh_sparse_index(sparse_index_dir, source_sha256)
+        if sparse_index is None:
+            return False
+        dense_index = load_fresh_dense_index(
+            os.path.join(self.persist_directory, DENSE_INDEX_DIRNAME),
+            source_sha256,
+            self.embedding_fingerprint(),
+            dtype=self.vector_dtype,
+            chunk_ids=sparse_index.chunk_ids
+        )
+        if dense_index is None:
+            return False
+        
+        self.ingest_report = {"skipped": True, "source_sha256": source_sha256}
+        self.sparse_index = sparse_index
+        self.metadata_index = MetadataIndex.load(sparse_index_dir)
+        self.dense_index = dense_index
+        logger.info("索引皆為最新，直接以 mmap 載入 (不開啟向量資料庫)")
+        return True
+    
+    def build_indexes(self):
+        """增量寫入向量資料庫，並載入 (必要時重建) 稀疏索引與向量索引"""
+        # 只嵌入新增或內容改變的區塊，刪除已移除的區塊
+        self.ingest_report = ingest(
+            vector_store=self.vector_store,
+            manifest_path=os.path.join(self.persist_directory, MANIFEST_FILENAME),
+            source_path=self.data_path,
+            embedding_fingerprint=self.embedding_fingerprint(),
+            load_documents=self.load_documents,
+            split_documents=self.split_documents
+        )
+        
+        # BM25 稀疏索引以 mmap 載入，資料檔改變時依向量資料庫中的區塊重建
+        try:
+            sparse_index_dir = os.path.join(self.persist_directory, SPARSE_INDEX_DIRNAME)
+            self.sparse_index = ensure_sparse_index(
+                self.vector_store,
+                sparse_index_dir,
+                self.ingest_report["source_sha256"]
+            )
+            # 結構化欄位的反向索引與稀疏索引一起建立
+            self.metadata_index = MetadataIndex.load(sparse_index_dir)
+        except Exception as e:
+            logger.error(f"建立稀疏索引時出錯: {str(e)}")
+            self.sparse_index = None
+            self.metadata_index = None
+        
+        # numpy 向量檢索：從向量資料庫匯出向量矩陣，區塊位置與稀疏索引一致
+        self.dense_index = None
+        if self.vector_backend == "numpy":
+            try:
+                self.dense_index = ensure_dense_index(
+                    self.vector_store,
+                    os.path.join(self.persist_directory, DENSE_INDEX_DIRNAME),
+                    self.ingest_report["source_sha256"],
+                    self.embedding_fingerprint(),
+                    dtype=self.vector_dtype,
+                    chunk_ids=self.sparse_index.chunk_ids if self.sparse_index is not None else None
+                )
+            except Exception as e:
+                logger.error(f"建立向量索引時出錯: {str(e)}")
+                self.dense_index = None
+    
+    def embedding_fingerprint(self):
+        """嵌入模型與分割設定的指紋，改變時需要重建整個向量資料庫 (與離線寫入工具共用)"""
+        return embedding_fingerprint()
+    
+    def is_ready(self):
+        """問答鏈是否已設置完成"""
+        return self.qa_chain is not None
+    
+    def process_query(self, query, priority=DEFAULT_PRIORITY, query_expansion=None):
+        """
+        處理用戶查詢
+        
+        Args:
+            query: 用戶的查詢字串
+            priority: 等待 API 速率限制時的優先順序，數字越小越優先
+            query_expansion: 查詢擴展方式 llm/local/none，None 時使用預設值
+        """
         if not self.qa_chain:
             logger.error("問答鏈未設置")
             return "系統錯誤：問答鏈未設置"
         
         try:
-            # 處理查詢
-            result = self.qa_chain.invoke({"query": query})
-            answer = result["result"]
-            retrieved_docs = result.get("source_documents", [])
+            # 正規化後完全相同的查詢直接回傳快取答案
+            cache_key = normalize_query(query)
+            cached = self.response_cache.get(cache_key) if self.response_cache else None
+            if cached:
+                return cached[0]
             
-            # 顯示檢索到的文檔（用於日誌）
-            for i, doc in enumerate(retrieved_docs):
-                logger.info(f"檢索到文檔 {i+1}:")
-                logger.info(f"內容: {doc.page_content[:150]}...")
-                logger.info(f"來源: {doc.metadata.get('source', '未知')}")
+            # 相同的查詢同時進行時只執行一次問答鏈，其餘請求等待結果
+            with request_priority(priority), query_expansion_mode(query_expansion):
+                return self.coalescer.run(cache_key, lambda: self._answer_query(query, cache_key))
             
-            return answer
+        except Exception as e:
+            logger.error(f"處理查詢時發生錯誤: {str(e)}")
+            return f"處理查詢時發生錯誤: {str(e)}"
+    
+    def _answer_query(self, query, cache_key):
+        """查詢語意快取，未命中時執行問答鏈並寫入快取"""
+        # 查詢語意快取
+        query_vector = None
+        if self.semantic_cache:
+            query_vector = self.embeddings.embed_query(query)
+            cached = self.semantic_cache.lookup(query_vector, self._cache_partition(query))
+            if cached:
+                self._store_response_cache(cache_key, *cached)
+                return cached[0]
+        
+        # 處理查詢
+        result = self.qa_chain.invoke({"query": query})
+        answer = result["result"]
+        retrieved_docs = result.get("source_documents", [])
+        self._record_prompt_tokens(query, retrieved_docs)
+        self._log_retrieved_documents(retrieved_docs)
+        
+        self._store_cache(query, cache_key, query_vector, answer, retrieved_docs)
+        return answer
+    
+    async def aprocess_query(self, query, priority=DEFAULT_PRIORITY, query_expansion=None):
+        """
+        非同步處理用戶查詢
+        
+        整條問答鏈使用 ainvoke 執行：多查詢檢索的子查詢、向量與BM25檢索會同時進行，
+        等待 Gemini 與 Cohere 回應時不佔用執行緒
+        
+        Args:
+            query: 用戶的查詢字串
+            priority: 等待 API 速率限制時的優先順序，數字越小越優先
+            query_expansion: 查詢擴展方式 llm/local/none，None 時使用預設值
+        """
+        if not self.qa_chain:
+            logger.error("問答鏈未設置")
+            return "系統錯誤：問答鏈未設置"
+        
+        try:
+            # 正規化後完全相同的查詢直接回傳快取答案
+            cache_key = normalize_query(query)
+            cached = self.response_cache.get(cache_key) if self.response_cache else None
+            if cached:
+                return cached[0]
+            
+            # 相同的查詢同時進行時只執行一次問答鏈，其餘請求等待結果
+            with request_priority(priority), query_expansion_mode(query_expansion):
+                return await self.coalescer.arun(cache_key, lambda: self._aanswer_query(query, cache_key))
             
         except Exception as e:
             logger.error(f"處理查詢時發生錯誤: {str(e)}")
             return f"處理查詢時發生錯誤: {str(e)}"
     
-    def process_product_comparison(self, user_query):
+    async def _aanswer_query(self, query, cache_key):
+        """非同步查詢語意快取，未命中時執行問答鏈並寫入快取"""
+        # 查詢語意快取
+        query_vector = None
+        if self.semantic_cache:
+            query_vector = await self.embeddings.aembed_query(query)
+            # 語意快取可能寫入多個 worker 共用的 SQLite 檔案，在執行緒中執行不阻塞 event loop
+            cached = await asyncio.to_thread(self.semantic_cache.lookup, query_vector, self._cache_partition(query))
+            if cached:
+                self._store_response_cache(cache_key, *cached)
+                return cached[0]
+        
+        # 處理查詢
+        result = await self.qa_chain.ainvoke({"query": query})
+        answer = result["result"]
+        retrieved_docs = result.get("source_documents", [])
+        self._record_prompt_tokens(query, retrieved_docs)
+        self._log_retrieved_documents(retrieved_docs)
+        
+        await asyncio.to_thread(self._store_cache, query, cache_key, query_vector, answer, retrieved_docs)
+        return answer
+    
+    async def astream_query(self, query, priority=DEFAULT_PRIORITY, query_expansion=None):
+        """
+        非同步串流處理用戶查詢，先回傳檢索來源，再逐段回傳 Gemini 生成的文字
+        
+        Args:
+            query: 用戶的查詢字串
+            priority: 等待 API 速率限制時的優先順序，數字越小越優先
+            query_expansion: 查詢擴展方式 llm/local/none，None 時使用預設值
+            
+        Yields:
+            tuple: 先產生一次 ("sources", 來源資訊列表)，接著多次 ("token", 文字片段)
+        """
+        if not self.retriever or not self.prompt:
+            raise RuntimeError("問答鏈未設置")
+        
+        # 查詢完全比對與語意快取，命中時一次回傳完整答案
+        cache_key = normalize_query(query)
+        cached = self.response_cache.get(cache_key) if self.response_cache else None
+        query_vector = None
+        if not cached and self.semantic_cache:
+            query_vector = await self.embeddings.aembed_query(query)
+            # 語意快取可能寫入多個 worker 共用的 SQLite 檔案，在執行緒中執行不阻塞 event loop
+            cached = await asyncio.to_thread(self.semantic_cache.lookup, query_vector, self._cache_partition(query))
+            if cached:
+                self._store_response_cache(cache_key, *cached)
+        if cached:
+            answer, sources = cached
+            yield "sources", sources
+            yield "token", answer
+            return
+        
+        # 檢索相關文件
+        retrieved_docs = await self._aretrieve(query, priority, query_expansion)
+        self._log_retrieved_documents(retrieved_docs)
+        yield "sources", [self._document_source(doc) for doc in retrieved_docs]
+        
+        # 與 "stuff" 問答鏈相同的方式組合提示
+        prompt_text = self._record_prompt_tokens(query, retrieved_docs)
+        
+        # 逐段回傳生成結果，呼叫端關閉產生器時會一併中斷 Gemini 的串流
+        answer_parts = []
+        async for chunk in self.llm.astream(prompt_text, priority=priority):
+            if chunk.content:
+                answer_parts.append(chunk.content)
+                yield "token", chunk.content
+        
+        await asyncio.to_thread(
+            self._store_cache, query, cache_key, query_vector, "".join(answer_parts), retrieved_docs
+        )
+    
+    def _record_prompt_tokens(self, query, retrieved_docs):
+        """以 "stuff" 問答鏈相同的方式組合提示並記錄 token 數量，回傳提示文字"""
+        context = "\n\n".join(doc.page_content for doc in retrieved_docs)
+        prompt_text = self.prompt.format(context=context, question=query)
+        self.context_packer.record_prompt(prompt_text)
+        return prompt_text
+    
+    async def _aretrieve(self, query, priority, query_expansion=None):
+        """
+        以指定的優先順序與查詢擴展方式檢索相關文件
+        
+        產生器的每一步可能在不同的 context 中執行，優先順序需在單一協程內設定與還原
+        """
+        with request_priority(priority), query_expansion_mode(query_expansion):
+            return await self.retriever.ainvoke(query)
+    
+    def _store_cache(self, query, cache_key, query_vector, answer, retrieved_docs):
+        """將完整的回答寫入完全比對快取與語意快取"""
+        if not answer:
+            return
+        sources = [self._document_source(doc) for doc in retrieved_docs]
+        self._store_response_cache(cache_key, answer, sources)
+        if self.semantic_cache and query_vector is not None:
+            self.semantic_cache.store(query, query_vector, answer, sources, self._cache_partition(query))
+    
+    def _cache_partition(self, query):
+        """語意快取的分區：查詢解析出的縣市、鄉鎮市區與類別，條件不同的查詢不共用答案"""
+        if self.catalog is None:
+            return ""
+        filters = self.catalog.parse_filters(query)
+        return json.dumps(filters, ensure_ascii=False, sort_keys=True) if filters else ""
+    
+    def _store_response_cache(self, cache_key, answer, sources):
+        """寫入完全比對快取"""
+        if self.response_cache:
+            self.response_cache.set(cache_key, (answer, sources))
+    
+    def compute_fingerprint(self):
+        """計算資料檔、提示模板與嵌入模型的指紋，任一項改變時快取即失效"""
+        digest = hashlib.sha256()
+        digest.update(PROMPT_TEMPLATE.encode("utf-8"))
+        digest.update(embedding_fingerprint().encode("utf-8"))
+        if os.path.exists(self.data_path):
+            with open(self.data_path, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(block)
+        return digest.hexdigest()
+    
+    def invalidate_cache(self):
+        """重新計算指紋，資料檔或提示模板已改變時清空快取"""
+        fingerprint = self.compute_fingerprint()
+        if fingerprint == self.fingerprint:
+            return
+        self.fingerprint = fingerprint
+        if self.semantic_cache:
+            self.semantic_cache.set_fingerprint(fingerprint)
+        if self.response_cache:
+            self.response_cache.clear()
+    
+    def get_metrics(self):
+        """取得 RAG 服務的統計數據"""
+        metrics = {
+            "coalescer": self.coalescer.stats(),
+            "rate_limits": self.rate_scheduler.stats(),
+            "query_embeddings": self.embeddings.stats(),
+            "context_packing": self.context_packer.stats()
+        }
+        if self.response_cache:
+            metrics["response_cache"] = self.response_cache.stats()
+        if self.semantic_cache:
+            metrics["semantic_cache"] = self.semantic_cache.stats()
+        if self.retrieval_executor:
+            metrics["retrieval"] = self.retrieval_executor.stats()
+            if self.retrieval_executor.expander:
+                metrics["query_expansion"] = self.retrieval_executor.expander.stats()
+        if self.reranker:
+            metrics["rerank"] = self.reranker.stats()
+        if self.model_client is not None:
+            metrics["model_server"] = self.model_client.stats()
+        return metrics
+    
+    def _document_source(self, doc):
+        """取得文件的來源資訊 (回傳給前端用)"""
+        return {
+            "source": doc.metadata.get("source", "未知"),
+            "row": doc.metadata.get("row"),
+            "preview": doc.page_content[:150]
+        }
+    
+    def _log_retrieved_documents(self, retrieved_docs):
+        """顯示檢索到的文檔（用於日誌）"""
+        for i, doc in enumerate(retrieved_docs):
+            logger.info(f"檢索到文檔 {i+1}:")
+            logger.info(f"內容: {doc.page_content[:150]}...")
+            logger.info(f"來源: {doc.metadata.get('source', '未知')}")
+    
+    def process_product_comparison(self, user_query, priority=DEFAULT_PRIORITY, query_expansion=None):
         """
         處理用戶旅遊查詢請求
         Args:
             user_query: 用戶的查詢字串
+            priority: 等待 API 速率限制時的優先順序，數字越小越優先
+            query_expansion: 查詢擴展方式 llm/local/none，None 時使用預設值
+            
+        Returns:
+            tuple: (原始回應文字, JSON字典)
+        """
+        try:
+            # 處理查詢
+            response = self.process_query(user_query, priority=priority, query_expansion=query_expansion)
+            
+            # 返回原始回應和簡單的JSON格式
+            return response, {"response": response}
+            
+        except Exception as e:
+            error_msg = f"處理查詢出錯: {str(e)}"
+            logger.error(error_msg)
+            return error_msg, {"error": error_msg}
+    
+    async def aprocess_product_comparison(self, user_query, priority=DEFAULT_PRIORITY, query_expansion=None):
+        """
+        非同步處理用戶旅遊查詢請求
+        Args:
+            user_query: 用戶的查詢字串
+            priority: 等待 API 速率限制時的優先順序，數字越小越優先
+            query_expansion: 查詢擴展方式 llm/local/none，None 時使用預設值
             
         Returns:
             tuple: (原始回應文字, JSON字典)
         """
         try:
             # 處理查詢
-            response = self.process_query(user_query)
+            response = await self.aprocess_query(user_query, priority=priority, query_expansion=query_expansion)
             
             # 返回原始回應和簡單的JSON格式
             return response, {"response": response}
@@ -0,0 +1,90 @@
+from collections import OrderedDict
+import threading
+import time
+
+
+class TTLCache:
+    """
+    有存活時間與數量上限的 LRU 快取 (執行緒安全)
+
+    超過數量上限時淘汰最久未使用的項目，過期的項目在讀取時移除。
+    """
+
+    def __init__(self, max_entries=1024, ttl_seconds=None):
+        """
+        初始化快取
+
+        Args:
+            max_entries: 快取項目數量上限
+            ttl_seconds: 快取項目的存活秒數，None 表示不會過期
+        """
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+
+        self._lock = threading.Lock()
+        # key -> (寫入時間, 值)，順序即為 LRU 順序
+        self._entries = OrderedDict()
+
+        # 統計數據
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        """讀取快取，未命中或已過期時回傳 default"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            stored_at, value = entry
+            if self.ttl_seconds is not None and time.monotonic() - stored_at > self.ttl_seconds:
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """寫入快取"""
+        with self._lock:
+            if key in self._entries:
+                del self._entries[key]
+            while len(self._entries) >= self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            self._entries[key] = (time.monotonic(), value)
+
+    def pop(self, key, default=None):
+        """移除並回傳快取項目"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            return default if entry is None else entry[1]
+
+    def clear(self):
+        """清空快取"""
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def stats(self):
+        """取得快取統計數據"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
@@ -0,0 +1,266 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import contextvars
+import functools
+import threading
+import weakref
+import logging
+
+# 設置日誌
+logger = logging.getLogger(__name__)
+
+
+class WorkerPoolSaturated(Exception):
+    """工作池已滿，呼叫端應稍後重試"""
+
+    def __init__(self, pool_name, retry_after):
+        super().__init__(f"{pool_name} 工作池已滿")
+        self.pool_name = pool_name
+        self.retry_after = retry_after
+
+
+class BoundedWorkerPool:
+    """
+    有上限的執行緒工作池，將同步的阻塞工作移出 event loop
+
+    同時執行數量為 max_workers，另外最多允許 max_queue 個工作排隊，
+    超過上限時直接拒絕 (WorkerPoolSaturated)，讓 API 回傳 429。
+    """
+
+    def __init__(self, name, max_workers=4, max_queue=16, timeout=None, retry_after=10):
+        """
+        初始化工作池
+
+        Args:
+            name: 工作池名稱 (用於日誌與執行緒名稱)
+            max_workers: 同時執行的工作數量
+            max_queue: 可排隊等待的工作數量
+            timeout: 每個工作的預設逾時秒數，None 表示不限制
+            retry_after: 工作池已滿時建議用戶端重試的秒數
+        """
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.capacity = max_workers + max_queue
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+
+        # 統計數據
+        self.completed = 0
+        self.rejected = 0
+        self.timeouts = 0
+
+    def _admit(self):
+        """取得一個名額，已滿時拋出 WorkerPoolSaturated"""
+        with self._lock:
+            if self._in_flight >= self.capacity:
+                self.rejected += 1
+                raise WorkerPoolSaturated(self.name, self.retry_after)
+            self._in_flight += 1
+
+    def _release(self, _future=None):
+        """釋放名額"""
+        with self._lock:
+            self._in_flight -= 1
+            self.completed += 1
+
+    async def run(self, func, *args, timeout=None, **kwargs):
+        """
+        在工作池中執行同步函式並等待結果
+
+        Args:
+            func: 要執行的同步函式
+            timeout: 本次工作的逾時秒數，未指定時使用預設值
+
+        Returns:
+            函式的回傳值
+
+        Raises:
+            WorkerPoolSaturated: 工作池已滿
+            asyncio.TimeoutError: 工作逾時
+        """
+        self._admit()
+        try:
+            # 保留 contextvars，讓日誌等上下文資訊可以傳進執行緒
+            context = contextvars.copy_context()
+            future = self._executor.submit(context.run, functools.partial(func, *args, **kwargs))
+        except BaseException:
+            self._release()
+            raise
+
+        # 名額在工作真正結束時才釋放，逾時的工作仍佔用執行緒直到完成
+        future.add_done_callback(self._release)
+
+        timeout = self.timeout if timeout is None else timeout
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except asyncio.TimeoutError:
+            # 尚未開始執行的工作可直接取消
+            future.cancel()
+            with self._lock:
+                self.timeouts += 1
+            logger.warning(f"{self.name} 工作逾時 ({timeout} 秒)")
+            raise
+
+    def stats(self):
+        """取得工作池統計數據"""
+        with self._lock:
+            return {
+                "in_flight": self._in_flight,
+                "capacity": self.capacity,
+                "max_workers": self.max_workers,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "timeouts": self.timeouts,
+            }
+
+    def shutdown(self, wait=False):
+        """關閉工作池"""
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+
+
+class BoundedAsyncPool:
+    """
+    有上限的協程工作池，限制同時進行中的非同步工作數量
+
+    與 BoundedWorkerPool 相同的排隊、拒絕與逾時規則，但工作直接在 event loop
+    上以協程執行，不佔用執行緒；逾時時會取消協程，連帶取消上游的 API 呼叫。
+    """
+
+    def __init__(self, name, max_concurrency=32, max_queue=16, timeout=None, retry_after=10):
+        """
+        初始化協程工作池
+
+        Args:
+            name: 工作池名稱 (用於日誌)
+            max_concurrency: 同時執行的協程數量
+            max_queue: 可排隊等待的協程數量
+            timeout: 每個工作的預設逾時秒數 (包含排隊時間)，None 表示不限制
+            retry_after: 工作池已滿時建議用戶端重試的秒數
+        """
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.capacity = max_concurrency + max_queue
+
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._in_flight = 0
+
+        # 統計數據
+        self.completed = 0
+        self.rejected = 0
+        self.timeouts = 0
+
+    async def _run_with_slot(self, coro_func, args, kwargs):
+        """取得執行名額後執行協程"""
+        async with self._semaphore:
+            return await coro_func(*args, **kwargs)
+
+    async def run(self, coro_func, *args, timeout=None, **kwargs):
+        """
+        在工作池中執行協程函式並等待結果
+
+        Args:
+            coro_func: 要執行的協程函式
+            timeout: 本次工作的逾時秒數，未指定時使用預設值
+
+        Returns:
+            協程的回傳值
+
+        Raises:
+            WorkerPoolSaturated: 工作池已滿
+            asyncio.TimeoutError: 工作逾時
+        """
+        self._admit()
+
+        timeout = self.timeout if timeout is None else timeout
+        try:
+            return await asyncio.wait_for(self._run_with_slot(coro_func, args, kwargs), timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            logger.warning(f"{self.name} 工作逾時 ({timeout} 秒)")
+            raise
+        finally:
+            self._release()
+
+    def stream(self, agen_func, *args, timeout=None, **kwargs):
+        """
+        在工作池中執行非同步產生器
+
+        名額在呼叫時立即取得 (已滿時直接拋出 WorkerPoolSaturated，讓 API 可在開始串流前回傳 429)，
+        產生器結束、被關閉或被回收時釋放名額。
+
+        Args:
+            agen_func: 回傳非同步產生器的函式
+            timeout: 整個串流的逾時秒數，未指定時使用預設值
+
+        Returns:
+            非同步產生器
+        """
+        self._admit()
+        released = []
+
+        def release_once():
+            if not released:
+                released.append(True)
+                self._release()
+
+        timeout = self.timeout if timeout is None else timeout
+        wrapper = self._stream_with_slot(agen_func(*args, **kwargs), timeout, release_once)
+        # 用戶端在串流開始前就斷線時產生器不會被執行，回收時仍需釋放名額
+        weakref.finalize(wrapper, release_once)
+        return wrapper
+
+    async def _stream_with_slot(self, agen, timeout, release):
+        """取得執行名額後逐一轉送產生器的項目"""
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        try:
+            async with self._semaphore:
+                while True:
+                    remaining = None if deadline is None else max(deadline - loop.time(), 0)
+                    try:
+                        item = await asyncio.wait_for(agen.__anext__(), remaining)
+                    except StopAsyncIteration:
+                        break
+                    yield item
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            logger.warning(f"{self.name} 串流逾時 ({timeout} 秒)")
+            raise
+        finally:
+            await agen.aclose()
+            release()
+
+    def _admit(self):
+        """取得一個名額，已滿時拋出 WorkerPoolSaturated (只在 event loop 上呼叫，不需要加鎖)"""
+        if self._in_flight >= self.capacity:
+            self.rejected += 1
+            raise WorkerPoolSaturated(self.name, self.retry_after)
+        self._in_flight += 1
+
+    def _release(self):
+        """釋放名額"""
+        self._in_flight -= 1
+        self.completed += 1
+
+    def stats(self):
+        """取得工作池統計數據"""
+        return {
+            "in_flight": self._in_flight,
+            "capacity": self.capacity,
+            "max_concurrency": self.max_concurrency,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+        }
+
+    def shutdown(self, wait=False):
+        """協程工作池沒有需要釋放的資源，保留與 BoundedWorkerPool 相同的介面"""
+        return None
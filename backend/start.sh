@@ -0,0 +1,39 @@
+#!/bin/sh
+# 啟動後端服務
+#   web_workers: uvicorn worker 數量 (預設 1)
+#   model_server_socket: 設定時先啟動模型伺服器，所有 worker 共用一份嵌入模型與 cross-encoder
+#   vector_backend: 多個 worker 時必須為 numpy，Chroma 的嵌入式資料庫不支援多個行程同時查詢
+set -e
+
+WORKERS="${web_workers:-1}"
+
+if [ "$WORKERS" -gt 1 ]; then
+    if [ -z "$vector_backend" ]; then
+        # 各 worker 以 mmap 共用同一份向量矩陣，Chroma 只在啟動時取得寫入鎖後增量寫入
+        export vector_backend=numpy
+        echo "web_workers=$WORKERS，vector_backend 使用 numpy" >&2
+    elif [ "$vector_backend" != "numpy" ]; then
+        echo "web_workers=$WORKERS 時 vector_backend 必須為 numpy (目前為 $vector_backend)，Chroma 不支援多個行程同時查詢" >&2
+        exit 1
+    fi
+fi
+
+if [ -n "$model_server_socket" ]; then
+    # 模型伺服器只接受以 model_server_authkey (或 secret_key) 驗證的連線，未設定時拒絕啟動
+    python -m package.model_server --check
+    # 模型伺服器結束時自動重新啟動，worker 會重新連線
+    (
+        while true; do
+            python -m package.model_server --socket "$model_server_socket" || true
+            echo "模型伺服器已結束，1 秒後重新啟動" >&2
+            sleep 1
+        done
+    ) &
+fi
+
+if [ "$WORKERS" -gt 1 ]; then
+    # 先建立資料表，避免多個 worker 同時建立
+    python -c "import app.main as main; main.creat_db()"
+fi
+
+exec uvicorn app.main:app --host 0.0.0.0 --port 8000 --workers "$WORKERS"
@@ -0,0 +1,155 @@
+"""
+資料庫負載測試：搜尋寫入問答記錄的同時讀取歷史記錄
+
+以 httpx 直接呼叫 FastAPI app (不需啟動 uvicorn，也不載入 RAG 模型，RAG 以固定延遲模擬)，
+多個行程同時對同一個資料庫檔案讀寫，模擬多個 uvicorn worker：
+
+    cd backend
+    python ../benchmarks/db_load.py --processes 4 --searchers 16 --readers 16 --seconds 20
+    # 與未調整的設定 (無 WAL、無 busy timeout) 比較
+    python ../benchmarks/db_load.py --processes 4 --legacy
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend")
+sys.path.insert(0, BACKEND_DIR)
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+class FakeRAGService:
+    """以固定延遲模擬 RAG 查詢"""
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    async def aprocess_product_comparison(self, query, query_expansion=None):
+        await asyncio.sleep(self.latency)
+        answer = f"{query} 的推薦景點" * 20
+        return answer, {"answer": answer}
+
+
+async def run_load(args, users):
+    import httpx
+    import app.main as main
+
+    if args.legacy:
+        from sqlmodel import create_engine
+        main.engine = create_engine(main.DATABASE_URL, connect_args={"check_same_thread": False})
+    main.rag_service = FakeRAGService(args.rag_latency)
+
+    tokens = [main.create_access_token(user_id, user_name)[0] for user_id, user_name in users]
+    results = {"search": [], "history": []}
+    statuses = {"search": {}, "history": {}}
+    locked = 0
+    deadline = time.monotonic() + args.seconds
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=60) as client:
+        async def worker(kind, index):
+            nonlocal locked
+            headers = {"Authorization": f"Bearer {tokens[index % len(tokens)]}"}
+            while time.monotonic() < deadline:
+                started = time.perf_counter()
+                try:
+                    if kind == "search":
+                        response = await client.post("/api/search", json={"content": f"台北景點 {index}"}, headers=headers)
+                    else:
+                        response = await client.get("/api/history", params={"limit": 10}, headers=headers)
+                    status = response.status_code
+                    if "database is locked" in response.text:
+                        locked += 1
+                except Exception as e:
+                    status = type(e).__name__
+                    if "database is locked" in str(e):
+                        locked += 1
+                results[kind].append((time.perf_counter() - started) * 1000)
+                statuses[kind][str(status)] = statuses[kind].get(str(status), 0) + 1
+
+        await asyncio.gather(
+            *[worker("search", i) for i in range(args.searchers)],
+            *[worker("history", i) for i in range(args.readers)]
+        )
+    return {"latencies": results, "statuses": statuses, "locked": locked}
+
+
+def process_main(args, users, queue):
+    import logging
+    logging.disable(logging.CRITICAL)
+    queue.put(asyncio.run(run_load(args, users)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="資料庫負載測試")
+    parser.add_argument("--database-url", help="預設在暫存目錄建立 SQLite 資料庫")
+    parser.add_argument("--processes", type=int, default=4, help="同時執行的行程數量 (模擬 uvicorn worker)")
+    parser.add_argument("--searchers", type=int, default=16, help="每個行程同時送出搜尋的數量")
+    parser.add_argument("--readers", type=int, default=16, help="每個行程同時讀取歷史記錄的數量")
+    parser.add_argument("--seconds", type=float, default=20)
+    parser.add_argument("--rag-latency", type=float, default=0.05, help="模擬的 RAG 查詢秒數")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--legacy", action="store_true", help="使用未調整的 SQLite 設定 (無 WAL、無 busy timeout)")
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    os.environ["database_url"] = args.database_url or f"sqlite:///{os.path.join(tmp_dir, 'load.db')}"
+    os.environ.setdefault("secret_key", "load-test-secret")
+    os.environ.setdefault("rag_max_concurrency", "1024")
+    os.environ.setdefault("rag_queue_size", "1024")
+
+    import app.main as app_main
+
+    app_main.creat_db()
+    # 所有測試用戶共用一個密碼雜湊，避免建立用戶時花費大量時間在 bcrypt
+    hashed_password = app_main.hash_password("load-test")
+    users = []
+    with app_main.Session(app_main.engine) as session:
+        for i in range(args.users):
+            user = app_main.User(user_name=f"load-{time.time_ns()}-{i}", email=f"load-{time.time_ns()}-{i}@example.com",
+                                 hashed_password=hashed_password)
+            session.add(user)
+            session.commit()
+            session.refresh(user)
+            users.append((user.id, user.user_name))
+    app_main.engine.dispose()
+
+    queue = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target=process_main, args=(args, users, queue))
+        for _ in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+    reports = [queue.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    print(f"資料庫: {os.environ['database_url']} ({'legacy' if args.legacy else 'tuned'})")
+    for kind in ("search", "history"):
+        latencies = [ms for report in reports for ms in report["latencies"][kind]]
+        statuses = {}
+        for report in reports:
+            for status, count in report["statuses"][kind].items():
+                statuses[status] = statuses.get(status, 0) + count
+        print(
+            f"{kind}: {len(latencies)} 次，{len(latencies) / args.seconds:.1f} req/s，"
+            f"p50 {percentile(latencies, 50):.1f} ms，p99 {percentile(latencies, 99):.1f} ms，"
+            f"狀態 {json.dumps(statuses)}"
+        )
+    print(f"database is locked: {sum(report['locked'] for report in reports)} 次")
+
+
+if __name__ == "__main__":
+    main()
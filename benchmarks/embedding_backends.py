@@ -0,0 +1,125 @@
+"""
+比較嵌入模型各執行方式的載入時間、單一查詢延遲、記憶體用量與向量差異
+
+每種執行方式在獨立的子行程中執行，記憶體用量 (RSS) 才不會互相影響：
+
+    cd backend
+    python ../benchmarks/embedding_backends.py --backends torch onnx onnx_int8 --repeat 200
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend")
+sys.path.insert(0, BACKEND_DIR)
+
+# 常見的旅遊查詢
+QUERIES = [
+    "我想去陽明山一日遊，請問有哪些推薦的景點?",
+    "台北有哪些適合親子旅遊的景點？",
+    "請推薦我台中市的藝術景點",
+    "請推薦我高雄能夠看海的景點",
+    "請推薦我新北市靠海的景點",
+    "宜蘭有什麼好吃的夜市",
+    "請推薦我澎湖必去景點",
+    "花蓮兩天一夜行程規劃",
+]
+
+
+def rss_mb():
+    """目前行程的常駐記憶體 (MB)"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def run_worker(backend, repeat, vectors_path):
+    """在子行程中測量單一執行方式"""
+    import numpy as np
+    from package.embeddings import create_embeddings
+    from package.ingest import EMBEDDING_MODEL_NAME
+
+    baseline_rss = rss_mb()
+    started = time.perf_counter()
+    embeddings = create_embeddings(EMBEDDING_MODEL_NAME, backend, device="cpu")
+    load_seconds = time.perf_counter() - started
+
+    # 暖機
+    for query in QUERIES:
+        embeddings.embed_query(query)
+
+    latencies = []
+    for i in range(repeat):
+        query = QUERIES[i % len(QUERIES)]
+        started = time.perf_counter()
+        embeddings.embed_query(query)
+        latencies.append((time.perf_counter() - started) * 1000)
+
+    np.save(vectors_path, np.asarray(embeddings.embed_documents(QUERIES), dtype=np.float32))
+    return {
+        "backend": backend,
+        "load_seconds": round(load_seconds, 2),
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+        "rss_mb": round(rss_mb(), 1),
+        "rss_delta_mb": round(rss_mb() - baseline_rss, 1),
+        "torch_loaded": "torch" in sys.modules,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="比較嵌入模型的執行方式")
+    parser.add_argument("--backends", nargs="+", default=["torch", "onnx", "onnx_int8"])
+    parser.add_argument("--repeat", type=int, default=200, help="每種執行方式測量的查詢次數")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    parser.add_argument("--vectors", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_worker(args.worker, args.repeat, args.vectors)))
+        return
+
+    import numpy as np
+
+    results = []
+    vectors = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for backend in args.backends:
+            vectors_path = os.path.join(tmp_dir, f"{backend}.npy")
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--worker", backend,
+                 "--repeat", str(args.repeat), "--vectors", vectors_path],
+                check=True, capture_output=True, text=True
+            ).stdout
+            results.append(json.loads(output.strip().splitlines()[-1]))
+            vectors[backend] = np.load(vectors_path)
+
+    # 與第一種執行方式 (預設 torch) 的向量比較
+    reference = args.backends[0]
+    for result in results:
+        cosine = (vectors[result["backend"]] * vectors[reference]).sum(axis=1)
+        result[f"min_cosine_vs_{reference}"] = round(float(cosine.min()), 5)
+
+    columns = list(results[0].keys())
+    print(" | ".join(columns))
+    for result in results:
+        print(" | ".join(str(result[column]) for column in columns))
+
+
+if __name__ == "__main__":
+    main()
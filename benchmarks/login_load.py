@@ -0,0 +1,118 @@
+"""
+登入負載測試：大量登入請求同時進行時的登入吞吐量與 event loop 延遲
+
+以 httpx 直接呼叫 FastAPI app (不需啟動 uvicorn，也不載入 RAG 模型)，同時以 /healthz 的延遲
+觀察 bcrypt 是否阻塞 event loop (阻塞時其他 API，例如串流查詢，也會一起停頓)：
+
+    cd backend
+    python ../benchmarks/login_load.py --concurrency 32 --seconds 10
+    # 與在 event loop 中直接執行 bcrypt 的舊寫法比較
+    python ../benchmarks/login_load.py --concurrency 32 --seconds 10 --legacy
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend")
+sys.path.insert(0, BACKEND_DIR)
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+class InlinePool:
+    """舊寫法：直接在 event loop 中執行 bcrypt"""
+
+    async def run(self, func, *args, **kwargs):
+        return func(*args, **kwargs)
+
+    def stats(self):
+        return {}
+
+    def shutdown(self, wait=False):
+        return None
+
+
+async def run_load(args, main):
+    import httpx
+
+    logins, probes = [], []
+    statuses = {}
+    deadline = time.monotonic() + args.seconds
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=60) as client:
+        async def login_worker(index):
+            user_name = f"login-user-{index % args.users}"
+            while time.monotonic() < deadline:
+                started = time.perf_counter()
+                response = await client.post("/api/token", data={"username": user_name, "password": "load-test"})
+                logins.append((time.perf_counter() - started) * 1000)
+                statuses[str(response.status_code)] = statuses.get(str(response.status_code), 0) + 1
+
+        async def probe():
+            # 每輪 (請求 /healthz + 等待) 超出探測間隔的時間，event loop 被阻塞時等待也會延後
+            while time.monotonic() < deadline:
+                started = time.perf_counter()
+                await client.get("/healthz")
+                await asyncio.sleep(args.probe_interval)
+                probes.append((time.perf_counter() - started - args.probe_interval) * 1000)
+
+        await asyncio.gather(probe(), *[login_worker(i) for i in range(args.concurrency)])
+    return logins, probes, statuses
+
+
+def main():
+    parser = argparse.ArgumentParser(description="登入負載測試")
+    parser.add_argument("--concurrency", type=int, default=32, help="同時送出登入的數量")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--users", type=int, default=8)
+    parser.add_argument("--probe-interval", type=float, default=0.01, help="/healthz 的探測間隔秒數")
+    parser.add_argument("--legacy", action="store_true", help="在 event loop 中直接執行 bcrypt")
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    os.environ["database_url"] = f"sqlite:///{os.path.join(tmp_dir, 'login.db')}"
+    os.environ.setdefault("secret_key", "load-test-secret")
+    # 登入請求可能多於工作池名額，測試時讓請求排隊而非回傳 429
+    os.environ.setdefault("auth_queue_size", str(args.concurrency))
+
+    import logging
+    logging.disable(logging.CRITICAL)
+    import app.main as app_main
+
+    app_main.creat_db()
+    hashed_password = app_main.hash_password("load-test")
+    with app_main.Session(app_main.engine) as session:
+        for i in range(args.users):
+            session.add(app_main.User(user_name=f"login-user-{i}", email=f"login-user-{i}@example.com",
+                                      hashed_password=hashed_password))
+        session.commit()
+
+    if args.legacy:
+        app_main.auth_pool = InlinePool()
+
+    logins, probes, statuses = asyncio.run(run_load(args, app_main))
+
+    mode = "legacy (event loop)" if args.legacy else f"auth 工作池 ({app_main.AUTH_MAX_WORKERS} 執行緒)"
+    print(f"bcrypt rounds {app_main.BCRYPT_ROUNDS}，{mode}，同時 {args.concurrency} 個登入")
+    print(
+        f"login: {len(logins)} 次，{len(logins) / args.seconds:.1f} req/s，"
+        f"p50 {percentile(logins, 50):.1f} ms，p99 {percentile(logins, 99):.1f} ms，狀態 {json.dumps(statuses)}"
+    )
+    print(
+        f"healthz (含 event loop 延遲): {len(probes)} 次，p50 {percentile(probes, 50):.1f} ms，"
+        f"p99 {percentile(probes, 99):.1f} ms，max {max(probes, default=0):.1f} ms"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+比較 Chroma (HNSW) 與 numpy 向量檢索的 recall@10 與查詢延遲
+
+以 float32 暴力搜尋的結果為正確答案，查詢向量為隨機區塊向量加上雜訊 (不需載入嵌入模型)：
+
+    cd backend
+    # 使用已建立的向量資料庫
+    python ../benchmarks/vector_backends.py --persist-dir chroma_db
+    # 使用隨機產生的向量
+    python ../benchmarks/vector_backends.py --synthetic 20000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend")
+sys.path.insert(0, BACKEND_DIR)
+
+import numpy as np
+
+from package.dense_index import DenseIndex, _iter_embeddings
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def normalize(vectors):
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def synthetic_collection(n, dim, tmp_dir, seed=0):
+    """建立隨機向量的 Chroma collection (以群集模擬真實資料的分布)"""
+    import chromadb
+
+    rng = np.random.default_rng(seed)
+    centers = normalize(rng.standard_normal((max(1, n // 50), dim)))
+    vectors = normalize(centers[rng.integers(0, len(centers), n)] + 0.3 * rng.standard_normal((n, dim)) / dim ** 0.5)
+    collection = chromadb.PersistentClient(path=tmp_dir).create_collection("bench")
+    for start in range(0, n, 5000):
+        ids = [f"chunk-{i}" for i in range(start, min(n, start + 5000))]
+        collection.add(
+            ids=ids,
+            embeddings=vectors[start:start + 5000].tolist(),
+            documents=[f"區塊 {i}" for i in ids],
+            metadatas=[{"chunk_id": i} for i in ids]
+        )
+    return collection
+
+
+class _CollectionStore:
+    """讓 chromadb collection 提供與 langchain Chroma 相同的 get 介面"""
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def get(self, **kwargs):
+        return self._collection.get(**kwargs)
+
+
+def measure(search, queries, batch):
+    """回傳 (每次查詢的結果, 延遲毫秒)"""
+    results, latencies = [], []
+    for start in range(0, len(queries), batch):
+        started = time.perf_counter()
+        results.extend(search(queries[start:start + batch]))
+        latencies.append((time.perf_counter() - started) * 1000)
+    return results, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description="比較 Chroma 與 numpy 向量檢索")
+    parser.add_argument("--persist-dir", help="已建立的向量資料庫目錄")
+    parser.add_argument("--synthetic", type=int, default=20000, help="未指定 --persist-dir 時產生的區塊數量")
+    parser.add_argument("--dim", type=int, default=384, help="隨機向量的維度")
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--batch", type=int, default=1, help="每次查詢的子查詢數量")
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.persist_dir:
+            from langchain_chroma import Chroma
+            store = Chroma(persist_directory=args.persist_dir)
+        else:
+            store = _CollectionStore(synthetic_collection(args.synthetic, args.dim, os.path.join(tmp_dir, "chroma")))
+
+        started = time.perf_counter()
+        indexes = {}
+        for dtype in ("float32", "float16"):
+            DenseIndex.build(_iter_embeddings(store), dtype=dtype).save(os.path.join(tmp_dir, dtype))
+            indexes[dtype] = DenseIndex.load(os.path.join(tmp_dir, dtype))
+        print(f"匯出 {len(indexes['float32'])} 個區塊向量，耗時 {time.perf_counter() - started:.2f} 秒")
+
+        # 查詢向量：隨機區塊向量加上雜訊
+        rng = np.random.default_rng(1)
+        matrix = np.asarray(indexes["float32"].vectors)
+        picked = matrix[rng.integers(0, len(matrix), args.queries)]
+        queries = normalize(picked + 0.5 * rng.standard_normal(picked.shape) / matrix.shape[1] ** 0.5).astype(np.float32)
+
+        # 正確答案：float32 暴力搜尋
+        truth = [set(positions) for positions in np.argsort(-(queries @ matrix.T), axis=1)[:, :args.k]]
+        chunk_ids = indexes["float32"].chunk_ids
+        truth_ids = [{str(chunk_ids[p]) for p in positions} for positions in truth]
+
+        def chroma_search(batch):
+            result = store._collection.query(query_embeddings=batch.tolist(), n_results=args.k, include=[])
+            return [set(ids) for ids in result["ids"]]
+
+        def numpy_search(index):
+            def search(batch):
+                return [{str(index.chunk_ids[p]) for p in positions} for positions, _ in index.search(batch, args.k)]
+            return search
+
+        backends = {
+            "chroma": chroma_search,
+            "numpy_float32": numpy_search(indexes["float32"]),
+            "numpy_float16": numpy_search(indexes["float16"]),
+        }
+        print(f"backend | recall@{args.k} | p50_ms | p99_ms (每次 {args.batch} 個子查詢)")
+        for name, search in backends.items():
+            # 暖機
+            measure(search, queries[:20], args.batch)
+            results, latencies = measure(search, queries, args.batch)
+            recall = np.mean([len(found & expected) / args.k for found, expected in zip(results, truth_ids)])
+            print(f"{name} | {recall:.4f} | {percentile(latencies, 50):.2f} | {percentile(latencies, 99):.2f}")
+
+
+if __name__ == "__main__":
+    main()
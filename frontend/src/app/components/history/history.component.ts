@@ -35,7 +35,7 @@ export class HistoryComponent implements OnInit {
     this.isLoading = true;
     this.errorMessage = '';
     
-    this.historyService.getQueryHistory(page * this.pageSize, this.pageSize).subscribe({
+    this.historyService.getQueryHistory(page * this.pageSize, this.pageSize, true).subscribe({
       next: (response) => {
         this.queryHistory = response.records;
         this.totalRecords = response.total;
@@ -61,6 +61,25 @@ export class HistoryComponent implements OnInit {
 
   viewQueryDetails(query: any) {
     this.selectedQuery = query;
+
+    // 列表只有回覆的前段文字，選取時再取得完整記錄
+    if (query.truncated) {
+      this.historyService.getQueryById(query.id).subscribe({
+        next: (record) => {
+          const index = this.queryHistory.findIndex(q => q.id === record.id);
+          if (index >= 0) {
+            this.queryHistory[index] = record;
+          }
+          if (this.selectedQuery && this.selectedQuery.id === record.id) {
+            this.viewQueryDetails(record);
+          }
+        },
+        error: (error) => {
+          this.messageService.error(error.message || '無法載入查詢記錄');
+        }
+      });
+      return;
+    }
     
     try {
       // 旅遊回覆是簡單的字串格式，不需要復雜的解析
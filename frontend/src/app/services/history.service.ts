@@ -15,8 +15,9 @@ export class HistoryService {
     private authService: AuthService
   ) { }
 
-  getQueryHistory(skip: number = 0, limit: number = 10): Observable<any> {
-    return this.http.get(`${this.apiUrl}/api/history?skip=${skip}&limit=${limit}`, {
+  // summary 為 true 時回覆只包含前段文字 (truncated 標記被截斷的記錄)，完整內容以 getQueryById 取得
+  getQueryHistory(skip: number = 0, limit: number = 10, summary: boolean = false): Observable<any> {
+    return this.http.get(`${this.apiUrl}/api/history?skip=${skip}&limit=${limit}&summary=${summary}`, {
       headers: this.authService.getAuthHeaders()
     }).pipe(
       catchError(this.handleError)